@@ -4,6 +4,7 @@
 """Example client for imagepipe"""
 
 import base64
+import httplib
 import os
 import re
 import cStringIO
@@ -12,6 +13,26 @@ import urllib
 import xmlrpclib
 from optparse import OptionParser
 
+
+def upload_query(name, value):
+    """Return query arguments of /upload for a store_image argument, value
+    is either a single one or a dictionary of values by suffix"""
+    if isinstance(value, dict):
+        return [(name, '%s:%s' % (suffix, item)) for
+                suffix, item in sorted(value.items())]
+    elif value:
+        return [(name, value)]
+    return []
+
+
+def batch_status(statuses):
+    """Print the statuses returned by a batch call, exit unless all of them
+    are OK"""
+    print statuses
+    if [status for status in statuses if status != 'OK']:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     parser = OptionParser(usage='usage: %prog [options]')
     parser.add_option('--host', dest='host', default='127.0.0.1',
@@ -27,10 +48,28 @@ if __name__ == '__main__':
                       help=('delete remote image specified by PATH, multiple '
                             '-d options can be specified'),
                       metavar='PATH')
+    parser.add_option('-g', '--get', dest='image_get',
+                      help=('download remote image specified by PATH from '
+                            '/images'), metavar='PATH')
+    parser.add_option('-o', '--output', dest='output',
+                      help=('write downloaded image to PATH (default: its '
+                            'file name)'), metavar='PATH')
     parser.add_option('-m', '--move', action='append', dest='image_move',
                       help=('move remote image specified by SRC_PATH to '
                             'DST_PATH, multiple -m options can be specified'),
                       metavar='"SRC_PATH DST_PATH"')
+    parser.add_option('--delete-prefix', dest='prefix_delete',
+                      help=('delete remote directory or image with its sizes '
+                            'specified by PREFIX'), metavar='PREFIX')
+    parser.add_option('--move-prefix', dest='prefix_move',
+                      help=('move remote directory or image with its sizes '
+                            'specified by SRC_PREFIX to DST_PREFIX'),
+                      metavar='"SRC_PREFIX DST_PREFIX"')
+    parser.add_option('--suffix', action='append', dest='prefix_suffix',
+                      help=('limit the sizes of an image prefix to SUFFIX, '
+                            'multiple --suffix options can be specified, '
+                            '--preset gives the suffixes of a preset'),
+                      metavar='SUFFIX')
     parser.add_option('--remote-path', dest='image_remote_path',
                       help='force uploaded file path', metavar='PATH')
     parser.add_option('--size', action='append', dest='image_size',
@@ -41,6 +80,18 @@ if __name__ == '__main__':
                             'specified'),
                       metavar=('"SUFFIX WIDTH HEIGHT [FORMAT] '
                               '[composite|crop]"'))
+    parser.add_option('--preset', dest='image_preset',
+                      help=('store uploaded file in the sizes of a preset '
+                            'from the service configuration, size, format, '
+                            'composite and crop options are ignored'),
+                      metavar='NAME')
+    parser.add_option('--raw', action='store_true', dest='image_raw',
+                      default=False, help=('upload file unencoded in the '
+                                           'body of a request to /upload'))
+    parser.add_option('--batch', action='store_true', dest='batch',
+                      default=False, help=('use store_images, delete_images '
+                                           'and move_images, fail unless '
+                                           'every status is OK'))
     parser.add_option('--format', dest='image_format',
                       help='force uploaded file format', metavar='FORMAT')
     parser.add_option('--composite', action='store_true',
@@ -56,7 +107,9 @@ if __name__ == '__main__':
 
     if not options.host or not options.port or (
             not options.image_path and not options.image_url and
-            not options.image_delete and not options.image_move):
+            not options.image_delete and not options.image_move and
+            not options.image_get and not options.prefix_delete and
+            not options.prefix_move):
         parser.print_help()
         sys.exit(1)
 
@@ -120,18 +173,74 @@ if __name__ == '__main__':
             crop = multi_crop
 
         image = cStringIO.StringIO()
-        base64.encode(open(local_path, 'r'), image)
+        if not options.image_raw:
+            base64.encode(open(local_path, 'r'), image)
+
+        if options.image_raw:
+            query = upload_query('preset', options.image_preset)
+            if not options.image_preset:
+                if size:
+                    query += upload_query('size', dict([
+                        (suffix, 'x'.join(dimension)) for
+                        suffix, dimension in size.items()]))
+                for name, value in (('format', fmt), ('composite', composite),
+                                    ('crop', crop)):
+                    query += upload_query(name, value)
+            url = '/upload/%s?%s' % (urllib.quote(remote_path),
+                                     urllib.urlencode(query))
+
+            print "PUT %s" % (url,)
+            connection = httplib.HTTPConnection(options.host,
+                                                int(options.port))
+            connection.request('PUT', url, open(local_path, 'rb').read())
+            response = connection.getresponse()
+            print response.read()
+            if response.status != httplib.OK:
+                sys.exit(1)
+        elif options.batch:
+            spec = {'image': image.getvalue(), 'path': remote_path}
+            if options.image_preset:
+                spec['preset'] = options.image_preset
+            else:
+                spec.update({'format': fmt, 'size': size,
+                             'composite': composite, 'crop': crop})
+            print "xmlrpc.store_images([{..., 'path': %s}])" % (
+                repr(remote_path),)
+            batch_status(xmlrpc.store_images([spec]))
+        elif options.image_preset:
+            print "xmlrpc.store_image_preset(..., %s, %s)" % (
+                repr(remote_path), repr(options.image_preset))
+            print xmlrpc.store_image_preset(image.getvalue(), remote_path,
+                                            options.image_preset)
+        else:
+            print "xmlrpc.store_image(..., %s, %s, %s, %s, %s)" % (
+                repr(remote_path), repr(fmt), repr(size), repr(composite),
+                repr(crop))
+            print xmlrpc.store_image(image.getvalue(), remote_path, fmt,
+                                     size, composite, crop)
 
-        print "xmlrpc.store_image(..., %s, %s, %s, %s, %s)" % (
-            repr(remote_path), repr(fmt), repr(size), repr(composite),
-            repr(crop))
-        print xmlrpc.store_image(image.getvalue(), remote_path, fmt, size,
-                                 composite, crop)
+    elif options.image_get:
+        url = '/images/%s' % (urllib.quote(options.image_get),)
+        print "GET %s" % (url,)
+        connection = httplib.HTTPConnection(options.host, int(options.port))
+        connection.request('GET', url)
+        response = connection.getresponse()
+        if response.status != httplib.OK:
+            print response.read()
+            sys.exit(1)
+
+        output = options.output or os.path.basename(options.image_get)
+        open(output, 'wb').write(response.read())
+        print "Written to %s" % (output,)
 
     elif options.image_delete:
         remote_path = options.image_delete
-        print "xmlrpc.delete_image(%s)" % repr(remote_path)
-        print xmlrpc.delete_image(remote_path)
+        if options.batch:
+            print "xmlrpc.delete_images(%s)" % repr(remote_path)
+            batch_status(xmlrpc.delete_images(remote_path))
+        else:
+            print "xmlrpc.delete_image(%s)" % repr(remote_path)
+            print xmlrpc.delete_image(remote_path)
 
     elif options.image_move:
         remote_src_path = []
@@ -142,6 +251,23 @@ if __name__ == '__main__':
             remote_src_path.append(src_path)
             remote_dst_path.append(dst_path)
 
-        print "xmlrpc.move_image(%s, %s)" % (repr(remote_src_path),
-                                             repr(remote_dst_path))
-        print xmlrpc.move_image(remote_src_path, remote_dst_path)
+        if options.batch:
+            print "xmlrpc.move_images(%s, %s)" % (repr(remote_src_path),
+                                                  repr(remote_dst_path))
+            batch_status(xmlrpc.move_images(remote_src_path, remote_dst_path))
+        else:
+            print "xmlrpc.move_image(%s, %s)" % (repr(remote_src_path),
+                                                 repr(remote_dst_path))
+            print xmlrpc.move_image(remote_src_path, remote_dst_path)
+
+    elif options.prefix_delete or options.prefix_move:
+        suffixes = options.image_preset or options.prefix_suffix
+        if options.prefix_delete:
+            print "xmlrpc.delete_prefix(%s, %s)" % (
+                repr(options.prefix_delete), repr(suffixes))
+            print xmlrpc.delete_prefix(options.prefix_delete, suffixes)
+        else:
+            (src_prefix, dst_prefix) = re.split('\s+', options.prefix_move)
+            print "xmlrpc.move_prefix(%s, %s, %s)" % (
+                repr(src_prefix), repr(dst_prefix), repr(suffixes))
+            print xmlrpc.move_prefix(src_prefix, dst_prefix, suffixes)
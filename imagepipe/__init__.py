@@ -9,4 +9,5 @@ and storing images.
 __author__ = 'Lukasz Kawczynski'
 __maintainer__ = 'Lukasz Kawczynski'
 __email__ = 'n@neuroid.pl'
-__all__ = ['image_service', 'io']
+__all__ = ['image_service', 'index', 'io', 'metrics', 'pillow_io',
+           'presets', 'replication', 'sync', 'workers']
@@ -12,18 +12,47 @@ _spec = """
 [network]
 interface = string(default='0.0.0.0')
 port = integer(default=8085)
+workers = integer(default=1)
 
 [replication]
 publish = string(default=None)
-subscribe = string(default=None)
+subscribe = force_list(default=list())
+forward = boolean(default=True)
+mode = option('command', 'result', default='command')
+wire = option('binary', 'json', default='json')
+journal = string(default=None)
+journal_size = integer(default=1024)
+journal_age = integer(default=86400)
+replay = string(default=None)
+replay_peers = force_list(default=list())
 
 [images]
 path = string()
+roots = force_list(default=list())
 umask = integer(default=0022)
 io_threads = integer(default=1)
+queue_depth = integer(default=100)
+queue_memory = integer(default=512)
+index = string(default=None)
+lazy = boolean(default=False)
+
+[cache]
+path = string(default=None)
+size = integer(default=1024)
+
+[presets]
+[[__many__]]
+__many__ = string()
 
 [imagemagick]
 convert = string(default='/usr/bin/convert')
+engine = option('convert', 'pillow', default='convert')
+pool = boolean(default=False)
+pool_max_jobs = integer(default=1000)
+pool_max_rss = integer(default=256)
+async = boolean(default=False)
+max_converts = integer(default=4)
+parallel = integer(default=1)
 [[env]]
 """
 
@@ -40,7 +69,8 @@ class ValidationError(Error):
 
 def read(conf_path):
     """Create a configuration object from cont_path"""
-    configspec = configobj.ConfigObj(cStringIO.StringIO(_spec))
+    configspec = configobj.ConfigObj(cStringIO.StringIO(_spec),
+                                     list_values=False, _inspec=True)
     return configobj.ConfigObj(conf_path, configspec=configspec,
                                file_error=True)
 
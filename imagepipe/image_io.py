@@ -2,13 +2,32 @@
 
 """Image handling functions"""
 
+import collections
+import contextlib
+import cStringIO
+import errno
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
 import os
 import shutil
+import stat
+import struct
 import subprocess
+import sys
+import threading
+import time
 
+from twisted.internet import defer, error, protocol, threads
+from twisted.protocols import basic
 from twisted.python import log
 import unidecode
 
+from imagepipe import metrics
+from imagepipe import pillow_io
+
 
 class Error(Exception):
     """Base class for processing errors"""
@@ -20,29 +39,604 @@ class ImageMagickError(Error):
     pass
 
 
+class InvalidImageError(Error):
+    """Indicates a broken header of an image, see probe"""
+    pass
+
+
+class LockedError(Error):
+    """Indicates images locked by another process, see Shards.lock"""
+    pass
+
+
+# Numbers of probed headers of known formats, conversions skipped as the
+# images already matched the variants and headers of them rejected as broken
+# (counted as probed too), see probe and _unchanged
+probe_stats = collections.Counter()
+_probe_lock = threading.Lock()
+
+# Format names of file extensions, as returned by probe
+_probe_formats = {'jpg': 'jpeg', 'jpe': 'jpeg'}
+
+# Numbers making temporary file names unique within the process
+_temp_ids = itertools.count()
+
+
+class ResultCache(object):
+    """Disk cache of converted images
+
+    Entries are keyed by the hash of the image blob and the transformation
+    (see key) and stored under path. Cached images are hard linked (or copied
+    if path is on a different filesystem) into place. Once the total size of
+    entries exceeds max_size bytes the least recently used ones are removed.
+    """
+
+    def __init__(self, path, max_size, version=''):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        create_dirs(path)
+        # Restore the order of use from access times, see fetch
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            if dirpath == path:
+                # Entries are in subdirectories named by the first two
+                # characters of their keys, others are caches of their own
+                dirnames[:] = [dirname for dirname in dirnames if
+                               len(dirname) == 2]
+                continue
+            for filename in filenames:
+                if filename.startswith('.tmp.') or filename.endswith('.tmp'):
+                    delete(os.path.join(dirpath, filename))
+                    continue
+                stat = os.stat(os.path.join(dirpath, filename))
+                entries.append((stat.st_atime, filename, stat.st_size))
+        for atime, key, size in sorted(entries):
+            self._entries[key] = size
+            self.size += size
+
+    def key(self, digest, variant, cascade=False):
+        """Return the key of variant of an image with the given digest,
+        cascade tells if it may be resized from a larger variant (see
+        store_multi)"""
+        return hashlib.sha1(repr((
+            digest, variant.get('fmt'), variant.get('dimension'),
+            bool(variant.get('composite')), bool(variant.get('crop')),
+            bool(cascade), self.version))).hexdigest()
+
+    def _entry_path(self, key):
+        """Return path of the cache entry"""
+        return os.path.join(self.path, key[:2], key)
+
+    def fetch(self, key, path, mode=None):
+        """Put the cached image in place of path, returns False on a miss
+
+        Links share the permission bits of the entry, so the image is copied
+        instead if mode is given and differs from them.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return False
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+
+        entry_path = self._entry_path(key)
+        try:
+            if (mode is not None and
+                    stat.S_IMODE(os.stat(entry_path).st_mode) != mode):
+                with open(entry_path, 'rb') as entry:
+                    _write(entry, path, mode)
+            else:
+                _link(entry_path, path)
+            # Modification time is left intact as it is shared with path
+            os.utime(entry_path, (time.time(),
+                                  os.stat(entry_path).st_mtime))
+        except (IOError, OSError):
+            # Evicted in the meantime
+            with self._lock:
+                self._entries.pop(key, None)
+                self.hits -= 1
+                self.misses += 1
+            return False
+        return True
+
+    def add(self, key, path):
+        """Store image from path under key and evict old entries"""
+        entry_path = self._entry_path(key)
+        create_dirs(os.path.dirname(entry_path))
+        _link(path, entry_path)
+        size = os.path.getsize(entry_path)
+
+        with self._lock:
+            self.size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+
+            evicted = []
+            while self.size > self.max_size and self._entries:
+                (evicted_key, evicted_size) = self._entries.popitem(False)
+                self.size -= evicted_size
+                evicted.append(evicted_key)
+
+        for evicted_key in evicted:
+            delete(self._entry_path(evicted_key))
+
+
+class Shards(object):
+    """Placement of images on several roots, e.g. one per disk
+
+    The first root holds the tree of all images. Every file is stored on the
+    root chosen by rendezvous hashing of its path relative to the tree (see
+    shard), so adding a root moves only the files it takes over (see
+    rebalance). Roots are told apart by their position in roots, so new ones
+    are appended and placement does not depend on where they are mounted.
+    Files stored on other roots are symbolic links in the tree, which is
+    served as before. Paths given to the methods are ones in the tree, roots
+    are made absolute as links are.
+    """
+
+    def __init__(self, roots):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.root = self.roots[0]
+
+    def shard(self, path):
+        """Return the index of the root of path
+
+        Originals and manifests of lazily stored variants are kept on the
+        root of their variant, see store_lazy. Paths are hashed UTF-8
+        encoded.
+        """
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        (dirname, name) = os.path.split(os.path.relpath(path, self.root))
+        key = os.path.join(dirname, _variant_name(name))
+        return max(xrange(len(self.roots)), key=lambda i: hashlib.md5(
+            '%d\0%s' % (i, key)).digest())
+
+    def locate(self, path):
+        """Return the path on its root of the file at path"""
+        return os.path.join(self.roots[self.shard(path)],
+                            os.path.relpath(path, self.root))
+
+    def resolve(self, path):
+        """Return the path the file at path is stored at, the target of its
+        link if it is one"""
+        try:
+            return os.path.join(os.path.dirname(path), os.readlink(path))
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOENT):
+                raise
+            return path
+
+    def link(self, path, previous=None):
+        """Link path to the file at its location (see locate), written
+        before, and remove the file previously linked from another root
+
+        As a location in the tree replaces the link at path once written,
+        previous is the file path resolved to (see resolve) before then.
+        """
+        path = os.path.normpath(path)
+        location = self.locate(path)
+        if previous is None:
+            previous = self.resolve(path)
+        if location != path:
+            create_dirs(os.path.dirname(path))
+            tmp_path = _temp_path(path)
+            os.symlink(location, tmp_path)
+            os.rename(tmp_path, path)
+        if previous not in (path, location):
+            delete(previous)
+
+    def move(self, src_path, dst_path):
+        """Move the file at src_path to dst_path and its location
+
+        Files are renamed within a root and copied between roots.
+        """
+        src_location = self.resolve(src_path)
+        previous = self.resolve(dst_path)
+        location = self.locate(dst_path)
+        create_dirs(os.path.dirname(location))
+        try:
+            os.rename(src_location, location)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            _link(src_location, location)
+            shutil.copymode(src_location, location)
+            os.unlink(src_location)
+        if src_location != src_path:
+            os.unlink(src_path)
+        self.link(dst_path, previous != src_location and previous or None)
+
+    def lock(self, exclusive=False):
+        """Lock the tree, returns the file descriptor holding the lock until
+        it is closed
+
+        Services storing images hold shared locks, rebalance an exclusive
+        one. Raises LockedError if the tree is locked the other way.
+        """
+        create_dirs(self.root)
+        fd = os.open(self.root, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, (exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH) |
+                        fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            raise LockedError(exclusive and "Images are in use, stop the "
+                              "service first" or "Images are being "
+                              "rebalanced")
+        return fd
+
+    def rebalance(self, progress=None):
+        """Move files of the tree not stored at their location there, e.g.
+        after adding a root, and remove files of other roots not linked from
+        the tree
+
+        A moved file is copied first and replaced by its link then, so it
+        can be read throughout. Files being stored could be removed or
+        replaced by older copies, so the tree is locked exclusively (see
+        lock) while no service runs. progress is called with the numbers of
+        checked, moved and removed files every 1000 checked files if given.
+        Returns the numbers of moved and removed files.
+        """
+        fd = self.lock(exclusive=True)
+        try:
+            return self._rebalance(progress)
+        finally:
+            os.close(fd)
+
+    def _rebalance(self, progress):
+        """Rebalance the locked tree, see rebalance"""
+        counts = [0, 0, 0]
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.tmp.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                current = self.resolve(path)
+                location = self.locate(path)
+                if current != location and os.path.exists(current):
+                    create_dirs(os.path.dirname(location))
+                    _link(current, location)
+                    shutil.copymode(current, location)
+                    self.link(path, current)
+                    counts[1] += 1
+                counts[0] += 1
+                if progress and counts[0] % 1000 == 0:
+                    progress(*counts)
+
+        for root in self.roots[1:]:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    location = os.path.join(dirpath, filename)
+                    path = os.path.join(self.root,
+                                        os.path.relpath(location, root))
+                    if (not filename.startswith('.tmp.') and
+                            self.resolve(path) != location):
+                        delete(location)
+                        counts[2] += 1
+
+        if progress:
+            progress(*counts)
+        return tuple(counts[1:])
+
+
+def _temp_path(path):
+    """Return a hidden temporary path in the directory of path
+
+    Files are written there and renamed to path, so readers never see
+    partially written ones and hard links of a replaced file (e.g. cache
+    entries) keep their contents. The file name of path is kept as the end
+    of the temporary one as convert chooses the format by its extension.
+    """
+    (dirname, filename) = os.path.split(path)
+    return os.path.join(dirname, '.tmp.%d.%d.%s' % (
+        os.getpid(), next(_temp_ids), filename))
+
+
+def _link(src_path, dst_path):
+    """Hard link (or copy) src_path to dst_path, replacing dst_path"""
+    tmp_path = _temp_path(dst_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(src_path, tmp_path)
+    os.rename(tmp_path, dst_path)
+    if os.path.lexists(tmp_path):
+        # Renaming does nothing if both are links of the same file, e.g. when
+        # the cached image is stored again
+        os.unlink(tmp_path)
+
+
+def _rename(variants, temporary, mode=None):
+    """Rename converted temporary variants into place of variants
+
+    Permission bits are set to mode first if given. Temporary files are
+    removed if any of them cannot be renamed.
+    """
+    try:
+        for variant, temporary_variant in zip(variants, temporary):
+            if mode is not None:
+                os.chmod(temporary_variant['path'], mode)
+            os.rename(temporary_variant['path'], variant['path'])
+    except Exception:
+        _discard(temporary)
+        raise
+
+
+def _discard(temporary):
+    """Remove temporary files of variants, e.g. after failed conversions"""
+    for variant in temporary:
+        delete(variant['path'])
+
+
+def read(blob):
+    """Return the contents of blob, either a string or a file object"""
+    if isinstance(blob, basestring):
+        return blob
+    blob.seek(0)
+    return blob.read()
+
+
+def _fileno(blob):
+    """Return the file descriptor of blob rewound or None if it has none"""
+    if isinstance(blob, basestring):
+        return None
+    try:
+        fileno = blob.fileno()
+    except (AttributeError, IOError, ValueError):
+        # E.g. a StringIO, io.BytesIO raises io.UnsupportedOperation
+        return None
+    blob.seek(0)
+    return fileno
+
+
+def digest(blob):
+    """Return SHA-1 of blob, either a string or a file object"""
+    if isinstance(blob, basestring):
+        return hashlib.sha1(blob).hexdigest()
+    digest = hashlib.sha1()
+    blob.seek(0)
+    for chunk in iter(lambda: blob.read(65536), ''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write(blob, path, mode=None):
+    """Write blob, either a string or a file object, to path
+
+    The file is written to a temporary path and renamed (see _temp_path),
+    its permission bits are set to mode before if given.
+    """
+    tmp_path = _temp_path(path)
+    try:
+        image = open(tmp_path, 'wb')
+        try:
+            if isinstance(blob, basestring):
+                image.write(blob)
+            else:
+                blob.seek(0)
+                shutil.copyfileobj(blob, image)
+        finally:
+            image.close()
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        delete(tmp_path)
+        raise
+
+
+def _count_probe(key):
+    """Increase a number of probe_stats"""
+    with _probe_lock:
+        probe_stats[key] += 1
+
+
+def _probe_jpeg(image):
+    """Return width and height from the frame header of a JPEG file
+
+    Extraneous bytes between segments are skipped up to the next marker, as
+    decoders do.
+    """
+    image.seek(2)
+    while True:
+        byte = image.read(1)
+        if not byte:
+            raise InvalidImageError("Missing JPEG frame header")
+        if byte != '\xff':
+            continue
+        code = ord(image.read(1) or '\0')
+        while code == 0xff:
+            # Fill bytes
+            code = ord(image.read(1) or '\0')
+
+        if code == 0x00:
+            # Stuffed 0xff or the end of the file
+            continue
+        if code == 0x01 or 0xd0 <= code <= 0xd7:
+            # Markers without a segment
+            continue
+        if code in (0xd8, 0xd9, 0xda):
+            raise InvalidImageError("Missing JPEG frame header")
+
+        (length,) = struct.unpack('>H', image.read(2))
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            (height, width) = struct.unpack('>xHH', image.read(5))
+            return (width, height)
+        image.seek(length - 2, os.SEEK_CUR)
+
+
+def probe(blob):
+    """Return (format, width, height) from the header of the image blob, None
+    if the format is not known
+
+    JPEG, PNG, GIF and WebP (except animated) headers are parsed, format is
+    jpeg, png, gif or webp. Raises InvalidImageError if the image is empty or
+    the header of a known format is broken. The blob is either a string or a
+    file object.
+    """
+    if isinstance(blob, basestring):
+        image = cStringIO.StringIO(blob)
+    else:
+        image = blob
+        image.seek(0)
+
+    try:
+        header = image.read(30)
+        if not header:
+            raise InvalidImageError("Empty image")
+
+        if header.startswith('\x89PNG\r\n\x1a\n'):
+            if header[12:16] != 'IHDR':
+                raise InvalidImageError("Missing PNG header")
+            (fmt, (width, height)) = ('png', struct.unpack('>II',
+                                                           header[16:24]))
+        elif header[:6] in ('GIF87a', 'GIF89a'):
+            (fmt, (width, height)) = ('gif', struct.unpack('<HH',
+                                                           header[6:10]))
+        elif header[:4] == 'RIFF' and header[8:12] == 'WEBP':
+            fmt = 'webp'
+            if header[12:16] == 'VP8 ':
+                if header[23:26] != '\x9d\x01\x2a':
+                    raise InvalidImageError("Broken WebP header")
+                (width, height) = struct.unpack('<HH', header[26:30])
+                (width, height) = (width & 0x3fff, height & 0x3fff)
+            elif header[12:16] == 'VP8L':
+                if header[20] != '\x2f':
+                    raise InvalidImageError("Broken WebP header")
+                (bits,) = struct.unpack('<I', header[21:25])
+                (width, height) = ((bits & 0x3fff) + 1,
+                                   ((bits >> 14) & 0x3fff) + 1)
+            elif header[12:16] == 'VP8X' and not ord(header[20]) & 0x02:
+                width = struct.unpack('<I', header[24:27] + '\0')[0] + 1
+                height = struct.unpack('<I', header[27:30] + '\0')[0] + 1
+            else:
+                # Animated
+                return None
+        elif header[:2] == '\xff\xd8':
+            fmt = 'jpeg'
+            (width, height) = _probe_jpeg(image)
+        else:
+            return None
+    except (struct.error, IndexError):
+        _count_probe('probed')
+        _count_probe('rejected')
+        raise InvalidImageError("Truncated header")
+    except InvalidImageError:
+        _count_probe('probed')
+        _count_probe('rejected')
+        raise
+
+    _count_probe('probed')
+    if not width or not height:
+        # E.g. a JPEG with the height defined later
+        return None
+    return (fmt, width, height)
+
+
+def _header(blob):
+    """Probe blob for _unchanged, None if the image is broken"""
+    try:
+        return probe(blob)
+    except InvalidImageError:
+        return None
+
+
+def _unchanged(header, variant):
+    """Check if converting the probed image (see probe) to the variant would
+    only encode the same pixels again
+
+    That is if no composite or crop is requested, the output format (fmt or
+    the extension of path) is the one of the image and it is not larger than
+    the dimension, which is only shrunk to.
+    """
+    if not header or variant.get('composite') or variant.get('crop'):
+        return False
+
+    (fmt, width, height) = header
+    output = (variant.get('fmt') or
+              os.path.splitext(variant['path'])[1][1:]).lower()
+    if _probe_formats.get(output, output) != fmt:
+        return False
+
+    dimension = variant.get('dimension')
+    return not dimension or (width <= dimension[0] and
+                             height <= dimension[1])
+
+
+def engine_version(engine, convert='/usr/bin/convert'):
+    """Return the version of the conversion engine, e.g. for ResultCache"""
+    if engine == 'pillow':
+        return pillow_io.version()
+
+    process = subprocess.Popen([convert, '-version'], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, close_fds=True)
+    stdout = process.communicate()[0]
+    return stdout.split('\n')[0].strip()
+
+
+def _is_animated(output_path, fmt):
+    """Check if output can hold all frames of the input (is a gif)"""
+    return os.path.splitext(output_path)[1] == '.gif' or fmt == 'gif'
+
+
 def _append_frame(input_path, output_path, fmt):
     """Append frame selection to input if output is not a gif"""
-    if os.path.splitext(output_path)[1] != '.gif' and fmt != 'gif':
+    if not _is_animated(output_path, fmt):
         # First frame only
         return input_path + "[0]"
     else:
         return input_path
 
 
+def _output_magick(output_path, fmt):
+    """Format output path with an optional explicit format"""
+    if fmt:
+        return "%s:%s" % (fmt, output_path)
+    else:
+        return output_path
+
+
+def _decode_hint(dimensions):
+    """Return convert arguments letting the JPEG decoder shrink the input
+
+    With -define jpeg:size=WxH libjpeg scales the image down by up to 8
+    while decoding (DCT scaling), keeping both its width and height at least
+    W and H. These are twice the largest width and height of dimensions, so
+    resizing still samples from twice the resolution of the result. Crop
+    fills the dimension, which needs both sides of the input at least as
+    large, so the factor of two is also its margin. No hint is given if an
+    image is not resized.
+    """
+    if not dimensions or not all(dimensions):
+        return []
+    return ["-define", "jpeg:size=%dx%d" % (
+        2 * max([dimension[0] for dimension in dimensions]),
+        2 * max([dimension[1] for dimension in dimensions]))]
+
+
 def _resize_magick(convert, input_path, output_path, dimension=None, fmt=None):
     """Assemble convert command
 
     This command resizes the input but keeps the original aspect ratio.
     """
     input_path = _append_frame(input_path, output_path, fmt)
-    cmd = [convert, input_path]
+    cmd = [convert] + _decode_hint([dimension]) + [input_path]
     if dimension:
         cmd.append("-resize")
         cmd.append("%dx%d>" % (dimension[0], dimension[1]))
-    if fmt:
-        cmd.append("%s:%s" % (fmt, output_path))
-    else:
-        cmd.append(output_path)
+    cmd.append(_output_magick(output_path, fmt))
     return cmd
 
 
@@ -55,13 +649,11 @@ def _composite_magick(convert, input_path, output_path, dimension, fmt=None):
     input_path = _append_frame(input_path, output_path, fmt)
     cmd = [convert, "-size",
            ("%dx%d" % (dimension[0], dimension[1])),
-           "xc:none", "null:", input_path, "-resize",
+           "xc:none", "null:"] + _decode_hint([dimension]) + [
+           input_path, "-resize",
            ("%dx%d>" % (dimension[0], dimension[1])),
            "-gravity", "center", "-layers", "composite"]
-    if fmt:
-        cmd.append("%s:%s" % (fmt, output_path))
-    else:
-        cmd.append(output_path)
+    cmd.append(_output_magick(output_path, fmt))
     return cmd
 
 
@@ -72,25 +664,215 @@ def _crop_magick(convert, input_path, output_path, dimension, fmt=None):
     aspect ratio.
     """
     input_path = _append_frame(input_path, output_path, fmt)
-    cmd = [convert, input_path, "-resize",
+    cmd = [convert] + _decode_hint([dimension]) + [
+           input_path, "-resize",
            ("%dx%d^" % (dimension[0], dimension[1])),
            "-gravity", "center", "-crop",
            ("%dx%d+0+0!" % (dimension[0], dimension[1])),
            "+repage"]
-    if fmt:
-        cmd.append("%s:%s" % (fmt, output_path))
-    else:
-        cmd.append(output_path)
+    cmd.append(_output_magick(output_path, fmt))
     return cmd
 
 
-def _imagemagick_convert(blob, magick, env):
-    """Execute imagemagick's convert with the specified parameters"""
+def transform_magick(variant):
+    """Return convert arguments transforming a clone of the input to the
+    variant, see _multi_magick"""
+    dimension = variant.get('dimension')
+    if variant.get('composite'):
+        # Move a transparent canvas and a null: separator in front of the
+        # clone to mirror _composite_magick
+        return ["-resize", "%dx%d>" % (dimension[0], dimension[1]),
+                "-size", "%dx%d" % (dimension[0], dimension[1]),
+                "xc:none", "-insert", "0", "null:", "-insert", "1",
+                "-gravity", "center", "-layers", "composite"]
+    elif variant.get('crop'):
+        return ["-resize", "%dx%d^" % (dimension[0], dimension[1]),
+                "-gravity", "center", "-crop",
+                "%dx%d+0+0!" % (dimension[0], dimension[1]), "+repage"]
+    elif dimension:
+        return ["-resize", "%dx%d>" % (dimension[0], dimension[1])]
+    return []
+
+
+def _cascade(variants):
+    """Plan variants as a cascade, each one resized from a larger one
+
+    Returns copies of variants ordered from the largest one, with source set
+    to the index of the variant to resize from instead of the input where
+    the result is indistinguishable. That is where the source is a plain
+    resize to at least twice the width and height of the variant, so it
+    keeps at least twice the resolution of the result. Cropped variants are
+    never cascaded as filling the size could enlarge a source of a different
+    aspect ratio, nor are variants of animated images (in which case convert
+    keeps all frames of the input).
+    """
+    if any([_is_animated(variant['path'], variant.get('fmt')) for
+            variant in variants]):
+        return variants
+
+    variants = sorted([dict(variant) for variant in variants],
+                      key=lambda variant: variant.get('dimension') and
+                      -variant['dimension'][0] * variant['dimension'][1] or 0)
+    sources = []
+    for index, variant in enumerate(variants):
+        dimension = variant.get('dimension')
+        if not dimension or variant.get('crop'):
+            continue
+
+        # The nearest larger one
+        for i in reversed(sources):
+            if (variants[i]['dimension'][0] >= 2 * dimension[0] and
+                    variants[i]['dimension'][1] >= 2 * dimension[1]):
+                variant['source'] = i
+                break
+
+        if not variant.get('composite'):
+            sources.append(index)
+    return variants
+
+
+def _split(planned, parallel):
+    """Split planned variants (see _cascade) into at most parallel groups,
+    each one converted by a call of its own
+
+    Variants stay in the group of their source, so cascades are not split.
+    Groups are balanced by the number of pixels of their variants (variants
+    without dimension count as the largest ones). Sources are numbered
+    within each group.
+    """
+    # Index of the first variant of every cascade -> indices of the cascade
+    cascades = collections.OrderedDict()
+    roots = {}
+    for i, variant in enumerate(planned):
+        if variant.get('source') is None:
+            roots[i] = i
+        else:
+            roots[i] = roots[variant['source']]
+        cascades.setdefault(roots[i], []).append(i)
+
+    def pixels(i):
+        dimension = planned[i].get('dimension')
+        return dimension and dimension[0] * dimension[1] or sys.maxint
+
+    groups = [[] for i in xrange(max(min(parallel, len(cascades)), 1))]
+    loads = [0] * len(groups)
+    for cascade in sorted(cascades.values(), key=lambda cascade: -sum(
+            [pixels(i) for i in cascade])):
+        lightest = loads.index(min(loads))
+        groups[lightest].extend(cascade)
+        loads[lightest] += sum([pixels(i) for i in cascade])
+
+    result = []
+    for group in groups:
+        group.sort()
+        positions = dict([(i, position) for
+                          position, i in enumerate(group)])
+        variants = []
+        for i in group:
+            variant = dict(planned[i])
+            if variant.get('source') is not None:
+                variant['source'] = positions[variant['source']]
+            variants.append(variant)
+        result.append(variants)
+    return result
+
+
+def _run_parallel(functions):
+    """Call functions at once, all but the first one in threads of their own
+
+    Once all of them returned the first exception raised is raised again.
+    """
+    errors = []
+
+    def call(f):
+        try:
+            f()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    started = [threading.Thread(target=call, args=(f,)) for
+               f in functions[1:]]
+    for thread in started:
+        thread.start()
+    call(functions[0])
+    for thread in started:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def _multi_magick(convert, input_path, variants):
+    """Assemble convert command
+
+    This command decodes the input once and writes all of the variants, each
+    one transformed in parentheses from a clone of the decoded input. Variants
+    are dictionaries with path, fmt, dimension, composite and crop keys (see
+    store).
+
+    Variants with source (see _cascade) are transformed from a clone of the
+    source variant instead, which is kept on the image list after writing it.
+    """
+    animated = [_is_animated(variant['path'], variant.get('fmt'))
+                for variant in variants]
+    if not any(animated):
+        # None of the variants needs more than the first frame
+        input_path += "[0]"
+
+    sources = set([variant.get('source') for variant in variants])
+    # Index of a variant -> index of its image on the list
+    kept = {}
+    cmd = ([convert, "-respect-parentheses"] +
+           _decode_hint([variant.get('dimension') for variant in variants]) +
+           [input_path])
+    for i, (variant, all_frames) in enumerate(zip(variants, animated)):
+        cmd.append("(")
+        cmd.append("-clone")
+        if variant.get('source') is not None:
+            cmd.append(str(kept[variant['source']]))
+        else:
+            cmd.append(all_frames and "0--1" or "0")
+        if 'magick' in variant:
+            # Compiled already, see presets
+            cmd.extend(variant['magick'])
+        else:
+            cmd.extend(transform_magick(variant))
+        cmd.append("-write")
+        cmd.append(_output_magick(variant['path'], variant.get('fmt')))
+        if i in sources:
+            kept[i] = len(kept) + 1
+        else:
+            cmd.append("-delete")
+            cmd.append("0--1")
+        cmd.append(")")
+    # The decoded input is still on the list, discard it
+    cmd.append("null:")
+    return cmd
+
+
+def _imagemagick_convert(blob, magick, env, pool=None):
+    """Execute imagemagick's convert with the specified parameters
+
+    If a pool of workers (see imagepipe.workers) is given convert is executed
+    by one of its workers instead of a process forked from this one. A blob
+    given as a file with a descriptor is passed to convert as its stdin.
+    """
     log.msg(" ".join(magick))
-    process = subprocess.Popen(magick, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               close_fds=True, env=env)
-    stderr = process.communicate(blob)[1]
+    if pool:
+        pool.convert(read(blob), magick, env)
+        return
+    fileno = _fileno(blob)
+    if fileno is not None:
+        process = subprocess.Popen(magick, stdin=fileno,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True,
+                                   env=env)
+        stderr = process.communicate()[1]
+    else:
+        process = subprocess.Popen(magick, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True,
+                                   env=env)
+        stderr = process.communicate(read(blob))[1]
     if process.returncode != 0:
         if stderr:
             message = unidecode.unidecode(stderr).strip()
@@ -99,18 +881,116 @@ def _imagemagick_convert(blob, magick, env):
             raise ImageMagickError()
 
 
+class _ConvertProtocol(protocol.ProcessProtocol):
+    """Feeds the image blob to convert and collects its error output"""
+
+    def __init__(self, blob, finished):
+        self.blob = blob
+        self.finished = finished
+        self.stderr = []
+
+    def connectionMade(self):
+        """Write the blob to stdin in chunks as the pipe accepts them"""
+        if isinstance(self.blob, basestring):
+            blob = cStringIO.StringIO(self.blob)
+        else:
+            blob = self.blob
+            blob.seek(0)
+        sent = basic.FileSender().beginFileTransfer(blob, self.transport)
+        sent.addBoth(lambda result: self.transport.closeStdin())
+
+    def errReceived(self, data):
+        """Collect error output"""
+        self.stderr.append(data)
+
+    def processEnded(self, reason):
+        """Fire finished, with ImageMagickError if convert failed"""
+        if reason.check(error.ProcessDone):
+            self.finished.callback(None)
+            return
+
+        stderr = ''.join(self.stderr)
+        if stderr:
+            message = unidecode.unidecode(stderr).strip()
+            self.finished.errback(ImageMagickError(message))
+        else:
+            self.finished.errback(ImageMagickError())
+
+
+def _imagemagick_spawn(blob, magick, env):
+    """Execute imagemagick's convert with the specified parameters from the
+    reactor
+
+    Unlike _imagemagick_convert this does not block a thread, it returns a
+    Deferred firing once convert exits and failing the same way.
+    """
+    # Not imported by the module so workers and tools do not install the
+    # default reactor
+    from twisted.internet import reactor
+    log.msg(" ".join(magick))
+    finished = defer.Deferred()
+    reactor.spawnProcess(_ConvertProtocol(blob, finished), magick[0], magick,
+                         env=dict(env or {}))
+    return finished
+
+
+def _pillow_convert(blob, variants, pool=None):
+    """Write the variants using the in-process Pillow engine
+
+    If a pool of workers is given the conversion is executed in one of its
+    workers.
+    """
+    log.msg("pillow " + " ".join([variant['path'] for variant in variants]))
+    if pool:
+        pool.pillow(read(blob), variants)
+    else:
+        pillow_io.convert(blob, variants)
+
+
+@contextlib.contextmanager
+def _converting(operation, mode):
+    """Record the duration of a conversion and count it as in flight"""
+    with metrics.converts_in_flight.track():
+        with metrics.stage_seconds.time(operation, mode, 'convert'):
+            yield
+
+
 def normalize_path(path, starts_with=None):
     """Collapses redundant separators and up-level references
 
-    The starts_with argument can be provided to check if a path is relative to
-    a given prefix. If it is not None is returned.
+    The starts_with argument can be provided to check if a path is the given
+    directory or one within it. If it is not None is returned.
     """
     path = os.path.normpath(path)
-    if starts_with and not path.startswith(starts_with):
-        return None
+    if starts_with:
+        starts_with = os.path.normpath(starts_with)
+        if path != starts_with and not path.startswith(
+                starts_with.rstrip(os.sep) + os.sep):
+            return None
     return path
 
 
+def suffixed_path(path, suffix, fmt=None):
+    """Return path with suffix added to the file name and the extension
+    replaced according to fmt if given
+
+        suffixed_path('x/image.jpg', '_small', 'png') == 'x/image_small.png'
+    """
+    (dirs, filename) = os.path.split(path)
+    parts = filename.split('.')
+    if len(parts) == 1:
+        suffixed = dirs + '/' + filename + suffix
+        if fmt:
+            suffixed += '.' + fmt
+    else:
+        suffixed = dirs + '/' + '.'.join(parts[:-1]) + suffix + '.'
+        if fmt:
+            suffixed += fmt
+        else:
+            suffixed += parts[-1]
+    return suffixed
+
+
 def create_dirs(path):
     """Create the directory given by path with all intermediate ones"""
     if path and not os.path.isdir(path):
@@ -118,13 +998,37 @@ def create_dirs(path):
 
 
 def store(blob, path, fmt=None, dimension=None, composite=None, crop=None,
-          umask=None, convert='/usr/bin/convert', env=None):
+          umask=None, convert='/usr/bin/convert', env=None, pool=None,
+          engine='convert', cache=None, mode=None, index=None, shards=None,
+          header=None):
     """Store the image on disk
 
     This pipes the image blob through one of the available imagemagick's
     convert calls depending on the requested transformations or writes it
-    directly if no transformations were requested.
+    directly if no transformations were requested. If engine is 'pillow'
+    the transformations are done in-process (see pillow_io) instead. The blob
+    is either a string or a file object, e.g. a spooled upload.
+
+    Images already matching the transformation are written directly too,
+    see _unchanged. header is the result of probe if the blob was probed
+    before, () if nothing is known about it, so it is not probed again.
+    Transformed images are taken from and added to cache, a
+    ResultCache, if one is given. Permission bits of the image are set to
+    mode if given. The stored image is recorded in index, a TreeIndex, if
+    given. The image is written to a temporary file renamed to path once
+    complete, see _temp_path. With shards, a Shards instance, the image is
+    written to its location and linked from path, see Shards.link.
+
+    Durations of the conversion and of writing the image are recorded in
+    metrics.stage_seconds.
     """
+    if shards:
+        previous = [shards.resolve(path)]
+        store(blob, shards.locate(path), fmt, dimension, composite, crop,
+              umask, convert, env, pool, engine, cache, mode, header=header)
+        _link_shards([path], shards, umask, index, previous)
+        return
+
     if umask != None:
         previous_umask = os.umask(umask)
     else:
@@ -133,35 +1037,436 @@ def store(blob, path, fmt=None, dimension=None, composite=None, crop=None,
     try:
         create_dirs(os.path.dirname(path))
 
-        if composite:
-            _imagemagick_convert(
-                blob, _composite_magick(convert, '-', path, dimension, fmt),
-                env)
-        elif crop:
-            _imagemagick_convert(
-                blob, _crop_magick(convert, '-', path, dimension, fmt), env)
-        elif fmt or dimension:
-            _imagemagick_convert(
-                blob, _resize_magick(convert, '-', path, dimension, fmt), env)
-        else:
-            image = open(path, 'wb')
-            image.write(blob)
-            image.close()
+        variant = {'path': path, 'fmt': fmt, 'dimension': dimension,
+                   'composite': composite, 'crop': crop}
+        if header is None and (fmt or dimension):
+            header = _header(blob)
+        if (fmt or dimension) and _unchanged(header, variant):
+            _count_probe('skipped')
+            (fmt, dimension) = (None, None)
+        mode_label = metrics.mode([variant])
+
+        key = None
+        if cache and (fmt or dimension):
+            key = cache.key(digest(blob),
+                            {'fmt': fmt, 'dimension': dimension,
+                             'composite': composite, 'crop': crop})
+            if cache.fetch(key, path, mode):
+                if index:
+                    index.update(path)
+                return
+
+        temporary = [dict(variant, path=_temp_path(path))]
+        tmp_path = temporary[0]['path']
+        try:
+            if not fmt and not dimension:
+                with metrics.stage_seconds.time('store', mode_label,
+                                                'write'):
+                    _write(blob, path, mode)
+                temporary = []
+            elif engine == 'pillow':
+                with _converting('store', mode_label):
+                    _pillow_convert(blob, temporary, pool)
+            elif composite:
+                with _converting('store', mode_label):
+                    _imagemagick_convert(
+                        blob, _composite_magick(convert, '-', tmp_path,
+                                                dimension, fmt), env, pool)
+            elif crop:
+                with _converting('store', mode_label):
+                    _imagemagick_convert(
+                        blob, _crop_magick(convert, '-', tmp_path, dimension,
+                                           fmt), env, pool)
+            else:
+                with _converting('store', mode_label):
+                    _imagemagick_convert(
+                        blob, _resize_magick(convert, '-', tmp_path,
+                                             dimension, fmt), env, pool)
+        except Exception:
+            _discard(temporary)
+            raise
+        if pool and mode is None and umask != None:
+            # Workers inherit the umask of the service rather than the given
+            # one
+            mode = 0666 & ~umask
+        _rename([variant], temporary, mode)
+
+        if key:
+            cache.add(key, path)
+
+        if index:
+            index.update(path)
+    finally:
+        if previous_umask:
+            os.umask(previous_umask)
+
+
+def _located(variants, shards):
+    """Return copies of variants with paths replaced by their locations,
+    see Shards.locate"""
+    return [dict(variant, path=shards.locate(variant['path'])) for
+            variant in variants]
+
+
+def _link_shards(paths, shards, umask=None, index=None, previous=None):
+    """Link files stored at their locations from paths, see Shards.link,
+    and record them in index, a TreeIndex, if given
+
+    previous lists the files paths resolved to before storing, see
+    Shards.resolve.
+    """
+    if umask != None:
+        previous_umask = os.umask(umask)
+    else:
+        previous_umask = None
+
+    try:
+        for i, path in enumerate(paths):
+            shards.link(path, previous and previous[i])
+            if index:
+                index.update(path)
+    finally:
+        if previous_umask:
+            os.umask(previous_umask)
+
+
+def _prepare_multi(blob, variants, umask=None, cache=None, cascade=False,
+                   header=None):
+    """Create directories, take variants from cache and write ones without
+    transformations or already matching them (see _unchanged), the blob is
+    probed unless header is given (see store)
+
+    Returns the list of variants left to convert and the list of their cache
+    keys (empty without cache).
+    """
+    if umask != None:
+        previous_umask = os.umask(umask)
+    else:
+        previous_umask = None
+
+    try:
+        converted = []
+        keys = []
+        blob_digest = cache and digest(blob)
+        for variant in variants:
+            create_dirs(os.path.dirname(variant['path']))
+
+            transformed = (variant.get('fmt') or variant.get('dimension') or
+                           variant.get('composite') or variant.get('crop'))
+            if transformed and not variant.get('composite') and not (
+                    variant.get('crop')):
+                if header is None:
+                    header = _header(blob) or ()
+                if _unchanged(header, variant):
+                    _count_probe('skipped')
+                    transformed = False
+
+            if transformed:
+                if cache:
+                    key = cache.key(blob_digest, variant, cascade)
+                    if cache.fetch(key, variant['path']):
+                        continue
+                    keys.append(key)
+                converted.append(variant)
+            else:
+                _write(blob, variant['path'])
+        return (converted, keys)
+    finally:
+        if previous_umask:
+            os.umask(previous_umask)
+
+
+def _finish_multi(variants, converted, temporary, keys, cache=None,
+                  index=None, mode=None):
+    """Rename converted variants into place, add them to cache and all of
+    them to index
+
+    Variants are converted to temporary ones (see _temp_path), permission
+    bits of those are set to mode if given.
+    """
+    _rename(converted, temporary, mode)
+
+    for key, variant in zip(keys, converted):
+        cache.add(key, variant['path'])
+
+    if index:
+        for variant in variants:
+            index.update(variant['path'])
+
+
+def store_multi(blob, variants, umask=None, convert='/usr/bin/convert',
+                env=None, pool=None, engine='convert', cache=None,
+                index=None, cascade=False, parallel=1, shards=None,
+                header=None):
+    """Store multiple variants of the image on disk
+
+    Variants are dictionaries with path, fmt, dimension, composite and crop
+    keys, the same as the arguments of store. All variants requiring
+    transformations are written by a single convert call (or Pillow
+    conversion) which decodes the image blob only once. The remaining ones
+    are written directly.
+
+    Variants found in cache, a ResultCache, are not converted again. Stored
+    variants are recorded in index, a TreeIndex, if given. With cascade
+    smaller variants are resized from larger ones, see _cascade. Converted
+    variants are written to temporary files renamed into place once all of
+    them are complete, see _temp_path.
+
+    With parallel above 1 variants are split into up to that many groups
+    (see _split) converted at once by calls of their own, each decoding the
+    image. If any of them fails none of the variants are renamed into place.
+    With shards, a Shards instance, variants are stored at their locations,
+    see store. header saves probing the blob again, see store.
+
+    Durations of preparing (including variants written directly),
+    converting and finishing are recorded in metrics.stage_seconds.
+    """
+    if shards:
+        paths = [variant['path'] for variant in variants]
+        previous = [shards.resolve(path) for path in paths]
+        store_multi(blob, _located(variants, shards), umask, convert, env,
+                    pool, engine, cache, cascade=cascade, parallel=parallel,
+                    header=header)
+        _link_shards(paths, shards, umask, index, previous)
+        return
+
+    if umask != None:
+        previous_umask = os.umask(umask)
+    else:
+        previous_umask = None
+
+    mode_label = metrics.mode(variants)
+    try:
+        with metrics.stage_seconds.time('store_multi', mode_label,
+                                        'prepare'):
+            (converted, keys) = _prepare_multi(blob, variants, cache=cache,
+                                               cascade=cascade, header=header)
+        temporary = [dict(variant, path=_temp_path(variant['path'])) for
+                     variant in converted]
+        groups = _split(cascade and _cascade(temporary) or temporary,
+                        parallel)
+        if len(groups) > 1:
+            # Calls must not share the position of a file
+            blob = read(blob)
+
+        try:
+            if converted and engine == 'pillow':
+                with _converting('store_multi', mode_label):
+                    _run_parallel([
+                        functools.partial(_pillow_convert, blob, group, pool)
+                        for group in groups])
+            elif converted:
+                with _converting('store_multi', mode_label):
+                    _run_parallel([functools.partial(
+                        _imagemagick_convert, blob,
+                        _multi_magick(convert, '-', group), env, pool) for
+                        group in groups])
+        except Exception:
+            _discard(temporary)
+            raise
+
+        # Workers inherit the umask of the service rather than the given one
+        mode = None
+        if pool and umask != None:
+            mode = 0666 & ~umask
+        with metrics.stage_seconds.time('store_multi', mode_label, 'finish'):
+            _finish_multi(variants, converted, temporary, keys, cache, index,
+                          mode)
+    finally:
+        if previous_umask:
+            os.umask(previous_umask)
+
+
+@defer.inlineCallbacks
+def store_multi_async(blob, variants, umask=None, convert='/usr/bin/convert',
+                      env=None, cache=None, index=None, cascade=False,
+                      parallel=1, shards=None, header=None):
+    """Store multiple variants of the image on disk, see store_multi
+
+    Convert is spawned from the reactor (see _imagemagick_spawn) instead of
+    blocking a thread, only directories, cache and index are handled in
+    threads. Returns a Deferred.
+    """
+    if shards:
+        paths = [variant['path'] for variant in variants]
+        previous = yield threads.deferToThread(
+            lambda: [shards.resolve(path) for path in paths])
+        yield store_multi_async(blob, _located(variants, shards), umask,
+                                convert, env, cache, cascade=cascade,
+                                parallel=parallel, header=header)
+        yield threads.deferToThread(_link_shards, paths, shards, umask,
+                                    index, previous)
+        return
+
+    mode_label = metrics.mode(variants)
+    with metrics.stage_seconds.time('store_multi', mode_label, 'prepare'):
+        (converted, keys) = yield threads.deferToThread(
+            _prepare_multi, blob, variants, umask, cache, cascade, header)
+
+    temporary = [dict(variant, path=_temp_path(variant['path'])) for
+                 variant in converted]
+    if converted:
+        groups = _split(cascade and _cascade(temporary) or temporary,
+                        parallel)
+        if len(groups) > 1:
+            # Calls must not share the position of a file
+            blob = yield threads.deferToThread(read, blob)
+        try:
+            with _converting('store_multi', mode_label):
+                results = yield defer.DeferredList([
+                    _imagemagick_spawn(blob, _multi_magick(convert, '-',
+                                                           group), env) for
+                    group in groups], consumeErrors=True)
+            for success, result in results:
+                if not success:
+                    result.raiseException()
+        except Exception:
+            yield threads.deferToThread(_discard, temporary)
+            raise
+
+    # Convert inherits the umask of the service rather than the given one
+    mode = None
+    if umask != None:
+        mode = 0666 & ~umask
+    with metrics.stage_seconds.time('store_multi', mode_label, 'finish'):
+        yield threads.deferToThread(_finish_multi, variants, converted,
+                                    temporary, keys, cache, index, mode)
+
+
+def lazy_paths(path):
+    """Return paths of the original and manifest of a lazily stored variant
+    at path, see store_lazy"""
+    (dirname, name) = os.path.split(path)
+    return (os.path.join(dirname, '.%s.original' % (name,)),
+            os.path.join(dirname, '.%s.variant' % (name,)))
+
+
+def _variant_name(name):
+    """Return the name of the variant of a lazily stored variant's original
+    or manifest (see lazy_paths), other names unchanged"""
+    if name.startswith('.') and name.endswith(('.original', '.variant')):
+        return name[1:].rsplit('.', 1)[0]
+    return name
+
+
+def store_lazy(blob, variants, umask=None, index=None, shards=None):
+    """Store the image for variants to be rendered on demand, see load_lazy
+
+    Next to the path of every variant this writes a hidden hard link of the
+    image blob (.NAME.original) and a manifest (.NAME.variant) with the
+    transformation. The blob is written only once and a variant is removed
+    together with its links, so the image is kept while any of its variants
+    is. Previously rendered variants are deleted. Returns the list of written
+    paths. With shards, a Shards instance, files are stored at the locations
+    of their variants, see store.
+    """
+    if shards:
+        paths = []
+        for variant in variants:
+            delete(variant['path'], index, shards=shards)
+            paths.extend(lazy_paths(variant['path']))
+        store_lazy(blob, _located(variants, shards), umask)
+        _link_shards(paths, shards, umask, index)
+        return paths
+
+    if umask != None:
+        previous_umask = os.umask(umask)
+    else:
+        previous_umask = None
+
+    try:
+        paths = []
+        for variant in variants:
+            create_dirs(os.path.dirname(variant['path']))
+            (original_path, manifest_path) = lazy_paths(variant['path'])
+
+            if paths:
+                _link(paths[0], original_path)
+            else:
+                _write(blob, original_path)
+
+            _write(json.dumps({'fmt': variant.get('fmt'),
+                               'dimension': variant.get('dimension'),
+                               'composite': variant.get('composite'),
+                               'crop': variant.get('crop')}), manifest_path)
+
+            delete(variant['path'], index)
+            paths.extend([original_path, manifest_path])
+
+        if index:
+            for path in paths:
+                index.update(path)
+        return paths
     finally:
         if previous_umask:
             os.umask(previous_umask)
 
 
-def delete(path):
-    """Delete image from disk"""
+def load_lazy(path):
+    """Return the original path and variant of a lazily stored image, see
+    store_lazy, or None if there is no manifest for path"""
+    (original_path, manifest_path) = lazy_paths(path)
+    try:
+        manifest = open(manifest_path, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+    try:
+        variant = json.load(manifest)
+    finally:
+        manifest.close()
+    # Keep cache keys equal to the ones of variants stored right away
+    return (original_path, {'path': path,
+                            'fmt': variant['fmt'] and str(variant['fmt']),
+                            'dimension': variant['dimension'],
+                            'composite': variant['composite'],
+                            'crop': variant['crop']})
+
+
+def load(path):
+    """Return contents and permission bits of a stored image"""
+    image = open(path, 'rb')
     try:
-        os.unlink(path)
-    except OSError:
-        pass
+        return (image.read(), stat.S_IMODE(os.fstat(image.fileno()).st_mode))
+    finally:
+        image.close()
+
 
+def delete(path, index=None, lazy=False, shards=None):
+    """Delete image from disk and index, a TreeIndex, if given
 
-def move(src_path, dst_path, umask=None):
-    """Move image from source to destination"""
+    With lazy the original and manifest of a lazily stored variant are
+    deleted as well, see store_lazy. With shards, a Shards instance, the
+    file linked from path is deleted too.
+    """
+    paths = [path]
+    if lazy:
+        paths.extend(lazy_paths(path))
+
+    for path in paths:
+        if shards and shards.resolve(path) != path:
+            delete(shards.resolve(path))
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+        if index:
+            index.remove(path)
+
+
+def move(src_path, dst_path, umask=None, index=None, lazy=False,
+         shards=None):
+    """Move image from source to destination, updating index, a TreeIndex,
+    if given
+
+    With lazy the original and manifest of a lazily stored variant are moved
+    as well, see store_lazy. A variant not rendered yet replaces a rendered
+    one at the destination. With shards, a Shards instance, files are moved
+    to their locations, see Shards.move.
+    """
     if umask != None:
         previous_umask = os.umask(umask)
     else:
@@ -169,7 +1474,175 @@ def move(src_path, dst_path, umask=None):
 
     try:
         create_dirs(os.path.dirname(dst_path))
+        paths = [(src_path, dst_path)]
+        if lazy and os.path.exists(lazy_paths(src_path)[1]):
+            paths = zip(lazy_paths(src_path), lazy_paths(dst_path))
+            if os.path.exists(src_path):
+                paths.append((src_path, dst_path))
+            else:
+                # Not rendered yet
+                delete(dst_path, index, shards=shards)
+
+        for src_path, dst_path in paths:
+            _move_file(src_path, dst_path, shards)
+
+            if index:
+                index.remove(src_path)
+                index.update(dst_path)
+    finally:
+        if previous_umask:
+            os.umask(previous_umask)
+
+
+def _move_file(src_path, dst_path, shards=None):
+    """Move the file at src_path to dst_path, see Shards.move for shards"""
+    if shards:
+        shards.move(src_path, dst_path)
+    else:
         shutil.move(src_path, dst_path)
+
+
+def _prefixed(path, suffixes=()):
+    """Return names of the files of the image at path and its variants with
+    suffixes in its directory, see delete_prefix"""
+    (dirname, name) = os.path.split(path)
+    stem = os.path.splitext(name)[0]
+    if not stem:
+        return []
+    stems = set([stem + suffix for suffix in [''] + list(suffixes)])
+    try:
+        entries = os.listdir(dirname)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+    names = []
+    for entry in entries:
+        if entry.startswith('.tmp.'):
+            continue
+        if (os.path.splitext(_variant_name(entry))[0] in stems and
+                os.path.isfile(os.path.join(dirname, entry))):
+            names.append(entry)
+    return sorted(names)
+
+
+def _move_tree(src_path, dst_path, index=None, shards=None):
+    """Move the files of directory src_path into dst_path one by one,
+    replacing files there, and remove the emptied directories"""
+    for dirpath, dirnames, filenames in os.walk(src_path, topdown=False):
+        dst_dirpath = os.path.normpath(os.path.join(
+            dst_path, os.path.relpath(dirpath, src_path)))
+        create_dirs(dst_dirpath)
+        for filename in filenames:
+            src_file = os.path.join(dirpath, filename)
+            dst_file = os.path.join(dst_dirpath, filename)
+            _move_file(src_file, dst_file, shards)
+            if index:
+                index.remove(src_file)
+                index.update(dst_file)
+        os.rmdir(dirpath)
+
+    if shards:
+        # Directories left on the other roots
+        for location in _locations(src_path, shards)[1:]:
+            for dirpath, dirnames, filenames in os.walk(location,
+                                                        topdown=False):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+
+
+def _locations(path, shards):
+    """Return the paths of the directory path on every root of shards"""
+    relpath = os.path.relpath(path, shards.root)
+    return [os.path.join(root, relpath) for root in shards.roots]
+
+
+def delete_prefix(path, index=None, shards=None, suffixes=()):
+    """Delete the directory path with all of its contents, otherwise the
+    image at path with its variants of the given suffixes, updating index, a
+    TreeIndex, if given
+
+    An image stands for the files in its directory named by its base name
+    without extension, or by that followed by one of suffixes, with any
+    extension, e.g. x/image.jpg with suffixes ['_small'] for x/image.jpg,
+    x/image.png and x/image_small.jpg but not x/image_large.jpg or
+    x/image.2.jpg. Originals and manifests of lazily stored variants are
+    included, see store_lazy. A directory is renamed to a hidden temporary
+    name first, so it disappears at once, with shards, a Shards instance, on
+    every root.
+    """
+    if os.path.isdir(path):
+        tmp_paths = []
+        for location in shards and _locations(path, shards) or [path]:
+            if os.path.isdir(location):
+                tmp_paths.append(_temp_path(location))
+                os.rename(location, tmp_paths[-1])
+        if index:
+            index.remove_tree(path)
+        for tmp_path in tmp_paths:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+    for name in _prefixed(path, suffixes):
+        delete(os.path.join(os.path.dirname(path), name), index,
+               shards=shards)
+
+
+def move_prefix(src_path, dst_path, umask=None, index=None, shards=None,
+                suffixes=()):
+    """Move the directory src_path with all of its contents, otherwise the
+    image at src_path with its variants of the given suffixes (see
+    delete_prefix), to dst_path, updating index, a TreeIndex, if given
+
+    A directory is moved by a single rename unless dst_path exists or is on
+    another file system, its files are moved one by one then and replace
+    files there. The variants of an image are renamed with the base name of
+    dst_path, e.g. from x/image.jpg to y/other.jpg x/image_small.png becomes
+    y/other_small.png. With shards, a Shards instance, files are moved to
+    their locations one by one, see Shards.move.
+    """
+    if umask != None:
+        previous_umask = os.umask(umask)
+    else:
+        previous_umask = None
+
+    try:
+        create_dirs(os.path.dirname(dst_path))
+        if os.path.isdir(src_path) and shards:
+            _move_tree(src_path, dst_path, index, shards)
+            return
+        elif os.path.isdir(src_path):
+            try:
+                os.rename(src_path, dst_path)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EEXIST,
+                                   errno.ENOTEMPTY):
+                    raise
+                _move_tree(src_path, dst_path, index)
+            else:
+                if index:
+                    index.move_tree(src_path, dst_path)
+            return
+
+        (src_dirname, src_name) = os.path.split(src_path)
+        (dst_dirname, dst_name) = os.path.split(dst_path)
+        src_stem = os.path.splitext(src_name)[0]
+        dst_stem = os.path.splitext(dst_name)[0]
+        for name in _prefixed(src_path, suffixes):
+            if _variant_name(name) == name:
+                renamed = dst_stem + name[len(src_stem):]
+            else:
+                # Lazily stored variant, .NAME.original or .NAME.variant
+                renamed = '.' + dst_stem + name[len(src_stem) + 1:]
+            src_file = os.path.join(src_dirname, name)
+            dst_file = os.path.join(dst_dirname, renamed)
+            _move_file(src_file, dst_file, shards)
+            if index:
+                index.remove(src_file)
+                index.update(dst_file)
     finally:
         if previous_umask:
             os.umask(previous_umask)
@@ -3,19 +3,35 @@
 """Twisted XML-RPC service implementation"""
 
 import base64
+import collections
+import heapq
+import itertools
 import json
 import os
+import shutil
 import signal
+import socket
+import sys
+import tempfile
+import time
 import traceback
 import uuid
 
 from twisted.application import service
-from twisted.internet import defer, reactor, threads
-from twisted.web import server, xmlrpc
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.python import failure, log
+from twisted.web import http, resource, server, static, xmlrpc
 import txzmq
+import zmq
 
 from imagepipe import config
 from imagepipe import image_io
+from imagepipe import index
+from imagepipe import metrics
+from imagepipe import pillow_io
+from imagepipe import presets
+from imagepipe import replication
+from imagepipe import workers
 
 
 class Error(Exception):
@@ -33,23 +49,416 @@ class ServerError(Error):
     pass
 
 
+class BusyError(Error):
+    """Indicates a full conversion queue"""
+    pass
+
+
+def _blob_size(blob):
+    """Return the length of an image blob, a string or a file object"""
+    if isinstance(blob, basestring):
+        return len(blob)
+
+    position = blob.tell()
+    blob.seek(0, os.SEEK_END)
+    size = blob.tell()
+    blob.seek(position)
+    return size
+
+
+def _partition(items, count, keys):
+    """Split indices of items into at most count chunks of about the same
+    size, each one in the order of items
+
+    Items sharing any of their keys (keys(item) returns a list of paths
+    relative to images.path) end up in one chunk, keys are compared
+    normalized (see _partition_key) and ones which are not strings are
+    ignored.
+    """
+    parent = {}
+
+    def find(key):
+        while parent.setdefault(key, key) != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    item_keys = [[_partition_key(key) for key in keys(item) if
+                  isinstance(key, basestring)] for item in items]
+    for paths in item_keys:
+        for key in paths[1:]:
+            parent[find(key)] = find(paths[0])
+
+    groups = collections.OrderedDict()
+    for i, paths in enumerate(item_keys):
+        groups.setdefault(paths and find(paths[0]) or (None, i),
+                          []).append(i)
+
+    chunks = [[] for i in xrange(max(min(count, len(groups)), 1))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(chunks, key=len).extend(group)
+    for chunk in chunks:
+        chunk.sort()
+    return chunks
+
+
+def _partition_key(path):
+    """Return path normalized the way paths of images are, so all spellings
+    of one image are equal"""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return os.path.normpath('/' + path.lstrip('/'))
+
+
+def _covers(prefix, path):
+    """Tell if a prefix operation on the normalized prefix (see
+    image_io.delete_prefix) may affect the normalized path, erring on the
+    side of yes"""
+    return path.startswith(os.path.splitext(prefix)[0])
+
+
+def _message_paths(message):
+    """Return the paths a replication message stores, deletes or moves (the
+    prefixes of prefix operations), normalized like _partition_key"""
+    (method, args) = (message['method'], message['args'])
+    try:
+        if method in ('store_image', 'store_image_preset'):
+            paths = [args[1]]
+        elif method == 'store_images':
+            paths = [spec['path'] for spec in args[0]]
+        elif method == 'store_files':
+            paths = [item[0] for item in args[0]]
+        elif method in ('delete_image', 'delete_prefix'):
+            paths = args[:1]
+        elif method in ('move_image', 'move_prefix'):
+            paths = args[:2]
+        else:
+            return []
+    except (IndexError, KeyError, TypeError):
+        return []
+
+    result = []
+    for path in paths:
+        result.extend(isinstance(path, list) and path or [path])
+    return [_partition_key(path) for path in result if
+            isinstance(path, basestring)]
+
+
+def _statuses(results):
+    """Return the status of every result of a batch, OK or the fault message
+    for Failures"""
+    return [isinstance(result, failure.Failure) and _error_message(result) or
+            'OK' for result in results]
+
+
+def _keywords(message):
+    """Return keyword arguments of a replication message, see
+    XMLRPCServer._replication_publish"""
+    return dict([(str(key), value) for key, value in
+                 (message.get('kwargs') or {}).items()])
+
+
+def _decode_image(image):
+    """Return data of an image encoded in base64 or received raw in a binary
+    replication message (see replication.Blob)"""
+    if isinstance(image, replication.Blob):
+        return image
+
+    try:
+        return base64.decodestring(image)
+    except Exception:
+        raise ClientError('Invalid image encoding, should be base64')
+
+
+def _error_message(failure):
+    """Translate exceptions to error messages prefixed with fault codes"""
+    print failure
+
+    if failure.type == TypeError:
+        return '[1000] Invalid parameters'
+    elif failure.type == ClientError:
+        return '[1000] ' + failure.getErrorMessage()
+    elif failure.type == ServerError:
+        return '[1001] ' + failure.getErrorMessage()
+    elif failure.type == BusyError:
+        return '[1003] ' + failure.getErrorMessage()
+    else:
+        return '[1002] Internal error'
+
+
+class Scheduler(object):
+    """Admission queue of conversions
+
+    At most slots conversions run at once, the other ones wait in the queue
+    ordered by priority (LOCAL before REPLICATION) and arrival. Conversions
+    of local requests are refused with BusyError once max_depth ones are
+    waiting or the images of the waiting and running ones take more than
+    max_bytes, replicated ones are always admitted as they cannot be retried.
+
+    Time spent waiting in the queue is recorded per priority in wait_count,
+    wait_total and wait_max (seconds).
+    """
+    LOCAL = 0
+    REPLICATION = 1
+
+    def __init__(self, slots, max_depth, max_bytes):
+        self.slots = slots
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.running = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.wait_count = [0, 0]
+        self.wait_total = [0.0, 0.0]
+        self.wait_max = [0.0, 0.0]
+        self._queue = []
+        self._order = itertools.count()
+
+    def configure(self, slots, max_depth, max_bytes):
+        """Change the limits, e.g. after reloading configuration"""
+        self.slots = slots
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self._dispatch()
+
+    @property
+    def depth(self):
+        """Number of waiting conversions"""
+        return len(self._queue)
+
+    def run(self, size, priority, f, *args, **kwargs):
+        """Call f(*args, **kwargs) once admitted and a slot is free, size is
+        the length of the image in bytes
+
+        The slot is held until the Deferred returned by f (e.g.
+        threads.deferToThread) fires. Returns a Deferred firing with its
+        result.
+        """
+        if (priority == self.LOCAL and
+                (len(self._queue) >= self.max_depth or
+                 (self.bytes and self.bytes + size > self.max_bytes))):
+            self.rejected += 1
+            return defer.fail(BusyError("Server busy, try again later"))
+
+        d = defer.Deferred()
+        self.bytes += size
+        heapq.heappush(self._queue, (priority, next(self._order), time.time(),
+                                     size, d, f, args, kwargs))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        """Start waiting conversions while there are free slots"""
+        while self._queue and self.running < self.slots:
+            (priority, order, queued, size, d, f, args,
+             kwargs) = heapq.heappop(self._queue)
+
+            wait = time.time() - queued
+            self.wait_count[priority] += 1
+            self.wait_total[priority] += wait
+            self.wait_max[priority] = max(self.wait_max[priority], wait)
+
+            self.running += 1
+            result = defer.maybeDeferred(f, *args, **kwargs)
+            result.addBoth(self._finished, size)
+            result.chainDeferred(d)
+
+    def _finished(self, result, size):
+        """Free the slot of a finished conversion"""
+        self.running -= 1
+        self.bytes -= size
+        self._dispatch()
+        return result
+
+    def stats(self):
+        """Return a summary of the queue state and wait times"""
+        summary = ['queued %d, running %d, %d bytes, %d rejected' % (
+            len(self._queue), self.running, self.bytes, self.rejected)]
+        for priority, name in ((self.LOCAL, 'local'),
+                               (self.REPLICATION, 'replication')):
+            summary.append('%s wait avg %.3f s, max %.3f s' % (
+                name, self.wait_total[priority] /
+                max(self.wait_count[priority], 1), self.wait_max[priority]))
+        return ', '.join(summary)
+
+
+class _SubConnection(txzmq.ZmqSubConnection):
+    """Subscription that stops reading messages while paused
+
+    Messages published meanwhile are buffered by ZeroMQ up to its high water
+    mark and dropped after that.
+    """
+
+    paused = False
+
+    def pauseProducing(self):
+        """Stop reading messages"""
+        self.paused = True
+
+    def resumeProducing(self):
+        """Read the messages waiting and continue reading new ones"""
+        if self.paused:
+            self.paused = False
+            # ZeroMQ only signals messages arriving later
+            reactor.callLater(0, self.doRead)
+
+    def doRead(self):
+        """Read messages until none are waiting or the connection is
+        paused, see txzmq.ZmqConnection.doRead"""
+        if self.read_scheduled is not None:
+            if not self.read_scheduled.called:
+                self.read_scheduled.cancel()
+            self.read_scheduled = None
+
+        while not self.paused and self.factory is not None:
+            events = self.socket.get(zmq.EVENTS)
+            if events & zmq.POLLIN != zmq.POLLIN:
+                return
+            try:
+                message = self._readMultipart()
+            except zmq.ZMQError as e:
+                if e.errno == zmq.EAGAIN:
+                    continue
+                raise
+            log.callWithLogger(self, self.messageReceived, message)
+
+
+class _ServerWorkerProtocol(protocol.ProcessProtocol):
+    """Logs output of a server worker and reports its exit"""
+
+    def __init__(self, workers, number):
+        self.workers = workers
+        self.number = number
+        self._buffer = ''
+
+    def outReceived(self, data):
+        """Log complete lines of output"""
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            log.msg('worker %d: %s' % (self.number, line))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        """Notify ServerWorkers"""
+        if self._buffer:
+            log.msg('worker %d: %s' % (self.number, self._buffer))
+        self.workers._ended(self.number, reason)
+
+
+class ServerWorkers(object):
+    """Server processes sharing one listening socket
+
+    Each of count workers runs main() of this module, an ImageService
+    accepting connections on the inherited socket (file descriptor 3) and
+    relaying replication messages to relay, a zeromq endpoint of the
+    service. Workers are numbered from 1 (the service being 0) and exiting
+    ones are started again.
+    """
+
+    def __init__(self, conf_path, count, port, interface, relay):
+        self.conf_path = conf_path
+        self.relay = relay
+        self._processes = {}
+        self._stopped = None
+
+        family = ':' in interface and socket.AF_INET6 or socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((interface, port))
+        self._socket.listen(1024)
+        self._socket.setblocking(False)
+
+        for number in xrange(1, count + 1):
+            self._spawn(number)
+
+    def _spawn(self, number):
+        """Start a worker"""
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            filter(None, [env.get('PYTHONPATH')]))
+        self._processes[number] = reactor.spawnProcess(
+            _ServerWorkerProtocol(self, number), sys.executable,
+            [sys.executable, '-u', '-m', 'imagepipe.image_service',
+             self.conf_path, self.relay, str(number)], env=env,
+            childFDs={0: 'w', 1: 'r', 2: 'r', 3: self._socket.fileno()})
+
+    def _ended(self, number, reason):
+        """Start the worker again unless stopping"""
+        del self._processes[number]
+        if self._stopped:
+            if not self._processes:
+                self._socket.close()
+                self._stopped.callback(None)
+            return
+
+        log.msg('worker %d exited: %s' % (number, reason.getErrorMessage()))
+        reactor.callLater(1, self._spawn, number)
+
+    def signal(self, signame):
+        """Send a signal (e.g. 'HUP') to all workers"""
+        for process in self._processes.values():
+            process.signalProcess(signame)
+
+    def stop(self):
+        """Stop all workers, returns a Deferred firing once they exit"""
+        self._stopped = defer.Deferred()
+        if not self._processes:
+            self._socket.close()
+            self._stopped.callback(None)
+        self.signal('TERM')
+        return self._stopped
+
+
 class ImageService(service.Service):
-    """Initializer for the XMLRPC server and zeromq-based replication"""
+    """Initializer for the XMLRPC server and zeromq-based replication
+
+    With network.workers above 1 the XMLRPC server runs in that many worker
+    processes (see ServerWorkers) while this service only applies and
+    publishes replication messages. Workers are ImageService instances given
+    the relay endpoint; instead of replicating themselves they send messages
+    to publish there.
+    """
 
-    def __init__(self, conf_path):
+    def __init__(self, conf_path, relay=None, number=0):
         self._conf_path = conf_path
+        self._relay = relay
+        self._number = number
         self._settings = None
         self._xmlrpc_port = None
         self._xmlrpc_server = None
         self._zmq_factory = None
         self._pub_connection = None
         self._sub_connection = None
-        self._replication_id = None
+        self._rep_connection = None
+        self._replay_connections = []
+        self._replication = None
+        self._pool = None
+        self._cache = None
+        self._index = None
+        self._shards = None
+        self._shards_lock = None
+        self._scheduler = None
+        self._relay_connection = None
+        self._relay_dir = None
+        self._workers = None
+        self._presets = None
 
     def _init_settings(self):
         """Load configuration"""
         settings = config.read(self._conf_path)
         config.check(settings)
+        if (settings['imagemagick']['engine'] == 'pillow' and
+                not pillow_io.Image):
+            raise config.ValidationError("The pillow engine requires Pillow")
+        if settings['imagemagick']['async'] and (
+                settings['imagemagick']['engine'] != 'convert' or
+                settings['imagemagick']['pool']):
+            raise config.ValidationError("Async requires the convert engine "
+                                         "without pool")
+        self._presets = presets.compile(settings)
         self._settings = settings  # Set after validation
         reactor.suggestThreadPoolSize(self._settings['images']['io_threads'])
 
@@ -58,33 +467,282 @@ class ImageService(service.Service):
 
         This creates a local (pub) and remote (sub) zeromq sockets and
         generates an unique identifier to distinguish replication messages sent
-        by different publisher.
+        by different publisher. The sub socket connects to every endpoint
+        given in the subscribe setting.
+
+        The rep socket serves messages lost by other instances (from the
+        journal) and the image tree to synchronize with (see _serve), a req
+        socket is created for every peer to request own lost messages from.
+
+        Server workers only connect a push socket to the relay endpoint,
+        the service binds a pull one if there are workers.
         """
         self._zmq_factory = txzmq.ZmqFactory()
 
+        if self._relay:
+            self._relay_connection = txzmq.ZmqPushConnection(
+                self._zmq_factory, txzmq.ZmqEndpoint('connect', self._relay))
+            self._replication = replication.Sequencer()
+            return
+
+        if self._relay_dir:
+            shutil.rmtree(self._relay_dir, True)
+            self._relay_dir = None
+        if self._settings['network']['workers'] > 1:
+            self._relay_dir = tempfile.mkdtemp(prefix='imagepipe-')
+            self._relay_connection = txzmq.ZmqPullConnection(
+                self._zmq_factory, txzmq.ZmqEndpoint(
+                    'bind', 'ipc://' + os.path.join(self._relay_dir,
+                                                    'relay')))
+            self._relay_connection.onPull = (
+                lambda parts: self._xmlrpc_server._replication_relayed(parts))
+
         if self._settings['replication']['publish']:
             pub_endpoint = txzmq.ZmqEndpoint(
                 'bind', self._settings['replication']['publish'])
             self._pub_connection = txzmq.ZmqPubConnection(self._zmq_factory,
                                                           pub_endpoint)
         if self._settings['replication']['subscribe']:
-            sub_endpoint = txzmq.ZmqEndpoint(
-                'connect', self._settings['replication']['subscribe'])
-            self._sub_connection = txzmq.ZmqSubConnection(self._zmq_factory,
-                                                          sub_endpoint)
-        if not self._replication_id:
-            self._replication_id = uuid.uuid4()
+            sub_endpoints = [txzmq.ZmqEndpoint('connect', address) for
+                             address in
+                             self._settings['replication']['subscribe']]
+            self._sub_connection = _SubConnection(self._zmq_factory,
+                                                  sub_endpoints[0])
+            self._sub_connection.addEndpoints(sub_endpoints[1:])
+        if not self._replication:
+            journal = None
+            if self._settings['replication']['journal']:
+                journal = replication.Journal(
+                    self._settings['replication']['journal'],
+                    self._settings['replication']['journal_size'] * 1048576,
+                    self._settings['replication']['journal_age'])
+            self._replication = replication.Sequencer(journal=journal)
+        if self._settings['replication']['replay']:
+            rep_endpoint = txzmq.ZmqEndpoint(
+                'bind', self._settings['replication']['replay'])
+            self._rep_connection = txzmq.ZmqREPConnection(self._zmq_factory,
+                                                          rep_endpoint)
+            self._rep_connection.gotMessage = self._serve
+        self._replay_connections = [
+            txzmq.ZmqREQConnection(self._zmq_factory,
+                                   txzmq.ZmqEndpoint('connect', address)) for
+            address in self._settings['replication']['replay_peers']]
+
+    @defer.inlineCallbacks
+    def _serve(self, message_id, request):
+        """Reply to a request of another instance
+
+        Requests are JSON encoded dictionaries with one of the following
+        methods, replies consist of 'OK' (or 'ERROR') and the listed parts:
+
+        {'method': 'replay', 'id': publisher id, 'first': sequence number,
+         'last': sequence number or null} -- up to 100 messages from the
+        journal as they were sent on the wire (binary ones joined)
+
+        {'method': 'tree', 'paths': list of directories} -- JSON encoded
+        dictionary of entries of every directory, see TreeIndex.entries
+
+        {'method': 'files', 'paths': list of images} -- JSON encoded list of
+        permission bits of every image (null if it does not exist) followed
+        by contents of the existing ones
+        """
+        try:
+            request = json.loads(request)
+            if request['method'] == 'replay':
+                parts = yield threads.deferToThread(self._read_journal,
+                                                    request)
+            elif request['method'] == 'tree':
+                parts = yield threads.deferToThread(self._read_tree,
+                                                    request['paths'])
+            elif request['method'] == 'files':
+                parts = yield threads.deferToThread(self._read_files,
+                                                    request['paths'])
+            else:
+                raise ValueError(request['method'])
+        except Exception:
+            traceback.print_exc()
+            self._rep_connection.reply(message_id, 'ERROR')
+        else:
+            self._rep_connection.reply(message_id, 'OK', *parts)
+
+    def _read_journal(self, request):
+        """Return messages requested by replay"""
+        if not self._replication.journal:
+            return []
+
+        last = request['last']
+        if last is not None:
+            last = int(last)
+        return self._replication.journal.replay(
+            uuid.UUID(hex=request['id']), int(request['first']), last, 100)
+
+    def _normalize_paths(self, paths):
+        """Return absolute paths under images.path or raise ValueError"""
+        root = self._settings['images']['path']
+        normalized_paths = []
+        for path in paths:
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            normalized_path = image_io.normalize_path(root + '/' + path, root)
+            if not normalized_path:
+                raise ValueError(path)
+            normalized_paths.append(normalized_path)
+        return normalized_paths
+
+    def _read_tree(self, paths):
+        """Return parts of the reply to tree"""
+        if not self._index:
+            raise ValueError("Index is not enabled")
+
+        entries = {}
+        for path, normalized_path in zip(paths,
+                                         self._normalize_paths(paths)):
+            entries[path] = self._index.entries(
+                self._index.relpath(normalized_path))
+        return [json.dumps(entries)]
+
+    def _read_files(self, paths):
+        """Return parts of the reply to files"""
+        modes = []
+        images = []
+        for normalized_path in self._normalize_paths(paths):
+            try:
+                (data, mode) = image_io.load(normalized_path)
+            except IOError:
+                modes.append(None)
+            else:
+                modes.append(mode)
+                images.append(data)
+        return [json.dumps(modes)] + images
+
+    def _pool_settings(self):
+        """Return settings affecting the worker pool"""
+        return (self._settings['images']['io_threads'],
+                self._settings['imagemagick']['pool'],
+                self._settings['imagemagick']['pool_max_jobs'],
+                self._settings['imagemagick']['pool_max_rss'])
+
+    def _init_pool(self):
+        """Start convert workers if enabled, replacing the running ones"""
+        if self._pool:
+            self._pool.shutdown()
+            self._pool = None
+
+        if self._settings['imagemagick']['pool']:
+            self._pool = workers.WorkerPool(
+                self._settings['images']['io_threads'],
+                self._settings['imagemagick']['pool_max_jobs'],
+                self._settings['imagemagick']['pool_max_rss'])
+
+    def _cache_settings(self):
+        """Return settings affecting the result cache"""
+        return (self._settings['cache']['path'],
+                self._settings['cache']['size'],
+                self._settings['network']['workers'],
+                self._settings['imagemagick']['engine'],
+                self._settings['imagemagick']['convert'])
+
+    def _init_cache(self):
+        """Open the result cache if enabled
+
+        With server workers every process has a cache of its own, the
+        service's at cache.path and the ones of workers in worker.NUMBER
+        subdirectories, sharing cache.size equally.
+        """
+        self._cache = None
+
+        path = self._settings['cache']['path']
+        if not path:
+            return
+
+        size = self._settings['cache']['size'] * 1024 * 1024
+        workers = self._settings['network']['workers']
+        if workers > 1:
+            size /= workers + 1
+            if self._number:
+                path = os.path.join(path, 'worker.%d' % (self._number,))
+        self._cache = image_io.ResultCache(
+            path, size, image_io.engine_version(
+                self._settings['imagemagick']['engine'],
+                self._settings['imagemagick']['convert']))
+
+    def _clean_cache(self):
+        """Remove caches of server workers which are not running"""
+        path = self._settings['cache']['path']
+        if not path or not os.path.isdir(path):
+            return
+
+        workers = self._settings['network']['workers']
+        for filename in os.listdir(path):
+            (prefix, dot, number) = filename.partition('.')
+            if (prefix == 'worker' and number.isdigit() and
+                    (workers <= 1 or int(number) > workers)):
+                shutil.rmtree(os.path.join(path, filename), True)
+
+    def _init_scheduler(self):
+        """Set up the conversion queue or update its limits"""
+        slots = self._settings['images']['io_threads']
+        if self._settings['imagemagick']['async']:
+            slots = self._settings['imagemagick']['max_converts']
+        max_depth = self._settings['images']['queue_depth']
+        max_bytes = self._settings['images']['queue_memory'] * 1024 * 1024
+        if self._scheduler:
+            self._scheduler.configure(slots, max_depth, max_bytes)
+        else:
+            self._scheduler = Scheduler(slots, max_depth, max_bytes)
+
+    def _init_index(self):
+        """Open the tree index if enabled"""
+        if self._settings['images']['index']:
+            self._index = index.TreeIndex(self._settings['images']['index'],
+                                          self._settings['images']['path'])
+
+    def _init_shards(self):
+        """Set up placement of images on images.roots if given, locked
+        against rebalancing while running"""
+        if self._settings['images']['roots']:
+            self._shards = image_io.Shards(
+                [self._settings['images']['path']] +
+                self._settings['images']['roots'])
+            self._shards_lock = self._shards.lock()
 
     def _init_server(self):
-        """Set up server socket"""
+        """Set up server socket, server workers sharing one or the inherited
+        one of a worker"""
         self._xmlrpc_server = XMLRPCServer(
             self._settings, self._pub_connection, self._sub_connection,
-            self._replication_id)
+            self._replication, self._scheduler, self._pool, self._cache,
+            self._replay_connections, self._index, self._presets,
+            self._shards)
+        site = server.Site(RootResource(self._xmlrpc_server))
+
+        if self._relay:
+            self._xmlrpc_server.relay_connection = self._relay_connection
+            family = (':' in self._settings['network']['interface'] and
+                      socket.AF_INET6 or socket.AF_INET)
+            self._xmlrpc_port = reactor.adoptStreamPort(3, family, site)
+        elif self._settings['network']['workers'] > 1:
+            self._clean_cache()
+            self._workers = ServerWorkers(
+                self._conf_path, self._settings['network']['workers'],
+                self._settings['network']['port'],
+                self._settings['network']['interface'],
+                self._relay_connection.endpoints[0].address)
+        else:
+            self._clean_cache()
+            self._xmlrpc_port = reactor.listenTCP(
+                self._settings['network']['port'], site,
+                interface=self._settings['network']['interface'])
 
-        self._xmlrpc_port = reactor.listenTCP(
-            self._settings['network']['port'],
-            server.Site(self._xmlrpc_server),
-            interface=self._settings['network']['interface'])
+    @defer.inlineCallbacks
+    def _stop_server(self):
+        """Stop listening or stop server workers"""
+        if self._xmlrpc_port:
+            yield self._xmlrpc_port.stopListening()
+            self._xmlrpc_port = None
+        if self._workers:
+            yield self._workers.stop()
+            self._workers = None
 
     @defer.inlineCallbacks
     def _signal(self, signum, frame):
@@ -94,8 +752,13 @@ class ImageService(service.Service):
 
             port = self._settings['network']['port']
             interface = self._settings['network']['interface']
+            workers = self._settings['network']['workers']
             publish = self._settings['replication']['publish']
             subscribe = self._settings['replication']['subscribe']
+            replay = self._settings['replication']['replay']
+            replay_peers = self._settings['replication']['replay_peers']
+            pool = self._pool_settings()
+            cache = self._cache_settings()
 
             try:
                 self._init_settings()
@@ -104,15 +767,45 @@ class ImageService(service.Service):
                 return
 
             self._xmlrpc_server.settings = self._settings
+            self._xmlrpc_server.presets = self._presets
+
+            print 'Queue: %s' % (self._scheduler.stats(),)
+            print ('Probe: %(probed)d image(s) probed, %(skipped)d '
+                   'conversion(s) skipped, %(rejected)d image(s) rejected' %
+                   image_io.probe_stats)
+            self._init_scheduler()
+
+            if self._pool_settings() != pool:
+                self._init_pool()
+                self._xmlrpc_server.pool = self._pool
+
+            if self._cache:
+                print 'Cache: %d hit(s), %d miss(es), %d bytes' % (
+                    self._cache.hits, self._cache.misses, self._cache.size)
+
+            if self._cache_settings() != cache:
+                self._init_cache()
+                self._xmlrpc_server.cache = self._cache
+
+            if self._relay:
+                # The listening socket and replication belong to the service
+                return
 
             reload_server = False
             if (self._settings['network']['port'] != port or
-                    self._settings['network']['interface'] != interface):
+                    self._settings['network']['interface'] != interface or
+                    self._settings['network']['workers'] != workers):
                 reload_server = True
+            elif self._workers:
+                self._workers.signal('HUP')
 
             reload_replication = False
-            if (self._settings['replication']['publish'] != publish or
-                    self._settings['replication']['subscribe'] != subscribe):
+            if (self._settings['network']['workers'] != workers or
+                    self._settings['replication']['publish'] != publish or
+                    self._settings['replication']['subscribe'] != subscribe or
+                    self._settings['replication']['replay'] != replay or
+                    self._settings['replication']['replay_peers'] !=
+                    replay_peers):
                 reload_replication = True
 
             if reload_replication:
@@ -127,24 +820,45 @@ class ImageService(service.Service):
                 if not reload_server:
                     self._xmlrpc_server.pub_connection = self._pub_connection
                     self._xmlrpc_server.sub_connection = self._sub_connection
+                    self._xmlrpc_server.replay_connections = (
+                        self._replay_connections)
                     return
 
             if reload_server:
-                yield self._xmlrpc_port.stopListening()
+                yield self._stop_server()
                 self._init_server()
 
     def startService(self):
         """Set up service"""
         signal.signal(signal.SIGHUP, self._signal)
         self._init_settings()
+        self._init_scheduler()
+        self._init_index()
+        self._init_shards()
         self._init_replication()
+        self._init_pool()
+        self._init_cache()
         self._init_server()
+        self._xmlrpc_server._replication_recover()
         service.Service.startService(self)
 
+    @defer.inlineCallbacks
     def stopService(self):
         """Tear down service"""
+        yield self._stop_server()
         self._xmlrpc_server.pub_connection = None
+        self._xmlrpc_server.relay_connection = None
         self._zmq_factory.shutdown()
+        if self._relay_dir:
+            shutil.rmtree(self._relay_dir, True)
+        if self._replication.journal:
+            self._replication.journal.close()
+        if self._index:
+            self._index.close()
+        if self._shards_lock != None:
+            os.close(self._shards_lock)
+        if self._pool:
+            self._pool.shutdown()
         service.Service.stopService(self)
 
 
@@ -152,86 +866,423 @@ class XMLRPCServer(xmlrpc.XMLRPC):
     """XMLRPC server for handling image manipulation calls"""
 
     def __init__(self, settings, pub_connection, sub_connection,
-                 replication_id):
+                 replication, scheduler, pool=None, cache=None,
+                 replay_connections=None, index=None, presets=None,
+                 shards=None):
         self.settings = settings
         self.pub_connection = pub_connection
         self.sub_connection = sub_connection
-        self._replication_id = replication_id
+        self.pool = pool
+        self.cache = cache
+        self.replay_connections = replay_connections or []
+        self.index = index
+        self.shards = shards
+        self.scheduler = scheduler
+        self.presets = presets or {}
+        self.relay_connection = None
+        self._replication = replication
+        self._replication_id = replication.id
+        # Publisher id -> received messages waiting for lost ones
+        self._replication_replaying = {}
+        # Path -> Deferreds waiting for the variant being rendered
+        self._rendering = {}
+        # Normalized path -> stores of images there and other operations on
+        # it, the running one first
+        self._storing = {}
+        # Normalized path -> Deferred of the last request for it, fired once
+        # it is in _storing
+        self._arriving = {}
+        # (Prefix, Deferred fired once done) of prefix operations
+        self._prefixes = []
+        # Received messages being handled and their length in bytes
+        self._replication_pending = 0
+        self._replication_bytes = 0
 
         if self.sub_connection:
             self.sub_connection.subscribe('')
-            self.sub_connection.gotMessage = self._replication_process
+            self.sub_connection.messageReceived = self._replication_received
 
         xmlrpc.XMLRPC.__init__(self)
 
+    def render_POST(self, request):
+        """Handle XMLRPC call, the time until the method is called is its
+        parse stage (see metrics.Timer)"""
+        request.timer = metrics.Timer('xmlrpc')
+        return xmlrpc.XMLRPC.render_POST(self, request)
+
     def _ebRender(self, failure):
         """Translate exceptions to XMLRPC faults"""
         if isinstance(failure.value, xmlrpc.Fault):
             return failure.value
 
-        print failure
+        return xmlrpc.Fault(self.FAILURE, _error_message(failure))
+
+    def _encode_image(self, data):
+        """Return image data as an argument of replication messages, raw for
+        binary ones or encoded in base64"""
+        if self.settings['replication']['wire'] == 'binary':
+            return replication.Blob(data)
+        return base64.encodestring(data)
+
+    def _load_files(self, paths):
+        """Return stored images as arguments of store_files"""
+        root = self.settings['images']['path']
+        files = []
+        for path in paths:
+            (data, mode) = image_io.load(path)
+            files.append([os.path.relpath(path, root),
+                          self._encode_image(data), mode])
+        return files
 
-        if failure.type == TypeError:
-            message = '[1000] Invalid parameters'
-        elif failure.type == ClientError:
-            message = '[1000] ' + failure.getErrorMessage()
-        elif failure.type == ServerError:
-            message = '[1001] ' + failure.getErrorMessage()
+    @defer.inlineCallbacks
+    def _replication_publish_store(self, blob, paths, args, image=None,
+                                   method='store_image', cascade=1):
+        """Send replication message for a stored image
+
+        In the command replication mode the message contains the original
+        image (blob, or image already encoded in base64 for JSON messages if
+        it is given) and args of method,
+        store_image or store_image_preset, so subscribers convert the image
+        again. The cascade argument of store_image is sent as a keyword
+        argument unless it is the default, so older subscribers accept the
+        message. In the result mode it contains the created images (paths)
+        for store_files.
+
+        Lazily stored images (see images.lazy) are not converted, so the
+        command is sent in both modes. Nothing is sent for requests superseded
+        by later ones (paths is None, see _coalesce), which send their images
+        themselves.
+        """
+        if ((not self.pub_connection and not self.relay_connection) or
+                paths is None):
+            return
+
+        if (self.settings['replication']['mode'] == 'result' and
+                not self.settings['images']['lazy']):
+            files = yield threads.deferToThread(self._load_files, paths)
+            self._replication_publish(self._replication_id, 'store_files',
+                                      files)
         else:
-            message = '[1002] Internal error'
+            if (image is None or
+                    self.settings['replication']['wire'] == 'binary'):
+                image = yield threads.deferToThread(
+                    lambda: self._encode_image(image_io.read(blob)))
+            options = {}
+            if not cascade:
+                options['cascade'] = 0
+            self._replication_publish(self._replication_id, method, image,
+                                      *args, **options)
+
+    @defer.inlineCallbacks
+    def _replication_publish_stores(self, specs, results):
+        """Send a single replication message for images stored by
+        store_images, results are the ones of _store_images
 
-        return xmlrpc.Fault(self.FAILURE, message)
+        See _replication_publish_store, in the command replication mode the
+        message contains specs of the stored images for store_images.
+        """
+        if not self.pub_connection and not self.relay_connection:
+            return
+
+        stored = [(spec, result) for spec, result in zip(specs, results) if
+                  not isinstance(result, failure.Failure) and
+                  result[1] is not None]
+        if not stored:
+            return
 
-    def _replication_publish(self, replication_id, method, *args):
+        if (self.settings['replication']['mode'] == 'result' and
+                not self.settings['images']['lazy']):
+            files = yield threads.deferToThread(self._load_files, [
+                path for spec, (blob, paths) in stored for path in paths])
+            self._replication_publish(self._replication_id, 'store_files',
+                                      files)
+        else:
+            if self.settings['replication']['wire'] == 'binary':
+                images = yield threads.deferToThread(lambda: [
+                    self._encode_image(image_io.read(blob)) for
+                    spec, (blob, paths) in stored])
+            else:
+                images = [spec['image'] for spec, result in stored]
+            self._replication_publish(
+                self._replication_id, 'store_images',
+                [dict(spec, image=image) for
+                 (spec, result), image in zip(stored, images)])
+
+    def _replication_encode(self, message):
+        """Return frames of a replication message, see replication.encode"""
+        if self.settings['replication']['wire'] == 'binary':
+            return replication.encode(message)
+        return [json.dumps(message)]
+
+    def _replication_publish(self, replication_id, method, *args, **kwargs):
         """Send replication message
 
-        Each message contains the publisher's replication id, the RPC method
-        call and method's arguments. The message is JSON encoded on the wire.
+        Each message contains the publisher's replication id, its sequence
+        number, the time it was published, the RPC method call and method's
+        arguments (and keyword arguments if there are any). On the wire the
+        message is either binary, images are sent raw in frames of their own
+        (see replication.encode), or JSON encoded (see replication.wire). It
+        is appended to the journal.
+
+        Server workers send the method and arguments to the relay connection
+        of the service instead, which numbers and publishes them (see
+        _replication_relayed).
+        """
+        message = {'method': method, 'args': args}
+        if kwargs:
+            message['kwargs'] = kwargs
+        if self.relay_connection:
+            self.relay_connection.send(self._replication_encode(message))
+        elif self.pub_connection:
+            seq = self._replication.next_seq()
+            parts = self._replication_encode(dict(message,
+                                                  id=replication_id.hex,
+                                                  seq=seq, time=time.time()))
+            if self._replication.journal:
+                threads.deferToThread(self._replication.journal.append,
+                                      replication_id, seq,
+                                      parts).addErrback(log.err)
+            self._replication_send(parts)
+
+    def _replication_send(self, parts):
+        """Publish frames of a replication message"""
+        if replication.is_binary(parts[0]):
+            self.pub_connection.send(parts)
+        else:
+            self.pub_connection.publish(parts[0])
+
+    def _replication_relayed(self, parts):
+        """Publish replication message relayed by a server worker"""
+        try:
+            message = replication.decode(parts)
+            self._replication_publish(self._replication_id,
+                                      message['method'], *message['args'],
+                                      **_keywords(message))
+        except Exception:
+            traceback.print_exc()
+
+    def _replication_forward(self, parts):
+        """Send received replication message to own subscribers as it is"""
+        if (self.pub_connection and
+                self.settings['replication']['forward']):
+            self._replication_send(parts)
+
+    def _replication_received(self, parts):
+        """Handle frames received by the sub connection
+
+        JSON encoded messages are prefixed with an empty tag, see
+        txzmq.ZmqPubConnection.publish.
         """
-        if self.pub_connection:
-            message = {'id': replication_id.hex,
-                       'method': method,
-                       'args': args}
-            self.pub_connection.publish(json.dumps(message))
+        if not replication.is_binary(parts[0]):
+            parts = [parts[0].split('\0', 1)[-1]]
+        size = sum(len(part) for part in parts)
+        self._replication_pending += 1
+        self._replication_bytes += size
+        if (self._replication_pending >= self.scheduler.max_depth or
+                self._replication_bytes > self.scheduler.max_bytes):
+            self._replication_pause(True)
+        d = self._replication_process(parts)
+        d.addBoth(self._replication_done, size)
+        return d
+
+    def _replication_done(self, result, size):
+        """Account a handled message, resumes the subscription once below
+        the limits of the conversion queue"""
+        self._replication_pending -= 1
+        self._replication_bytes -= size
+        if (self._replication_pending < self.scheduler.max_depth and
+                self._replication_bytes <= self.scheduler.max_bytes):
+            self._replication_pause(False)
+        return result
+
+    def _replication_pause(self, pause):
+        """Pause or resume reading of the sub connection"""
+        if pause and hasattr(self.sub_connection, 'pauseProducing'):
+            self.sub_connection.pauseProducing()
+        elif not pause and hasattr(self.sub_connection, 'resumeProducing'):
+            self.sub_connection.resumeProducing()
+
+    @staticmethod
+    def _replication_parse(parts):
+        """Decode replication message, returns (message, publisher id)"""
+        message = replication.decode(parts)
+        if ('id' not in message or 'method' not in message or
+                'args' not in message):
+            raise ValueError()
+        return (message, uuid.UUID(hex=message['id']))
 
     @defer.inlineCallbacks
-    def _replication_process(self, json_str, tag=''):
-        """Handle received replication message and execute a local _api_*
-        method"""
+    def _replication_process(self, parts):
+        """Handle received replication message (a list of frames) and execute
+        a local _api_* method"""
         try:
-            message = json.loads(json_str)
-            if ('id' not in message or 'method' not in message or
-                    'args' not in message):
-                raise ValueError()
-            replication_id = uuid.UUID(hex=message['id'])
+            (message, replication_id) = self._replication_parse(parts)
         except Exception:
             traceback.print_exc()
-            print "Received bogus message: %s" % (json_str,)
+            print "Received bogus message: %r" % (parts[0][:1024],)
             return
 
-        # Skip own messages
+        # Skip own messages and ones received from another peer already,
+        # messages without a sequence number come from older instances
         if replication_id == self._replication_id:
             return
+        if replication_id in self._replication_replaying:
+            self._replication_replaying[replication_id].append(parts)
+            return
+        if 'seq' in message:
+            if self._replication.seen(replication_id, message['seq']):
+                return
+            gap = self._replication.advance(replication_id, message['seq'])
+            if gap and self.replay_connections:
+                yield self._replication_catch_up(replication_id, gap[0],
+                                                 gap[1], parts)
+                return
+
+        # Clocks of the instances are assumed to be synchronized
+        if 'time' in message:
+            metrics.replication_lag_seconds.observe(
+                max(time.time() - message['time'], 0))
+        yield self._replication_apply(message, replication_id, parts)
+
+    @defer.inlineCallbacks
+    def _replication_apply(self, message, replication_id, parts):
+        """Execute a local _api_* method of a new replication message
 
+        Messages are applied in the order they are received, the ones on a
+        path are queued in that order (see _serialize). A message received
+        after a later one of its publisher on the same paths, e.g. through
+        another peer, is skipped (see replication.Sequencer.superseded).
+        """
         method = getattr(self, '_api_' + message['method'], None)
         if not method:
             print "Received unknown method %s from %s" % (message['method'],
                                                           replication_id,)
+            if 'seq' in message:
+                yield self._replication_applied(replication_id,
+                                                message['seq'])
+            return
+
+        # Forward before applying so instances further down a chain do not
+        # wait for this one
+        self._replication_forward(parts)
+
+        if 'seq' in message and self._replication.superseded(
+                replication_id, message['seq'], _message_paths(message)):
+            print "Skipped superseded %s@%s" % (message['method'],
+                                                replication_id)
+            yield self._replication_applied(replication_id, message['seq'],
+                                            parts=parts)
             return
 
         print '%s@%s' % (message['method'], replication_id)
+        try:
+            yield method(*message['args'], **_keywords(message))
+        finally:
+            # Journal once applied, so a message interrupted by a restart is
+            # requested again (see _replication_recover)
+            if 'seq' in message:
+                yield self._replication_applied(replication_id,
+                                                message['seq'], parts=parts)
+
+    def _replication_applied(self, replication_id, first, last=None,
+                             parts=None):
+        """Record received messages from first to last as applied (or lost)
+        and journal them, parts is the message if only first is given
+
+        Along with the message the publisher's position is journaled once
+        all messages before it are applied, since messages are applied
+        concurrently. Returns a Deferred firing once written.
+        """
+        journal = self._replication.journal
+        if not journal:
+            return defer.succeed(None)
 
-        yield method(*message['args'])
-        self._replication_publish(replication_id, message['method'],
-                                  *message['args'])
+        position = self._replication.applied(replication_id, first, last)
+        if parts is None and position is None:
+            return defer.succeed(None)
+        return threads.deferToThread(journal.append, replication_id, first,
+                                     parts, position)
+
+    @defer.inlineCallbacks
+    def _replication_catch_up(self, replication_id, first, last=None,
+                              parts=None):
+        """Request lost messages of a publisher from replay peers
+
+        Messages with sequence numbers from first to last (until no peer has
+        more of them if None) are requested from each peer in turn and
+        applied in order, followed by the received message (parts) which
+        revealed the loss. Messages of the publisher received in the meantime
+        are processed afterwards.
+        """
+        self._replication_replaying[replication_id] = []
+        replayed_seqs = set()
+        start = first
+        try:
+            for connection in self.replay_connections:
+                while last is None or first <= last:
+                    request = json.dumps({'method': 'replay',
+                                          'id': replication_id.hex,
+                                          'first': first, 'last': last})
+                    try:
+                        reply = yield connection.sendMsg(request, timeout=10)
+                    except Exception:
+                        traceback.print_exc()
+                        break
+                    if reply[0] != 'OK' or len(reply) < 2:
+                        break
+
+                    for replayed in reply[1:]:
+                        (message, message_id) = self._replication_parse(
+                            [replayed])
+                        replayed_seqs.add(message['seq'])
+                        first = max(first, message['seq'] + 1)
+                        self._replication.advance(replication_id,
+                                                  message['seq'])
+                        if not self._replication.seen(replication_id,
+                                                      message['seq']):
+                            try:
+                                yield self._replication_apply(
+                                    message, replication_id, [replayed])
+                            except Exception:
+                                traceback.print_exc()
+
+            # Messages skipped by the replies are not in the journals of the
+            # peers either, do not wait for them to be applied
+            for seq in xrange(start, first):
+                if seq not in replayed_seqs:
+                    self._replication_applied(replication_id, seq)
+            if last is not None and first <= last:
+                print "Lost messages %d-%d from %s" % (
+                    first, last, replication_id)
+                self._replication_applied(replication_id, first, last)
+            if parts:
+                (message, message_id) = self._replication_parse(parts)
+                yield self._replication_apply(message, replication_id, parts)
+        finally:
+            for parts in self._replication_replaying.pop(replication_id):
+                self._replication_process(parts)
+
+    def _replication_recover(self):
+        """Request messages published while this instance was not running
+
+        Every publisher known from the journal is asked for messages from the
+        position all of its messages were applied up to, ones applied after
+        it already are skipped (see replication.Sequencer).
+        """
+        if not self.replay_connections:
+            return
+
+        for replication_id, seq in self._replication.positions.items():
+            self._replication_catch_up(replication_id, seq)
 
     @defer.inlineCallbacks
     def _api_store_image(self, image, path, fmt=None, size=None,
-                         composite=0, crop=0):
+                         composite=0, crop=0, cascade=1):
         """Store image and apply transformations
 
         Arguments:
-        image -- image data, encoded in base64
+        image -- image data, encoded in base64 (or raw, see
+                 replication.Blob)
         path -- destination path, relative to images.path from configuration
         fmt -- format of the destination image, e.g. 'png', 'gif'
         size -- size of the destination image, [width, height]
@@ -240,6 +1291,8 @@ class XMLRPCServer(xmlrpc.XMLRPC):
                      size specification and keep the original aspect ratio
         crop -- set to 1 if destination image should be cropped to conform with
                 the size specification
+        cascade -- set to 0 to resize every image from the original one, see
+                   image_io.store_multi
 
         The below arguments will result in storing a single image resized to
         500x500px.
@@ -265,12 +1318,120 @@ class XMLRPCServer(xmlrpc.XMLRPC):
         A dictionary can also be provided in the place of format, composite and
         crop arguments. The keys must equal the ones from the size dictionary.
         If single values are provided they affect all created images.
+
+        With images.lazy only the image and manifests of the sizes are stored,
+        each size is rendered once requested (see ImageResource).
+
+        Conversions are queued with the replication priority, see Scheduler.
+        Durations of the stages are observed as replicated_store_image.
         """
+        timer = metrics.Timer('replicated_store_image')
         try:
-            blob = base64.decodestring(image)
+            blob = _decode_image(image)
+            timer.lap('decode')
+
+            paths = yield self._store_image(blob, path, fmt, size, composite,
+                                            crop, Scheduler.REPLICATION,
+                                            cascade, timer)
+        finally:
+            timer.observe()
+        defer.returnValue(paths)
+
+    def _store_variants(self, blob, variants, priority, cascade=True,
+                        timer=None, header=None):
+        """Queue conversion of the image to variants, see
+        image_io.store_multi
+
+        With imagemagick.async convert is spawned from the reactor, otherwise
+        the conversion blocks a thread. Either way up to imagemagick.parallel
+        calls convert the variants at once within one slot of the queue. The
+        queue stage of timer, a metrics.Timer, ends once the conversion
+        starts. header is the one returned by _check_image if called.
+        """
+        timer = timer or metrics.Timer(None)
+        if self.settings['imagemagick']['async']:
+            return self.scheduler.run(
+                _blob_size(blob), priority,
+                timer.starting(image_io.store_multi_async),
+                blob=blob, variants=variants,
+                umask=self.settings['images']['umask'],
+                convert=self.settings['imagemagick']['convert'],
+                env=self.settings['imagemagick']['env'], cache=self.cache,
+                index=self.index, cascade=cascade,
+                parallel=self.settings['imagemagick']['parallel'],
+                shards=self.shards, header=header)
+
+        return self.scheduler.run(
+            _blob_size(blob), priority, threads.deferToThread,
+            timer.starting(image_io.store_multi), blob=blob,
+            variants=variants,
+            umask=self.settings['images']['umask'],
+            convert=self.settings['imagemagick']['convert'],
+            env=self.settings['imagemagick']['env'], pool=self.pool,
+            engine=self.settings['imagemagick']['engine'], cache=self.cache,
+            index=self.index, cascade=cascade,
+            parallel=self.settings['imagemagick']['parallel'],
+            shards=self.shards, header=header)
+
+    @defer.inlineCallbacks
+    def _check_image(self, blob):
+        """Reject images with broken headers before queueing them, returns
+        the header for image_io.store (see image_io.probe)"""
+        try:
+            header = yield threads.deferToThread(image_io.probe, blob)
+        except image_io.InvalidImageError as e:
+            raise ClientError("Invalid image (%s)" % (e,))
+        defer.returnValue(header or ())
+
+    @defer.inlineCallbacks
+    def _store_sizes(self, blob, variants, priority, cascade=True,
+                     timer=None):
+        """Store variants of the given sizes, returns the list of created
+        images
+
+        All variants are written by a single convert call decoding the image
+        only once, or stored for rendering on request with images.lazy.
+        Durations of the probe, queue and store stages are recorded in timer,
+        a metrics.Timer.
+        """
+        timer = timer or metrics.Timer(None)
+        timer.mode = metrics.mode(variants)
+        header = yield self._check_image(blob)
+        timer.lap('probe')
+        try:
+            if self.settings['images']['lazy']:
+                paths = yield self.scheduler.run(
+                    _blob_size(blob), priority, threads.deferToThread,
+                    timer.starting(image_io.store_lazy), blob=blob,
+                    variants=variants,
+                    umask=self.settings['images']['umask'], index=self.index,
+                    shards=self.shards)
+            else:
+                yield self._store_variants(blob, variants, priority,
+                                           cascade, timer, header)
+                paths = [variant['path'] for variant in variants]
+            timer.lap('store')
+        except BusyError:
+            raise
         except Exception:
-            raise ClientError('Invalid image encoding, should be base64')
+            traceback.print_exc()
+            raise ServerError("Unable to store image(s), see log for "
+                              "details")
+
+        defer.returnValue(paths)
 
+    @defer.inlineCallbacks
+    def _store_image(self, blob, path, fmt=None, size=None, composite=0,
+                     crop=0, priority=Scheduler.REPLICATION, cascade=1,
+                     timer=None):
+        """Store decoded image and apply transformations
+
+        The blob is either a string or a file object, see
+        XMLRPCServer._api_store_image for explanation of the other arguments.
+        Returns the list of created images, None if a later request for the
+        path superseded this one (see _coalesce).
+        """
+        timer = timer or metrics.Timer(None)
         normalized_path = image_io.normalize_path(
             self.settings['images']['path'] + '/' + path,
             self.settings['images']['path'])
@@ -294,8 +1455,7 @@ class XMLRPCServer(xmlrpc.XMLRPC):
                 crop = dict([(item[0], crop) for
                              item in size.items()])
 
-            (dirs, filename) = os.path.split(normalized_path)
-            parts = filename.split('.')
+            variants = []
 
             for suffix, dimension in size.items():
                 if not isinstance(dimension, list) or len(dimension) != 2:
@@ -315,30 +1475,17 @@ class XMLRPCServer(xmlrpc.XMLRPC):
 
                 # Add a suffix and replace the original extension if format
                 # was specified
-                if len(parts) == 1:
-                    suffixed_path = dirs + '/' + filename + suffix
-                    if fmt[suffix]:
-                        suffixed_path += '.' + fmt[suffix]
-                else:
-                    suffixed_path = (dirs + '/' + '.'.join(parts[:-1]) +
-                                    suffix + '.')
-                    if fmt[suffix]:
-                        suffixed_path += fmt[suffix]
-                    else:
-                        suffixed_path += parts[-1]
-
-                try:
-                    yield threads.deferToThread(
-                        image_io.store, blob=blob, path=suffixed_path,
-                        fmt=fmt[suffix], dimension=dimension,
-                        composite=composite[suffix], crop=crop[suffix],
-                        umask=self.settings['images']['umask'],
-                        convert=self.settings['imagemagick']['convert'],
-                        env=self.settings['imagemagick']['env'])
-                except Exception:
-                    traceback.print_exc()
-                    raise ServerError("Unable to store image(s), see log for "
-                                      "details")
+                variants.append({'path': image_io.suffixed_path(
+                                     normalized_path, suffix, fmt[suffix]),
+                                 'fmt': fmt[suffix], 'dimension': dimension,
+                                 'composite': composite[suffix],
+                                 'crop': crop[suffix]})
+
+            paths = yield self._coalesce(
+                normalized_path, blob, variants,
+                lambda: self._store_sizes(blob, variants, priority,
+                                          bool(cascade), timer))
+            defer.returnValue(paths)
         else:
             if fmt:
                 if not isinstance(fmt, basestring):
@@ -356,48 +1503,494 @@ class XMLRPCServer(xmlrpc.XMLRPC):
                 raise ClientError("Composite and crop options require a size "
                                   "specification")
 
-            try:
-                yield threads.deferToThread(
-                    image_io.store, blob=blob, path=normalized_path,
+            paths = yield self._coalesce(
+                normalized_path, blob, [{'path': normalized_path,
+                                         'fmt': fmt}],
+                lambda: self._store_file(blob, normalized_path, fmt,
+                                         priority, timer))
+            defer.returnValue(paths)
+
+    @defer.inlineCallbacks
+    def _store_file(self, blob, path, fmt=None,
+                    priority=Scheduler.REPLICATION, timer=None):
+        """Store decoded image at the normalized path, converted to fmt if
+        given, returns the list of created images"""
+        timer = timer or metrics.Timer(None)
+        timer.mode = metrics.mode([{'fmt': fmt}])
+        header = None
+        if fmt:
+            header = yield self._check_image(blob)
+            timer.lap('probe')
+
+        try:
+            if self.settings['imagemagick']['async']:
+                yield self._store_variants(blob, [{'path': path, 'fmt': fmt}],
+                                           priority, timer=timer,
+                                           header=header)
+            else:
+                yield self.scheduler.run(
+                    _blob_size(blob), priority, threads.deferToThread,
+                    timer.starting(image_io.store), blob=blob, path=path,
                     fmt=fmt, umask=self.settings['images']['umask'],
                     convert=self.settings['imagemagick']['convert'],
-                    env=self.settings['imagemagick']['env'])
+                    env=self.settings['imagemagick']['env'], pool=self.pool,
+                    engine=self.settings['imagemagick']['engine'],
+                    cache=self.cache, index=self.index, shards=self.shards,
+                    header=header)
+            timer.lap('store')
+        except BusyError:
+            raise
+        except Exception:
+            traceback.print_exc()
+            raise ServerError("Unable to store image(s), see log for "
+                              "details")
+
+        defer.returnValue([path])
+
+    @defer.inlineCallbacks
+    def _coalesce(self, path, blob, variants, store):
+        """Call store, storing blob in variants for the normalized path,
+        unless the same is being stored already
+
+        Stores for one path run one after another in the order of requests,
+        so the last request wins. A request of the same image and variants as
+        the last one joins it, one of another image in the same variants
+        replaces the last one unless it is running. The Deferred returned
+        fires with the result of the store the request ended up in, None if
+        that stored another image, so superseded requests are not replicated
+        (see _replication_publish_store). Other operations on the path are
+        ordered along with the stores, see _serialize.
+        """
+        (arrived, queued) = self._arrive([path])
+        try:
+            image_digest = yield threads.deferToThread(image_io.digest, blob)
+            yield arrived
+        except Exception:
+            arrived.addCallback(lambda result: self._queued([path], queued))
+            raise
+        signature = repr([sorted(variant.items()) for variant in variants])
+        d = defer.Deferred()
+
+        queue = self._storing.get(path)
+        last = queue and queue[-1]
+        if (last and last['signature'] == signature and
+                (last['digest'] == image_digest or last is not queue[0])):
+            # Joined or superseded
+            last['digest'] = image_digest
+            last['store'] = store
+            last['waiting'].append((d, image_digest))
+        else:
+            self._enqueue(path, {'signature': signature,
+                                 'digest': image_digest, 'store': store,
+                                 'waiting': [(d, image_digest)]})
+        self._queued([path], queued)
+
+        result = yield d
+        defer.returnValue(result)
+
+    def _arrive(self, paths, prefix=False):
+        """Take the place of a request for the normalized paths in the order
+        of requests
+
+        Returns a Deferred firing once the requests made before for any of
+        paths are queued and the prefix operations before covering any of
+        them (all of them with prefix) are done, and the Deferred to pass to
+        _queued once this request is queued.
+        """
+        waiting = [self._arriving[path] for path in paths if
+                   path in self._arriving]
+        for other, done in self._prefixes:
+            if prefix or [path for path in paths if _covers(other, path)]:
+                waiting.append(done)
+        queued = defer.Deferred()
+        for path in paths:
+            self._arriving[path] = queued
+        return (defer.DeferredList(waiting), queued)
+
+    def _queued(self, paths, queued):
+        """Let requests after this one for paths queue, see _arrive"""
+        for path in paths:
+            if self._arriving.get(path) is queued:
+                del self._arriving[path]
+        queued.callback(None)
+
+    def _enqueue(self, path, entry):
+        """Append entry to the queue of path and start it if first"""
+        queue = self._storing.setdefault(path, [])
+        queue.append(entry)
+        if len(queue) == 1:
+            self._run_store(path)
+
+    def _serialize(self, paths, f, *args, **kwargs):
+        """Call f(*args, **kwargs) once the stores and other operations
+        requested before for any of the normalized paths are done
+
+        Requests for the paths made later wait until it returns, e.g. a
+        replicated delete of an image is not undone by its store. Returns a
+        Deferred firing with the result of f.
+        """
+        paths = sorted(set(paths))
+        (arrived, queued) = self._arrive(paths)
+        return self._run_serialized(paths, arrived, queued, f, args, kwargs)
+
+    def _serialize_prefix(self, prefixes, f, *args, **kwargs):
+        """Call f(*args, **kwargs) like _serialize, for the normalized paths
+        of the prefix operation on prefixes
+
+        Prefix operations run one at a time in the order of requests, after
+        the requests before for any path under the prefixes and before the
+        later ones (see _covers).
+        """
+        paths = [path for path in set(self._storing) | set(self._arriving) if
+                 [prefix for prefix in prefixes if _covers(prefix, path)]]
+        (arrived, queued) = self._arrive(sorted(paths), prefix=True)
+        prefix_ops = [(prefix, defer.Deferred()) for prefix in prefixes]
+        self._prefixes.extend(prefix_ops)
+
+        d = self._run_serialized(sorted(paths), arrived, queued, f, args,
+                                 kwargs)
+        d.addBoth(self._prefix_done, prefix_ops)
+        return d
+
+    def _prefix_done(self, result, prefix_ops):
+        """Let requests wait for the finished prefix operation go on"""
+        for prefix_op in prefix_ops:
+            self._prefixes.remove(prefix_op)
+            prefix_op[1].callback(None)
+        return result
+
+    @defer.inlineCallbacks
+    def _run_serialized(self, paths, arrived, queued, f, args, kwargs):
+        """Queue an operation on paths, see _serialize"""
+        yield arrived
+        if not paths:
+            self._queued(paths, queued)
+            result = yield defer.maybeDeferred(f, *args, **kwargs)
+            defer.returnValue(result)
+
+        # The operation starts once it is first in the queues of all paths
+        started = []
+        finished = defer.Deferred()
+
+        def start():
+            d = defer.Deferred()
+            started.append(d)
+            if len(started) == len(paths):
+                defer.maybeDeferred(f, *args, **kwargs).chainDeferred(
+                    finished)
+            return d
+
+        for path in paths:
+            self._enqueue(path, {'signature': None, 'digest': None,
+                                 'store': start, 'waiting': []})
+        self._queued(paths, queued)
+        try:
+            result = yield finished
+        finally:
+            for d in started:
+                d.callback(None)
+        defer.returnValue(result)
+
+    def _run_store(self, path):
+        """Start the first store for path, see _coalesce"""
+        d = defer.maybeDeferred(self._storing[path][0]['store'])
+        d.addBoth(self._stored, path)
+
+    def _stored(self, result, path):
+        """Start the next store for path and pass the result of the finished
+        one to its requests, None to the superseded ones"""
+        queue = self._storing[path]
+        finished = queue.pop(0)
+        if queue:
+            self._run_store(path)
+        else:
+            del self._storing[path]
+
+        for d, image_digest in finished['waiting']:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            elif image_digest != finished['digest']:
+                d.callback(None)
+            else:
+                d.callback(result)
+
+    @defer.inlineCallbacks
+    def _api_store_image_preset(self, image, path, preset):
+        """Store image in the sizes of a preset
+
+        Arguments:
+        image -- image data, encoded in base64 (or raw, see
+                 replication.Blob)
+        path -- destination path, relative to images.path from configuration
+        preset -- name of a preset from the presets section of configuration
+
+        A preset is a dictionary of sizes by suffix, like the one which can be
+        given to store_image, defined once in configuration:
+
+            [presets]
+            [[product]]
+            "" = 500x500
+            _small = 50x50 crop
+            _thumb = 100x100 composite png
+
+        Conversions are queued with the replication priority, see Scheduler.
+        Durations of the stages are observed as replicated_store_image_preset.
+        """
+        timer = metrics.Timer('replicated_store_image_preset')
+        try:
+            blob = _decode_image(image)
+            timer.lap('decode')
+
+            paths = yield self._store_preset(blob, path, preset,
+                                             Scheduler.REPLICATION, timer)
+        finally:
+            timer.observe()
+        defer.returnValue(paths)
+
+    @defer.inlineCallbacks
+    def _api_store_images(self, specs):
+        """Store multiple images, returns the status of each one
+
+        Arguments:
+        specs -- list of structs with image (encoded in base64 or raw, see
+                 replication.Blob) and path, and either the format, size,
+                 composite, crop and cascade arguments of store_image or the
+                 preset of store_image_preset
+        """
+        results = yield self._store_images(specs, Scheduler.REPLICATION,
+                                           'replicated_store_images')
+        defer.returnValue(_statuses(results))
+
+    @defer.inlineCallbacks
+    def _store_images(self, specs, priority, operation):
+        """Store the images of specs (see _api_store_images), as many at once
+        as the conversion queue runs
+
+        Returns (blob, list of created images or None, see _store_image) or
+        the Failure of every spec.
+        Durations are observed per image as operation, see metrics.Timer.
+        """
+        if not isinstance(specs, list):
+            raise ClientError("Invalid store specifications, should be a "
+                              "list")
+
+        semaphore = defer.DeferredSemaphore(self.scheduler.slots)
+        results = yield defer.DeferredList(
+            [semaphore.run(self._store_spec, spec, priority, operation) for
+             spec in specs], consumeErrors=True)
+        defer.returnValue([result for success, result in results])
+
+    @defer.inlineCallbacks
+    def _store_spec(self, spec, priority, operation):
+        """Store the image of a store_images specification, returns (blob,
+        list of created images)"""
+        if (not isinstance(spec, dict) or 'image' not in spec or
+                'path' not in spec):
+            raise ClientError("Invalid store specification, should be a "
+                              "struct with image and path")
+
+        timer = metrics.Timer(operation)
+        try:
+            blob = _decode_image(spec['image'])
+            timer.lap('decode')
+            if spec.get('preset') is not None:
+                paths = yield self._store_preset(blob, spec['path'],
+                                                 spec['preset'], priority,
+                                                 timer)
+            else:
+                paths = yield self._store_image(
+                    blob, spec['path'], spec.get('format'), spec.get('size'),
+                    spec.get('composite', 0), spec.get('crop', 0), priority,
+                    spec.get('cascade', 1), timer)
+        finally:
+            timer.observe()
+        defer.returnValue((blob, paths))
+
+    def _store_preset(self, blob, path, preset,
+                      priority=Scheduler.REPLICATION, timer=None):
+        """Store decoded image in the sizes of a preset
+
+        See XMLRPCServer._api_store_image_preset for explanation of the
+        arguments. Returns the list of created images, None if superseded
+        (see _store_image).
+        """
+        normalized_path = image_io.normalize_path(
+            self.settings['images']['path'] + '/' + path,
+            self.settings['images']['path'])
+
+        if not normalized_path:
+            raise ClientError("Invalid path(s)")
+
+        if not isinstance(preset, basestring) or preset not in self.presets:
+            raise ClientError("Unknown preset %s" % (preset,))
+
+        variants = self.presets[preset].variants(normalized_path)
+        return self._coalesce(
+            normalized_path, blob, variants,
+            lambda: self._store_sizes(blob, variants, priority, timer=timer))
+
+    @defer.inlineCallbacks
+    def _api_store_files(self, files):
+        """Store images as they are
+
+        Arguments:
+        files -- list of [path, data, mode] lists where path is relative to
+                 images.path from configuration, data is the image encoded in
+                 base64 (or raw, see replication.Blob) and mode are the
+                 permission bits of the file
+
+        This is used to replicate converted images in the result replication
+        mode.
+        """
+        if not isinstance(files, list):
+            raise ClientError("Invalid files specification, should be a list")
+
+        for item in files:
+            if not isinstance(item, list) or len(item) != 3:
+                raise ClientError("Invalid file specification, should be a "
+                                  "list with three elements (path, data and "
+                                  "mode)")
+            (path, image, mode) = item
+
+            normalized_path = image_io.normalize_path(
+                self.settings['images']['path'] + '/' + path,
+                self.settings['images']['path'])
+
+            if not normalized_path:
+                raise ClientError("Invalid path(s)")
+
+            blob = _decode_image(image)
+            try:
+                yield self._serialize(
+                    [normalized_path], self.scheduler.run, len(blob),
+                    Scheduler.REPLICATION, threads.deferToThread,
+                    image_io.store, blob=blob, path=normalized_path,
+                    umask=self.settings['images']['umask'], mode=mode,
+                    index=self.index, shards=self.shards)
             except Exception:
                 traceback.print_exc()
                 raise ServerError("Unable to store image(s), see log for "
                                   "details")
 
+    def _normalize(self, path):
+        """Return path relative to images.path normalized or raise
+        ClientError"""
+        if not isinstance(path, basestring):
+            raise ClientError("Invalid path specification, should be a "
+                              "string")
+
+        normalized_path = image_io.normalize_path(
+            self.settings['images']['path'] + '/' + path,
+            self.settings['images']['path'])
+
+        if not normalized_path:
+            raise ClientError("Invalid path(s)")
+        return normalized_path
+
+    def _normalize_valid(self, paths):
+        """Return the normalized ones of paths which are valid, see
+        _normalize"""
+        normalized_paths = []
+        for path in paths:
+            try:
+                normalized_paths.append(self._normalize(path))
+            except ClientError:
+                pass
+        return normalized_paths
+
+    @defer.inlineCallbacks
+    def _run_batch(self, f, items, keys):
+        """Call f(item) for every item in up to io_threads jobs of the
+        thread pool at once
+
+        Items sharing a path (see _partition) are handled by one job in
+        their order. Returns None or the Failure of every item.
+        """
+        def run(chunk):
+            results = []
+            for i in chunk:
+                try:
+                    f(items[i])
+                except Exception:
+                    results.append(failure.Failure())
+                    results[-1].cleanFailure()
+                else:
+                    results.append(None)
+            return results
+
+        chunks = yield threads.deferToThread(
+            _partition, items, self.settings['images']['io_threads'], keys)
+        chunk_results = yield defer.gatherResults(
+            [threads.deferToThread(run, chunk) for chunk in chunks])
+
+        results = [None] * len(items)
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            for i, result in zip(chunk, chunk_result):
+                results[i] = result
+        defer.returnValue(results)
+
+    def _delete(self, path):
+        """Delete the image at path, called from a thread"""
+        normalized_path = self._normalize(path)
+        try:
+            image_io.delete(path=normalized_path, index=self.index,
+                            lazy=True, shards=self.shards)
+        except Exception:
+            traceback.print_exc()
+            raise ServerError("Unable to delete image(s), see log for "
+                              "details")
+
+    def _move(self, paths):
+        """Move the image from the source to the destination path of paths,
+        called from a thread"""
+        (src_path, dst_path) = paths
+        normalized_src_path = self._normalize(src_path)
+        normalized_dst_path = self._normalize(dst_path)
+        try:
+            image_io.move(src_path=normalized_src_path,
+                          dst_path=normalized_dst_path,
+                          umask=self.settings['images']['umask'],
+                          index=self.index, lazy=True, shards=self.shards)
+        except Exception:
+            traceback.print_exc()
+            raise ServerError("Unable to move image(s), see log for "
+                              "details")
+
     @defer.inlineCallbacks
     def _api_delete_image(self, path):
         """Delete image
 
         Arguments:
         path -- path of the image or a list of paths
+
+        Lists of paths are deleted by a few jobs at once, see _run_batch. The
+        first error is raised once all of them are done.
         """
         if not isinstance(path, list):
             paths = [path]
         else:
             paths = path
 
-        for path in paths:
-            if not isinstance(path, basestring):
-                raise ClientError("Invalid path specification, should be a "
-                                  "string")
+        results = yield self._delete_images(paths)
+        for result in results:
+            if result:
+                result.raiseException()
 
-            normalized_path = image_io.normalize_path(
-                self.settings['images']['path'] + '/' + path,
-                self.settings['images']['path'])
-
-            if not normalized_path:
-                raise ClientError("Invalid path(s)")
+    @defer.inlineCallbacks
+    def _delete_images(self, paths, publish=False):
+        """Delete images, returns None or the Failure of every path
 
-            try:
-                yield threads.deferToThread(
-                    image_io.delete, path=normalized_path)
-            except Exception:
-                traceback.print_exc()
-                raise ServerError("Unable to delete image(s), see log for "
-                                  "details")
+        With publish the deleted ones are replicated by a single message.
+        """
+        results = yield self._serialize(
+            self._normalize_valid(paths), self._run_batch, self._delete,
+            paths, lambda path: [path])
+        deleted = [path for path, result in zip(paths, results) if
+                   not result]
+        if publish and deleted:
+            self._replication_publish(self._replication_id, 'delete_image',
+                                      deleted)
+        defer.returnValue(results)
 
     @defer.inlineCallbacks
     def _api_move_image(self, src_path, dst_path):
@@ -407,7 +2000,10 @@ class XMLRPCServer(xmlrpc.XMLRPC):
         src_path -- the source path or a list of paths
         dst_path -- the destination path or a list of paths
 
-        In case of multiple paths both lists must equal in length.
+        In case of multiple paths both lists must equal in length. Moves
+        sharing a path are done in the given order, the other ones by a few
+        jobs at once (see _run_batch). The first error is raised once all of
+        them are done.
         """
         if not isinstance(src_path, list):
             src_path = [src_path]
@@ -415,53 +2011,234 @@ class XMLRPCServer(xmlrpc.XMLRPC):
         if not isinstance(dst_path, list):
             dst_path = [dst_path]
 
-        if len(src_path) != len(dst_path):
-            raise ClientError("Number of source paths should match number of "
-                              "destination paths")
+        results = yield self._move_images(src_path, dst_path)
+        for result in results:
+            if result:
+                result.raiseException()
 
-        for i in xrange(len(src_path)):
-            normalized_src_path = image_io.normalize_path(
-                self.settings['images']['path'] + '/' + src_path[i],
-                self.settings['images']['path'])
+    @defer.inlineCallbacks
+    def _move_images(self, src_paths, dst_paths, publish=False):
+        """Move images, returns None or the Failure of every pair of paths
 
-            normalized_dst_path = image_io.normalize_path(
-                self.settings['images']['path'] + '/' + dst_path[i],
-                self.settings['images']['path'])
+        With publish the moved ones are replicated by a single message.
+        """
+        if len(src_paths) != len(dst_paths):
+            raise ClientError("Number of source paths should match number "
+                              "of destination paths")
+
+        pairs = zip(src_paths, dst_paths)
+        results = yield self._serialize(
+            self._normalize_valid(src_paths + dst_paths), self._run_batch,
+            self._move, pairs, list)
+        moved = [pair for pair, result in zip(pairs, results) if not result]
+        if publish and moved:
+            self._replication_publish(self._replication_id, 'move_image',
+                                      [src for src, dst in moved],
+                                      [dst for src, dst in moved])
+        defer.returnValue(results)
+
+    def _normalize_prefix(self, prefix):
+        """Return prefix normalized like _normalize, raise ClientError for
+        the images.path directory itself"""
+        normalized_prefix = self._normalize(prefix)
+        if normalized_prefix == os.path.normpath(
+                self.settings['images']['path']):
+            raise ClientError("Invalid path(s)")
+        return normalized_prefix
+
+    def _prefix_suffixes(self, suffixes):
+        """Return the list of suffixes given as one or as the name of a
+        preset, see _api_delete_prefix"""
+        if suffixes is None:
+            return []
+        if isinstance(suffixes, basestring):
+            if suffixes not in self.presets:
+                raise ClientError("Unknown preset %s" % (suffixes,))
+            return self.presets[suffixes].suffixes()
+
+        if not isinstance(suffixes, (list, tuple)):
+            raise ClientError("Invalid suffixes")
+        encoded_suffixes = []
+        for suffix in suffixes:
+            if isinstance(suffix, unicode):
+                suffix = suffix.encode('utf-8')
+            if not isinstance(suffix, str) or '/' in suffix:
+                raise ClientError("Invalid suffix %r" % (suffix,))
+            encoded_suffixes.append(suffix)
+        return encoded_suffixes
 
-            if not normalized_src_path or not normalized_dst_path:
-                raise ClientError("Invalid path(s)")
+    @defer.inlineCallbacks
+    def _api_delete_prefix(self, prefix, suffixes=None):
+        """Delete a directory or an image with its variants
 
-            try:
-                yield threads.deferToThread(
-                    image_io.move, src_path=normalized_src_path,
-                    dst_path=normalized_dst_path,
-                    umask=self.settings['images']['umask'])
-            except Exception:
-                traceback.print_exc()
-                raise ServerError("Unable to move image(s), see log for "
-                                  "details")
+        Arguments:
+        prefix -- path of a directory or of an image; of an image the files
+                  in its directory named after its base name without
+                  extension, with any extension, are deleted, see
+                  image_io.delete_prefix
+        suffixes -- list of suffixes of the variants of an image to delete
+                    too, or the name of a preset whose sizes they are
+        """
+        normalized_prefix = self._normalize_prefix(prefix)
+        suffixes = self._prefix_suffixes(suffixes)
+        try:
+            yield self._serialize_prefix(
+                [normalized_prefix], threads.deferToThread,
+                image_io.delete_prefix, path=normalized_prefix,
+                index=self.index, shards=self.shards, suffixes=suffixes)
+        except Exception:
+            traceback.print_exc()
+            raise ServerError("Unable to delete image(s), see log for "
+                              "details")
+
+    @defer.inlineCallbacks
+    def _api_move_prefix(self, src_prefix, dst_prefix, suffixes=None):
+        """Move a directory or an image with its variants
+
+        Arguments:
+        src_prefix -- path of a directory or of an image, see
+                      _api_delete_prefix
+        dst_prefix -- the destination path; variants of an image are renamed
+                      with its base name, see image_io.move_prefix
+        suffixes -- suffixes of the variants of an image, see
+                    _api_delete_prefix
+        """
+        normalized_src_prefix = self._normalize_prefix(src_prefix)
+        normalized_dst_prefix = self._normalize_prefix(dst_prefix)
+        suffixes = self._prefix_suffixes(suffixes)
+        try:
+            yield self._serialize_prefix(
+                [normalized_src_prefix, normalized_dst_prefix],
+                threads.deferToThread, image_io.move_prefix,
+                src_path=normalized_src_prefix,
+                dst_path=normalized_dst_prefix,
+                umask=self.settings['images']['umask'], index=self.index,
+                shards=self.shards, suffixes=suffixes)
+        except Exception:
+            traceback.print_exc()
+            raise ServerError("Unable to move image(s), see log for "
+                              "details")
 
     @defer.inlineCallbacks
-    def xmlrpc_store_image(self, image, path, format=None, size=None,
-                           composite=0, crop=0):
+    def _convert_variant(self, path):
+        """Render the lazily stored variant at path, see _render_variant"""
+        lazy = yield threads.deferToThread(image_io.load_lazy, path)
+        if not lazy:
+            defer.returnValue(False)
+
+        (original_path, variant) = lazy
+        timer = metrics.Timer('render')
+        timer.mode = metrics.mode([variant])
+        blob = yield threads.deferToThread(open, original_path, 'rb')
+        try:
+            yield self._store_variants(blob, [variant], Scheduler.LOCAL,
+                                       timer=timer)
+            timer.lap('store')
+        finally:
+            blob.close()
+            timer.observe()
+        defer.returnValue(True)
+
+    def _render_variant(self, path):
+        """Render the lazily stored variant at path, see store_lazy
+
+        Concurrent calls for the same path share one conversion. Returns a
+        Deferred firing with False if there is no manifest for path.
+        """
+        if path in self._rendering:
+            d = defer.Deferred()
+            self._rendering[path].append(d)
+            return d
+
+        self._rendering[path] = []
+        d = self._convert_variant(path)
+        d.addBoth(self._variant_rendered, path)
+        return d
+
+    def _variant_rendered(self, result, path):
+        """Pass the result of _render_variant to the waiting calls"""
+        for d in self._rendering.pop(path):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    @xmlrpc.withRequest
+    @defer.inlineCallbacks
+    def xmlrpc_store_image(self, request, image, path, format=None,
+                           size=None, composite=0, crop=0, cascade=1):
         """Handle store_image RPC
 
         See XMLRPCServer._api_store_image for explanation of the arguments.
         """
-        yield self._api_store_image(image, path, format, size, composite, crop)
-        self._replication_publish(self._replication_id, 'store_image', image,
-                                  path, format, size, composite, crop)
+        timer = request.timer
+        timer.operation = 'store_image'
+        timer.lap('parse')
+        try:
+            blob = _decode_image(image)
+            timer.lap('decode')
+            paths = yield self._store_image(blob, path, format, size,
+                                            composite, crop, Scheduler.LOCAL,
+                                            cascade, timer)
+            yield self._replication_publish_store(
+                blob, paths, (path, format, size, composite, crop), image,
+                cascade=cascade)
+            timer.lap('publish')
+        finally:
+            timer.observe()
         defer.returnValue('OK')
 
+    @xmlrpc.withRequest
+    @defer.inlineCallbacks
+    def xmlrpc_store_image_preset(self, request, image, path, preset):
+        """Handle store_image_preset RPC
+
+        See XMLRPCServer._api_store_image_preset for explanation of the
+        arguments.
+        """
+        timer = request.timer
+        timer.operation = 'store_image_preset'
+        timer.lap('parse')
+        try:
+            blob = _decode_image(image)
+            timer.lap('decode')
+            paths = yield self._store_preset(blob, path, preset,
+                                             Scheduler.LOCAL, timer)
+            yield self._replication_publish_store(
+                blob, paths, (path, preset), image, 'store_image_preset')
+            timer.lap('publish')
+        finally:
+            timer.observe()
+        defer.returnValue('OK')
+
+    @defer.inlineCallbacks
+    def xmlrpc_store_images(self, specs):
+        """Handle store_images RPC
+
+        See XMLRPCServer._api_store_images for explanation of the arguments.
+        Returns the status of every image, OK or the fault message. Stored
+        images are replicated by a single message.
+        """
+        results = yield self._store_images(specs, Scheduler.LOCAL,
+                                           'store_images')
+        yield self._replication_publish_stores(specs, results)
+        defer.returnValue(_statuses(results))
+
     @defer.inlineCallbacks
     def xmlrpc_delete_image(self, path):
         """Handle delete_image RPC
 
         See XMLRPCServer._api_delete_image for explanation of the arguments.
+        Images deleted before an error are replicated nevertheless.
         """
-        yield self._api_delete_image(path)
-        self._replication_publish(self._replication_id, 'delete_image',
-                                  path)
+        if not isinstance(path, list):
+            path = [path]
+
+        results = yield self._delete_images(path, publish=True)
+        for result in results:
+            if result:
+                result.raiseException()
         defer.returnValue('OK')
 
     @defer.inlineCallbacks
@@ -469,8 +2246,360 @@ class XMLRPCServer(xmlrpc.XMLRPC):
         """Handle move_image RPC
 
         See XMLRPCServer._api_move_image for explanation of the arguments.
+        Images moved before an error are replicated nevertheless.
+        """
+        if not isinstance(src_path, list):
+            src_path = [src_path]
+
+        if not isinstance(dst_path, list):
+            dst_path = [dst_path]
+
+        results = yield self._move_images(src_path, dst_path, publish=True)
+        for result in results:
+            if result:
+                result.raiseException()
+        defer.returnValue('OK')
+
+    @defer.inlineCallbacks
+    def xmlrpc_delete_images(self, paths):
+        """Handle delete_images RPC
+
+        Deletes a list of images like delete_image, but returns the status of
+        every image, OK or the fault message. Deleted images are replicated
+        by a single message.
+        """
+        if not isinstance(paths, list):
+            raise ClientError("Invalid paths specification, should be a list")
+
+        results = yield self._delete_images(paths, publish=True)
+        defer.returnValue(_statuses(results))
+
+    @defer.inlineCallbacks
+    def xmlrpc_move_images(self, src_paths, dst_paths):
+        """Handle move_images RPC
+
+        Moves lists of images like move_image, but returns the status of
+        every pair of paths, OK or the fault message. Moved images are
+        replicated by a single message.
+        """
+        if not isinstance(src_paths, list) or not isinstance(dst_paths,
+                                                             list):
+            raise ClientError("Invalid paths specification, should be a list")
+
+        results = yield self._move_images(src_paths, dst_paths, publish=True)
+        defer.returnValue(_statuses(results))
+
+    @defer.inlineCallbacks
+    def xmlrpc_delete_prefix(self, prefix, suffixes=None):
+        """Handle delete_prefix RPC
+
+        See XMLRPCServer._api_delete_prefix for explanation of the
+        arguments. Replicated by a single message, with the suffixes of a
+        preset listed.
+        """
+        suffixes = self._prefix_suffixes(suffixes)
+        yield self._api_delete_prefix(prefix, suffixes)
+        self._replication_publish(self._replication_id, 'delete_prefix',
+                                  prefix, suffixes)
+        defer.returnValue('OK')
+
+    @defer.inlineCallbacks
+    def xmlrpc_move_prefix(self, src_prefix, dst_prefix, suffixes=None):
+        """Handle move_prefix RPC
+
+        See XMLRPCServer._api_move_prefix for explanation of the arguments.
+        Replicated by a single message, with the suffixes of a preset listed.
         """
-        yield self._api_move_image(src_path, dst_path)
-        self._replication_publish(self._replication_id, 'move_image', src_path,
-                                  dst_path)
+        suffixes = self._prefix_suffixes(suffixes)
+        yield self._api_move_prefix(src_prefix, dst_prefix, suffixes)
+        self._replication_publish(self._replication_id, 'move_prefix',
+                                  src_prefix, dst_prefix, suffixes)
         defer.returnValue('OK')
+
+
+class UploadResource(resource.Resource):
+    """HTTP resource for storing raw images
+
+    The image is sent unencoded as the body of a PUT or POST request to
+    /upload/PATH. Twisted spools large bodies to a temporary file which is
+    then passed to convert as it is. Other arguments of store_image are given
+    in the query string, each one either affects all created images or the
+    one with the given suffix:
+
+        format=png or format=_small:png
+        size=500x500 or size=_small:50x50 (repeated for multiple sizes)
+        composite=1 or composite=_small:1
+        crop=1 or crop=_small:1
+        cascade=0
+
+    A repeated argument without a suffix, e.g. size=500x500&size=_small:50x50,
+    is the one of the unsuffixed image (same as size=:500x500). A preset can
+    be given instead (preset=product), see XMLRPCServer._api_store_image and
+    XMLRPCServer._api_store_image_preset for explanation of the arguments.
+    """
+    isLeaf = True
+
+    def __init__(self, xmlrpc_server):
+        resource.Resource.__init__(self)
+        self.xmlrpc_server = xmlrpc_server
+
+    @staticmethod
+    def _parse_argument(values, parse):
+        """Return a single value or a dictionary of values by suffix"""
+        if not values:
+            return None
+
+        try:
+            if len(values) == 1 and ':' not in values[0]:
+                return parse(values[0])
+
+            result = {}
+            for value in values:
+                (suffix, separator, value) = value.partition(':')
+                if not separator:
+                    # The unsuffixed image
+                    (suffix, value) = ('', suffix)
+                if suffix in result:
+                    raise ValueError(suffix)
+                result[suffix] = parse(value)
+            return result
+        except ValueError:
+            raise ClientError("Invalid argument %s, repeated ones take "
+                              "SUFFIX:VALUE, the unsuffixed image VALUE or "
+                              ":VALUE" % (', '.join(values),))
+
+    @staticmethod
+    def _parse_size(value):
+        """Parse WIDTHxHEIGHT into a list"""
+        return [int(n) for n in value.lower().split('x', 1)]
+
+    @defer.inlineCallbacks
+    def _store_image(self, request):
+        """Store the uploaded image and replicate it, the durations of the
+        stages are observed as upload (see metrics.Timer)"""
+        timer = metrics.Timer('upload')
+        try:
+            yield self._store_upload(request, timer)
+            timer.lap('publish')
+        finally:
+            timer.observe()
+
+    @defer.inlineCallbacks
+    def _store_upload(self, request, timer):
+        """Store the uploaded image and replicate it"""
+        path = '/'.join(request.postpath)
+        preset = self._parse_argument(request.args.get('preset'), str)
+        if preset:
+            paths = yield self.xmlrpc_server._store_preset(
+                request.content, path, preset, Scheduler.LOCAL, timer)
+            yield self.xmlrpc_server._replication_publish_store(
+                request.content, paths, (path, preset),
+                method='store_image_preset')
+            return
+
+        fmt = self._parse_argument(request.args.get('format'), str)
+        size = self._parse_argument(request.args.get('size'),
+                                    self._parse_size)
+        composite = self._parse_argument(request.args.get('composite'),
+                                         int) or 0
+        crop = self._parse_argument(request.args.get('crop'), int) or 0
+        cascade = self._parse_argument(request.args.get('cascade'), int)
+        if cascade is None:
+            cascade = 1
+
+        # Suffixes without composite or crop arguments are just resized
+        if isinstance(size, dict):
+            for argument in (composite, crop):
+                if isinstance(argument, dict):
+                    for suffix in size:
+                        argument.setdefault(suffix, 0)
+
+        paths = yield self.xmlrpc_server._store_image(
+            request.content, path, fmt, size, composite, crop,
+            Scheduler.LOCAL, cascade, timer)
+        yield self.xmlrpc_server._replication_publish_store(
+            request.content, paths, (path, fmt, size, composite, crop),
+            cascade=cascade)
+
+    def _cbRender(self, result, request, response_failed):
+        """Write response"""
+        if response_failed:
+            return
+
+        request.setHeader('content-type', 'text/plain')
+        request.write('OK')
+        request.finish()
+
+    def _ebRender(self, failure, request, response_failed):
+        """Write error response with the fault code of XMLRPCServer"""
+        message = _error_message(failure)
+        if response_failed:
+            return
+
+        if message.startswith('[1000]'):
+            request.setResponseCode(http.BAD_REQUEST)
+        elif message.startswith('[1003]'):
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        else:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.setHeader('content-type', 'text/plain')
+        request.write(message)
+        request.finish()
+
+    def render_PUT(self, request):
+        """Handle upload"""
+        response_failed = []
+        request.notifyFinish().addErrback(response_failed.append)
+        d = defer.maybeDeferred(self._store_image, request)
+        d.addCallbacks(self._cbRender, self._ebRender,
+                       callbackArgs=(request, response_failed),
+                       errbackArgs=(request, response_failed))
+        return server.NOT_DONE_YET
+
+    render_POST = render_PUT
+
+
+class ImageResource(resource.Resource):
+    """HTTP resource for reading stored images
+
+    GET /images/PATH returns the image, rendering a lazily stored variant
+    (see images.lazy) if it is not yet. A web server serving images.path can
+    fall back to this resource for missing files.
+    """
+    isLeaf = True
+
+    def __init__(self, xmlrpc_server):
+        resource.Resource.__init__(self)
+        self.xmlrpc_server = xmlrpc_server
+
+    @defer.inlineCallbacks
+    def _find_image(self, request):
+        """Return path of the image, None if there is none"""
+        root = os.path.normpath(self.xmlrpc_server.settings['images']['path'])
+        path = os.path.normpath(root + '/' + '/'.join(request.postpath))
+
+        # Only files below root, neither originals and manifests nor
+        # temporary files and directories are served
+        if (not path.startswith(root.rstrip(os.sep) + os.sep) or
+                [name for name in path[len(root):].split(os.sep) if
+                 name.startswith('.')]):
+            defer.returnValue(None)
+
+        exists = yield threads.deferToThread(os.path.isfile, path)
+        if not exists:
+            rendered = yield self.xmlrpc_server._render_variant(path)
+            if not rendered:
+                defer.returnValue(None)
+        defer.returnValue(path)
+
+    def _cbRender(self, path, request, response_failed):
+        """Write the image"""
+        if response_failed:
+            return
+
+        if not path:
+            request.setResponseCode(http.NOT_FOUND)
+            request.setHeader('content-type', 'text/plain')
+            request.write('Not found')
+            request.finish()
+            return
+
+        body = static.File(path).render(request)
+        if body != server.NOT_DONE_YET:
+            request.write(body)
+            request.finish()
+
+    def _ebRender(self, failure, request, response_failed):
+        """Write error response with the fault code of XMLRPCServer"""
+        message = _error_message(failure)
+        if response_failed:
+            return
+
+        if message.startswith('[1003]'):
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        else:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.setHeader('content-type', 'text/plain')
+        request.write(message)
+        request.finish()
+
+    def render_GET(self, request):
+        """Handle read"""
+        response_failed = []
+        request.notifyFinish().addErrback(response_failed.append)
+        d = self._find_image(request)
+        d.addCallbacks(self._cbRender, self._ebRender,
+                       callbackArgs=(request, response_failed),
+                       errbackArgs=(request, response_failed))
+        return server.NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+
+class MetricsResource(resource.Resource):
+    """HTTP resource for reading metrics in the Prometheus text format
+
+    GET /metrics returns the stage histograms and replication lag (see
+    imagepipe.metrics) along with the state of the conversion queue. With
+    server workers each response covers the worker which handled it.
+    """
+    isLeaf = True
+
+    def __init__(self, xmlrpc_server):
+        resource.Resource.__init__(self)
+        self.xmlrpc_server = xmlrpc_server
+        self.gauges = [
+            metrics.Gauge('imagepipe_queue_depth',
+                          'Number of conversions waiting in the queue',
+                          lambda: self.xmlrpc_server.scheduler.depth),
+            metrics.Gauge('imagepipe_queue_running',
+                          'Number of conversions holding a slot',
+                          lambda: self.xmlrpc_server.scheduler.running),
+            metrics.Gauge('imagepipe_queue_bytes',
+                          'Size of images of queued and running conversions',
+                          lambda: self.xmlrpc_server.scheduler.bytes)]
+
+    def render_GET(self, request):
+        """Handle read"""
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return metrics.render(self.gauges)
+
+
+class RootResource(resource.Resource):
+    """Serves the upload resource under /upload, the image resource under
+    /images, metrics under /metrics and XMLRPC on other paths"""
+
+    def __init__(self, xmlrpc_server):
+        resource.Resource.__init__(self)
+        self.xmlrpc_server = xmlrpc_server
+        self.putChild('upload', UploadResource(xmlrpc_server))
+        self.putChild('images', ImageResource(xmlrpc_server))
+        self.putChild('metrics', MetricsResource(xmlrpc_server))
+
+    def getChild(self, path, request):
+        """Fall back to XMLRPC"""
+        return self.xmlrpc_server
+
+    def render(self, request):
+        """Handle requests for the root itself, e.g. without a path"""
+        return self.xmlrpc_server.render(request)
+
+
+def main():
+    """Run a server worker, see ServerWorkers"""
+    def emit(event):
+        text = log.textFromEventDict(event)
+        if text is not None:
+            sys.stdout.write(text.replace('\n', '\n\t') + '\n')
+
+    log.startLoggingWithObserver(emit, setStdout=False)
+    (conf_path, relay, number) = sys.argv[1:]
+    image_service = ImageService(conf_path, relay, int(number))
+    reactor.callWhenRunning(image_service.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  image_service.stopService)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
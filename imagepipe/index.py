@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""Digest index of the image tree"""
+
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+class TreeIndex(object):
+    """Merkle tree of digests of stored images
+
+    Files are recorded with the MD5 digest of their contents, directories
+    with the digest of their sorted entries (names and digests of files and
+    subdirectories), so two trees are equal if their root digests are and
+    differing subtrees are found by comparing entries top-down.
+
+    The index is a SQLite database at path. Updating a file only marks its
+    directory and all of the parent ones as changed, their digests are
+    computed again when requested. Paths are relative to root, the root
+    directory itself is ''.
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'dir TEXT, name TEXT, digest TEXT, '
+                         'PRIMARY KEY (dir, name))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                         'path TEXT PRIMARY KEY, parent TEXT, name TEXT, '
+                         'digest TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS dirs_parent '
+                         'ON dirs (parent)')
+
+    def relpath(self, path):
+        """Return path relative to root"""
+        path = os.path.relpath(path, self.root)
+        return path != '.' and path or ''
+
+    @staticmethod
+    def file_digest(path):
+        """Return the digest of the file at path"""
+        digest = hashlib.md5()
+        image = open(path, 'rb')
+        try:
+            for chunk in iter(lambda: image.read(65536), ''):
+                digest.update(chunk)
+        finally:
+            image.close()
+        return digest.hexdigest()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run statements in a transaction holding the lock"""
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                yield
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _invalidate(self, path):
+        """Mark the directory path and all of the parent ones as changed"""
+        while True:
+            (parent, name) = os.path.split(path)
+            self._db.execute('INSERT OR REPLACE INTO dirs VALUES '
+                             '(?, ?, ?, NULL)', (path, parent, name))
+            if not path:
+                break
+            path = parent
+
+    def update(self, path, digest=None):
+        """Record the file at path, its digest is computed unless given"""
+        if digest is None:
+            digest = self.file_digest(path)
+        (dirname, name) = os.path.split(self.relpath(path))
+
+        with self._transaction():
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                             (dirname, name, digest))
+            self._invalidate(dirname)
+
+    def remove(self, path):
+        """Forget the file at path"""
+        (dirname, name) = os.path.split(self.relpath(path))
+
+        with self._transaction():
+            self._db.execute('DELETE FROM files WHERE dir = ? AND name = ?',
+                             (dirname, name))
+            self._invalidate(dirname)
+
+    def remove_tree(self, path):
+        """Forget the directory path with all of its contents"""
+        path = self.relpath(path)
+
+        with self._transaction():
+            self._db.execute('DELETE FROM files WHERE dir = ? OR '
+                             'substr(dir, 1, ?) = ?',
+                             (path, len(path) + 1, path + '/'))
+            self._db.execute('DELETE FROM dirs WHERE path = ? OR '
+                             'substr(path, 1, ?) = ?',
+                             (path, len(path) + 1, path + '/'))
+            self._invalidate(os.path.dirname(path))
+
+    def move_tree(self, src_path, dst_path):
+        """Record the directory src_path renamed to dst_path with all of its
+        contents
+
+        Digests of the moved subdirectories are kept, dst_path is expected
+        not to be recorded yet.
+        """
+        src = self.relpath(src_path)
+        dst = self.relpath(dst_path)
+        prefix = (len(src) + 1, src + '/')
+
+        with self._transaction():
+            self._db.execute('UPDATE OR REPLACE files SET dir = ? || '
+                             'substr(dir, ?) WHERE dir = ? OR '
+                             'substr(dir, 1, ?) = ?',
+                             (dst, len(src) + 1, src) + prefix)
+            self._db.execute('UPDATE OR REPLACE dirs SET path = ? || '
+                             'substr(path, ?), parent = ? || '
+                             'substr(parent, ?) WHERE substr(path, 1, ?) = ?',
+                             (dst, len(src) + 1, dst, len(src) + 1) + prefix)
+            self._db.execute('DELETE FROM dirs WHERE path = ?', (src,))
+            self._invalidate(dst)
+            self._invalidate(os.path.dirname(src))
+
+    def _digest(self, path):
+        """Return the digest of the directory path, None if it is empty"""
+        row = self._db.execute('SELECT digest FROM dirs WHERE path = ?',
+                               (path,)).fetchone()
+        if not row:
+            return None
+        if row[0]:
+            return row[0]
+
+        entries = self._entries(path)
+        if not entries:
+            self._db.execute('DELETE FROM dirs WHERE path = ?', (path,))
+            return None
+
+        digest = hashlib.md5()
+        for name, entry_digest, is_dir in entries:
+            digest.update('%s%s %s\n' % (name, is_dir and '/' or '',
+                                         entry_digest))
+        digest = digest.hexdigest()
+        self._db.execute('UPDATE dirs SET digest = ? WHERE path = ?',
+                         (digest, path))
+        return digest
+
+    def _entries(self, path):
+        """Return sorted [name, digest, is_dir] of entries of the directory"""
+        entries = [[name, digest, False] for name, digest in
+                   self._db.execute('SELECT name, digest FROM files WHERE '
+                                    'dir = ?', (path,))]
+        subdirs = self._db.execute('SELECT path, name FROM dirs WHERE '
+                                   'parent = ? AND path != ?',
+                                   (path, '')).fetchall()
+        for subdir, name in subdirs:
+            digest = self._digest(subdir)
+            if digest:
+                entries.append([name, digest, True])
+        return sorted(entries)
+
+    def digest(self, path=''):
+        """Return the digest of the directory path, None if it is empty"""
+        with self._transaction():
+            return self._digest(path)
+
+    def entries(self, path=''):
+        """Return sorted [name, digest, is_dir] lists of entries of the
+        directory path"""
+        with self._transaction():
+            return self._entries(path)
+
+    def rebuild(self, progress=None):
+        """Replace the index with digests of all files under root
+
+        Files are added in batches of 1000, progress is called with the
+        number of files added so far after each batch if given. Temporary
+        files of stores in progress (.tmp.*) are skipped. Returns the number
+        of files.
+        """
+        with self._transaction():
+            self._db.execute('DELETE FROM files')
+            self._db.execute('DELETE FROM dirs')
+
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirname = self.relpath(dirpath)
+            filenames = [filename for filename in filenames
+                         if not filename.startswith('.tmp.')]
+            for start in xrange(0, len(filenames), 1000):
+                rows = []
+                for filename in filenames[start:start + 1000]:
+                    try:
+                        rows.append((dirname, filename, self.file_digest(
+                            os.path.join(dirpath, filename))))
+                    except IOError:
+                        # Removed in the meantime
+                        continue
+
+                with self._transaction():
+                    self._db.executemany('INSERT OR REPLACE INTO files '
+                                         'VALUES (?, ?, ?)', rows)
+                    self._invalidate(dirname)
+
+                count += len(rows)
+                if progress:
+                    progress(count)
+        return count
+
+    def close(self):
+        """Close the database"""
+        self._db.close()
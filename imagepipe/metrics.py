@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""Latency histograms and gauges in the Prometheus text format"""
+
+import contextlib
+import threading
+import time
+
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    """Format a sample value"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    """Format label pairs, e.g. {operation="store",stage="convert"}"""
+    if not names:
+        return ''
+    return '{%s}' % (','.join(['%s="%s"' % (
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for name, value in zip(names, values)]),)
+
+
+class Histogram(object):
+    """Distribution of durations by label values
+
+    Observations may come from threads, e.g. conversions running in the
+    thread pool.
+    """
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._lock = threading.Lock()
+        # Label values -> [bucket counts, sum]
+        self._series = {}
+
+    def observe(self, value, *labels):
+        """Record a value with the given label values"""
+        with self._lock:
+            if labels not in self._series:
+                self._series[labels] = [[0] * len(self.buckets), 0.0]
+            series = self._series[labels]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """Record the duration of the with block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *labels)
+
+    def render(self):
+        """Return the lines of all series"""
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % (self.name,)]
+        with self._lock:
+            series = sorted([(labels, list(counts), total) for
+                             labels, (counts, total) in self._series.items()])
+
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(
+                    self.labels + ('le',), labels + (_format_value(bound),)),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (
+                self.name, _format_labels(self.labels, labels),
+                _format_value(total)))
+            lines.append('%s_count%s %d' % (
+                self.name, _format_labels(self.labels, labels), cumulative))
+        return lines
+
+
+class Gauge(object):
+    """Current value, either set, increased and decreased or read from a
+    function when rendered"""
+
+    def __init__(self, name, description, function=None):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase the value"""
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        """Decrease the value"""
+        self.inc(-amount)
+
+    @contextlib.contextmanager
+    def track(self):
+        """Increase the value for the duration of the with block"""
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def render(self):
+        """Return the lines of the gauge"""
+        if self.function:
+            value = self.function()
+        else:
+            value = self.value
+        return ['# HELP %s %s' % (self.name, self.description),
+                '# TYPE %s gauge' % (self.name,),
+                '%s %s' % (self.name, _format_value(value))]
+
+
+def mode(variants):
+    """Return the variant mode label of an image stored in variants (see
+    image_io.store_multi)
+
+    This is multi for more than one variant, otherwise composite, crop,
+    resize, format or copy for images written as they are.
+    """
+    if len(variants) > 1:
+        return 'multi'
+    variant = variants and variants[0] or {}
+    if variant.get('composite'):
+        return 'composite'
+    elif variant.get('crop'):
+        return 'crop'
+    elif variant.get('dimension'):
+        return 'resize'
+    elif variant.get('fmt'):
+        return 'format'
+    return 'copy'
+
+
+class Timer(object):
+    """Durations of consecutive stages of a request
+
+    Stages end with lap, the durations are recorded in stage_seconds by
+    observe along with the total once the operation and mode are known.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.mode = 'unknown'
+        self.stages = []
+        self._start = self._last = time.time()
+
+    def lap(self, stage):
+        """End a stage started by the previous one (or the timer)"""
+        now = time.time()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def starting(self, f):
+        """Return a function calling f once the current stage ends, for
+        the queue stage of scheduled conversions"""
+        def start(*args, **kwargs):
+            self.lap('queue')
+            return f(*args, **kwargs)
+        return start
+
+    def observe(self):
+        """Record the stages and the total duration"""
+        for stage, seconds in self.stages:
+            stage_seconds.observe(seconds, self.operation, self.mode, stage)
+        stage_seconds.observe(time.time() - self._start, self.operation,
+                              self.mode, 'total')
+
+
+stage_seconds = Histogram(
+    'imagepipe_stage_seconds', 'Duration of stages of storing images',
+    ('operation', 'mode', 'stage'))
+replication_lag_seconds = Histogram(
+    'imagepipe_replication_lag_seconds', 'Time from publishing replication '
+    'messages until receiving them')
+converts_in_flight = Gauge(
+    'imagepipe_converts_in_flight', 'Number of running conversions')
+
+
+def render(gauges=()):
+    """Return all metrics and the given gauges in the text format"""
+    lines = []
+    for metric in ((stage_seconds, replication_lag_seconds,
+                    converts_in_flight) + tuple(gauges)):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
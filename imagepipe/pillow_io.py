@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""In-process image conversion using Pillow
+
+This mirrors the resize, composite and crop commands assembled in image_io
+(including the geometry rounding of ImageMagick) so both engines produce
+images of the same dimensions. Pillow releases the GIL while decoding,
+resampling and encoding so conversions running in the reactor's thread pool
+proceed in parallel.
+"""
+
+import cStringIO
+import os
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = None
+
+
+class Error(Exception):
+    """Base class for conversion errors"""
+    pass
+
+
+class PillowError(Error):
+    """Indicates Pillow is missing or failed to process the image"""
+    pass
+
+
+# Formats whose names differ from the file extensions
+_formats = {'jpg': 'JPEG', 'jpe': 'JPEG', 'tif': 'TIFF'}
+
+# ImageMagick's default quality when it can not be estimated from the input
+_jpeg_quality = 92
+
+
+def version():
+    """Return the version of Pillow"""
+    if not Image:
+        raise PillowError("Pillow is not installed")
+    return "Pillow %s" % (getattr(Image, '__version__', None) or
+                          getattr(Image, 'PILLOW_VERSION'),)
+
+
+def _format(path, fmt):
+    """Return Pillow's format name for the output"""
+    name = (fmt or os.path.splitext(path)[1][1:]).lower()
+    return _formats.get(name, name.upper())
+
+
+def _geometry(size, dimension, fill=False):
+    """Compute the size of the image after resizing
+
+    This follows ImageMagick's WxH> (fit and never enlarge) and WxH^ (fill)
+    geometries.
+    """
+    (width, height) = size
+    if fill:
+        scale = max(float(dimension[0]) / width, float(dimension[1]) / height)
+    else:
+        if width <= dimension[0] and height <= dimension[1]:
+            return size
+        scale = min(float(dimension[0]) / width, float(dimension[1]) / height)
+    return (max(int(scale * width + 0.5), 1),
+            max(int(scale * height + 0.5), 1))
+
+
+def _target(size, variant):
+    """Return the size variant's image is resized to before composing or
+    cropping"""
+    if not variant.get('dimension'):
+        return size
+    return _geometry(size, variant['dimension'], bool(variant.get('crop')))
+
+
+def _transform(frame, size, variant):
+    """Apply variant's transformation on a single frame
+
+    The size argument is the size of the input before draft mode shrinking.
+    """
+    if frame.mode not in ('RGB', 'RGBA', 'L', 'CMYK'):
+        frame = frame.convert('RGBA')
+
+    target = _target(size, variant)
+    if frame.size != target:
+        frame = frame.resize(target, Image.LANCZOS)
+
+    dimension = variant.get('dimension')
+    if variant.get('composite'):
+        canvas = Image.new('RGBA', tuple(dimension), (0, 0, 0, 0))
+        canvas.paste(frame, ((dimension[0] - target[0]) / 2,
+                             (dimension[1] - target[1]) / 2))
+        frame = canvas
+    elif variant.get('crop'):
+        left = (target[0] - dimension[0]) / 2
+        top = (target[1] - dimension[1]) / 2
+        frame = frame.crop((left, top, left + dimension[0],
+                            top + dimension[1]))
+    return frame
+
+
+def _save(frames, path, fmt, info):
+    """Write frames in the requested format"""
+    fmt = _format(path, fmt)
+    options = {}
+    if fmt == 'JPEG':
+        options['quality'] = _jpeg_quality
+        frames = [frame.mode in ('RGB', 'L', 'CMYK') and frame or
+                  frame.convert('RGB') for frame in frames]
+    if len(frames) > 1:
+        options['save_all'] = True
+        options['append_images'] = frames[1:]
+        for key in ('duration', 'loop'):
+            if key in info:
+                options[key] = info[key]
+    frames[0].save(path, fmt, **options)
+
+
+def convert(blob, variants):
+    """Decode the image blob once and write all of the variants
+
+    Variants are dictionaries with path, fmt, dimension, composite and crop
+    keys (see image_io.store). Only gif outputs keep all frames of the input.
+    The blob is either a string or a file object.
+
+    Variants with source (see image_io._cascade) are resized from the image
+    of the source variant, computing the geometry from its size like
+    convert does.
+    """
+    if not Image:
+        raise PillowError("Pillow is not installed")
+
+    try:
+        if isinstance(blob, basestring):
+            blob = cStringIO.StringIO(blob)
+        blob.seek(0)
+        image = Image.open(blob)
+        size = image.size
+        info = dict(image.info)
+
+        # Shrink-on-load, JPEG is decoded directly to the smallest scale that
+        # is still larger than any of the requested sizes
+        if image.format == 'JPEG':
+            targets = [_target(size, variant) for variant in variants]
+            image.draft('RGB', (max([t[0] for t in targets]),
+                                max([t[1] for t in targets])))
+
+        first = None
+        frames = None
+        # Index of a variant -> its image, for variants with source
+        kept = {}
+        sources = set([variant.get('source') for variant in variants])
+        for i, variant in enumerate(variants):
+            if variant.get('source') is not None:
+                source = kept[variant['source']]
+                transformed = [_transform(source, source.size, variant)]
+            else:
+                if (os.path.splitext(variant['path'])[1] == '.gif' or
+                        variant.get('fmt') == 'gif'):
+                    if frames is None:
+                        frames = [frame.copy() for
+                                  frame in ImageSequence.Iterator(image)]
+                    source = frames
+                else:
+                    if first is None:
+                        image.seek(0)
+                        image.load()
+                        first = image.copy()
+                    source = [first]
+                transformed = [_transform(frame, size, variant) for
+                               frame in source]
+            if i in sources:
+                kept[i] = transformed[0]
+
+            _save(transformed, variant['path'], variant.get('fmt'), info)
+    except (IOError, ValueError, KeyError, EOFError) as e:
+        raise PillowError(str(e))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Named transformation presets"""
+
+from imagepipe import config
+from imagepipe import image_io
+
+
+class Preset(object):
+    """Sizes of a preset compiled once from the configuration
+
+    Variants are dictionaries with suffix, fmt, dimension, composite and
+    crop keys (see image_io.store) and magick, the convert arguments of the
+    transformation.
+    """
+
+    def __init__(self, name, variants):
+        self.name = name
+        self._variants = variants
+
+    def suffixes(self):
+        """Return the list of suffixes of the sizes"""
+        return [variant['suffix'] for variant in self._variants]
+
+    def variants(self, path):
+        """Return variants of the image at path for image_io.store_multi"""
+        variants = []
+        for variant in self._variants:
+            variant = dict(variant)
+            variant['path'] = image_io.suffixed_path(
+                path, variant.pop('suffix'), variant['fmt'])
+            variants.append(variant)
+        return variants
+
+
+def parse(value):
+    """Parse a size specification into a variant
+
+    The specification is WIDTHxHEIGHT optionally followed by composite or
+    crop and a format, e.g. 50x50 crop png.
+    """
+    variant = {'fmt': None, 'dimension': None, 'composite': 0, 'crop': 0}
+    for token in value.lower().split():
+        if token in ('composite', 'crop'):
+            if variant['composite'] or variant['crop']:
+                raise ValueError("Unexpected %s" % (token,))
+            variant[token] = 1
+        elif token[:1].isdigit():
+            if variant['dimension']:
+                raise ValueError("Unexpected %s" % (token,))
+            try:
+                (width, height) = token.split('x')
+                variant['dimension'] = [int(width), int(height)]
+            except ValueError:
+                raise ValueError("Invalid size %s" % (token,))
+        elif not variant['fmt']:
+            variant['fmt'] = token
+        else:
+            raise ValueError("Unexpected %s" % (token,))
+
+    if not variant['dimension']:
+        raise ValueError("Missing WIDTHxHEIGHT")
+    return variant
+
+
+def compile(settings):
+    """Return dictionary of Preset objects by name from settings"""
+    presets = {}
+    for name, sizes in settings['presets'].items():
+        variants = []
+        for suffix, value in sorted(sizes.items()):
+            try:
+                variant = parse(value)
+            except ValueError as e:
+                raise config.ValidationError(
+                    "Setting '[presets] -> [%s] -> %s': %s" % (
+                        name, suffix, e))
+            variant['suffix'] = suffix
+            variant['magick'] = image_io.transform_magick(variant)
+            variants.append(variant)
+
+        if not variants:
+            raise config.ValidationError("Section '[presets] -> [%s]' has no "
+                                         "sizes" % (name,))
+        presets[name] = Preset(name, variants)
+    return presets
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+
+"""Replication message encoding, sequencing and journal"""
+
+import collections
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+
+# Binary messages start with MAGIC, followed by the version, flags and the
+# length of the header
+MAGIC = '\xffIPM'
+VERSION = 1
+_PREFIX = struct.Struct('>BBI')
+
+# Flags of binary messages
+COMPRESSED = 1
+
+# Headers of binary messages larger than this (in bytes) are compressed, e.g.
+# the ones of batches of deletes and moves
+COMPRESS_SIZE = 1024
+
+
+class Error(Exception):
+    """Base class for replication errors"""
+    pass
+
+
+class JournalError(Error):
+    """Indicates a corrupted journal"""
+    pass
+
+
+class MessageError(Error):
+    """Indicates an invalid message"""
+    pass
+
+
+class Blob(str):
+    """Image data carried raw in a frame of its own by binary messages"""
+    pass
+
+
+def is_binary(data):
+    """Check if data (the first frame of a message) is a binary message"""
+    return data.startswith(MAGIC)
+
+
+def _extract(value, location, frames):
+    """Return value with Blobs replaced by None, appends (location, Blob) of
+    each one to frames"""
+    if isinstance(value, Blob):
+        frames.append((location, value))
+        return None
+    elif isinstance(value, (list, tuple)):
+        return [_extract(item, location + [i], frames) for
+                i, item in enumerate(value)]
+    elif isinstance(value, dict):
+        return dict([(key, _extract(item, location + [key], frames)) for
+                     key, item in value.items()])
+    return value
+
+
+def encode(message, compress_size=COMPRESS_SIZE):
+    """Encode a message dictionary as a list of frames
+
+    The first frame is the header: MAGIC, the version, flags and the message
+    JSON encoded (and compressed with zlib if larger than compress_size)
+    with every Blob in lists and dictionaries of it replaced by null. Each
+    Blob follows as a frame, the header lists their locations (indices and
+    keys from the message args) and sizes. Joined frames are a valid
+    message too, see decode.
+    """
+    frames = []
+    args = _extract(message.get('args', []), [], frames)
+    header = json.dumps(dict(message, args=args, frames=[
+        [location, len(blob)] for location, blob in frames]))
+
+    flags = 0
+    if len(header) > compress_size:
+        header = zlib.compress(header)
+        flags |= COMPRESSED
+
+    return ([MAGIC + _PREFIX.pack(VERSION, flags, len(header)) + header] +
+            [blob for location, blob in frames])
+
+
+def decode(parts):
+    """Decode a message from a list of frames, returns the message dictionary
+
+    This accepts binary messages either as frames (see encode) or joined into
+    one, and JSON encoded ones of older instances as the only frame. Image
+    data of binary messages is put back in place as Blobs.
+    """
+    data = parts[0]
+    if not is_binary(data):
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise MessageError("Invalid message")
+
+    offset = len(MAGIC) + _PREFIX.size
+    try:
+        (version, flags, size) = _PREFIX.unpack(data[len(MAGIC):offset])
+        if version != VERSION:
+            raise MessageError("Unsupported message version %d" % (
+                version,))
+        header = data[offset:offset + size]
+        if flags & COMPRESSED:
+            header = zlib.decompress(header)
+        message = json.loads(header)
+        if not isinstance(message.get('frames'), list):
+            raise ValueError()
+    except (struct.error, zlib.error, ValueError, AttributeError):
+        raise MessageError("Invalid message header")
+
+    frames = list(parts[1:])
+    if not frames:
+        # Joined, see Journal
+        offset += size
+        for location, length in message['frames']:
+            frames.append(data[offset:offset + length])
+            offset += length
+        if offset != len(data):
+            raise MessageError("Invalid message length")
+
+    if len(frames) != len(message['frames']):
+        raise MessageError("Invalid number of frames")
+    for (location, length), blob in zip(message.pop('frames'), frames):
+        if len(blob) != length or not location:
+            raise MessageError("Invalid frame")
+        try:
+            container = message['args']
+            for i in location[:-1]:
+                container = container[i]
+            container[location[-1]] = Blob(blob)
+        except (IndexError, KeyError, TypeError):
+            raise MessageError("Invalid frame location")
+    return message
+
+
+class Journal(object):
+    """Append-only log of published replication messages
+
+    Messages are appended to segment files (journal.NUMBER) as lines of the
+    publisher id, sequence number and the message as sent on the wire.
+    Binary messages (see encode) are stored joined after a line ending with
+    their length prefixed by #, followed by a newline. Once a
+    segment grows over max_size / 8 bytes a new one is started and the oldest
+    segments are removed while the journal is larger than max_size bytes or
+    older than max_age seconds.
+
+    Both own and received messages are appended, so any instance can replay
+    messages of others. Received messages are appended once applied, along
+    with positions (lines of the publisher id, sequence number and !) up to
+    which all messages of the publisher are, see Sequencer.applied. Every
+    segment starts with the last positions so they survive removal of old
+    segments. The directory also keeps the replication id of this instance.
+
+    The range of sequence numbers of every publisher in each segment is kept
+    in memory, so replay reads only segments holding requested messages.
+    Methods may be called from any thread.
+    """
+
+    def __init__(self, path, max_size, max_age):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self._segment = None
+        self._lock = threading.Lock()
+        # Segment number -> {publisher id: [lowest, highest sequence number]}
+        self._ranges = {}
+        self._positions = {}
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._state = self._scan()
+        segments = self._segments()
+        self._number = segments and segments[-1][0] + 1 or 1
+        self._rotate()
+
+    def _segments(self):
+        """Return sorted list of (number, path) of segment files"""
+        segments = []
+        for filename in os.listdir(self.path):
+            (prefix, dot, number) = filename.partition('.')
+            if prefix == 'journal' and number.isdigit():
+                segments.append((int(number),
+                                 os.path.join(self.path, filename)))
+        return sorted(segments)
+
+    def _scan(self):
+        """Read all segments, returns (last sequence numbers, sequence
+        numbers) of every publisher and records ranges and positions"""
+        seqs = {}
+        for number, message_id, seq, message in self._read(self._segments()):
+            if message is None:
+                self._positions[message_id] = max(
+                    self._positions.get(message_id, 0), seq)
+                continue
+            self._record(number, message_id, seq)
+            seqs.setdefault(message_id, set()).add(seq)
+        return seqs
+
+    def _record(self, number, message_id, seq):
+        """Extend the range of a publisher in segment number by seq"""
+        ranges = self._ranges.setdefault(number, {})
+        if message_id in ranges:
+            ranges[message_id][0] = min(ranges[message_id][0], seq)
+            ranges[message_id][1] = max(ranges[message_id][1], seq)
+        else:
+            ranges[message_id] = [seq, seq]
+
+    def _rotate(self):
+        """Start a new segment and remove expired ones"""
+        if self._segment:
+            self._segment.close()
+        self._segment = open(os.path.join(self.path, 'journal.%d' % (
+            self._number,)), 'ab')
+        self._number += 1
+        for message_id, position in sorted(self._positions.items()):
+            self._segment.write('%s %d !\n' % (message_id, position))
+        self._segment.flush()
+
+        segments = self._segments()[:-1]
+        size = sum([os.path.getsize(path) for number, path in segments])
+        for number, path in segments:
+            if (size <= self.max_size and
+                    os.path.getmtime(path) > time.time() - self.max_age):
+                break
+            size -= os.path.getsize(path)
+            os.unlink(path)
+            self._ranges.pop(number, None)
+
+    def append(self, replication_id, seq, parts, position=None):
+        """Append a message given as a list of frames, replication_id is the
+        publisher's id
+
+        The publisher's position is appended too if given, parts may be None
+        to append only that.
+        """
+        with self._lock:
+            if parts is None:
+                pass
+            elif is_binary(parts[0]):
+                self._segment.write('%s %d #%d\n' % (
+                    replication_id.hex, seq,
+                    sum([len(part) for part in parts])))
+                for part in parts:
+                    self._segment.write(part)
+                self._segment.write('\n')
+            else:
+                self._segment.write('%s %d %s\n' % (replication_id.hex, seq,
+                                                    parts[0]))
+            if parts is not None:
+                self._record(self._number - 1, replication_id.hex, seq)
+            if position is not None:
+                self._segment.write('%s %d !\n' % (replication_id.hex,
+                                                   position))
+                self._positions[replication_id.hex] = max(
+                    self._positions.get(replication_id.hex, 0), position)
+            self._segment.flush()
+
+            if self._segment.tell() > self.max_size / 8:
+                self._rotate()
+
+    def _read(self, segments):
+        """Iterate over (segment number, publisher id, sequence number,
+        message) of all messages in segments, oldest first; binary messages
+        are joined, the message of positions is None"""
+        for number, path in segments:
+            try:
+                segment = open(path, 'rb')
+            except IOError:
+                # Removed in the meantime
+                continue
+            try:
+                while True:
+                    line = segment.readline()
+                    if not line.endswith('\n'):
+                        # Being written
+                        break
+                    try:
+                        (replication_id, seq, message) = line.split(' ', 2)
+                        seq = int(seq)
+                        if message == '!\n':
+                            message = None
+                        elif message.startswith('#'):
+                            size = int(message[1:])
+                            message = segment.read(size + 1)
+                            if len(message) < size + 1:
+                                # Being written
+                                break
+                    except ValueError:
+                        raise JournalError("Invalid line in %s" % (path,))
+                    yield (number, replication_id, seq,
+                           message and message[:-1])
+            finally:
+                segment.close()
+
+    def replay(self, replication_id, first, last=None, limit=None):
+        """Return messages of a publisher with sequence numbers from first to
+        last (inclusive, no upper bound if None) that are still in the
+        journal, at most limit ones
+
+        This reads segments and should not be called from the reactor thread.
+        """
+        with self._lock:
+            segments = []
+            for number, path in self._segments():
+                seqs = self._ranges.get(number, {}).get(replication_id.hex)
+                if (seqs and seqs[1] >= first and
+                        (last is None or seqs[0] <= last)):
+                    segments.append((number, path, seqs[0]))
+
+        messages = {}
+        for number, path, lowest in segments:
+            # Sequence numbers grow with segments, but messages received
+            # concurrently are appended as they are applied
+            if limit and len(messages) >= limit and (
+                    lowest > sorted(messages)[limit - 1]):
+                break
+            for segment_number, message_id, seq, message in self._read(
+                    [(number, path)]):
+                if (message is not None and
+                        message_id == replication_id.hex and seq >= first and
+                        (last is None or seq <= last) and
+                        seq not in messages):
+                    messages[seq] = message
+        return [messages[seq] for seq in sorted(messages)[:limit]]
+
+    def recover(self):
+        """Return (last sequence numbers, positions, applied sequence
+        numbers) of every publisher in the journal as dictionaries
+
+        Applied sequence numbers are sets of the ones from the position on,
+        positions are missing for publishers journaled by older versions.
+        This is available once, after opening the journal.
+        """
+        seqs = self._state
+        self._state = None
+        (last_seqs, positions, applied) = ({}, {}, {})
+        for message_id, numbers in seqs.items():
+            last_seqs[uuid.UUID(hex=message_id)] = max(numbers)
+        for message_id, position in self._positions.items():
+            replication_id = uuid.UUID(hex=message_id)
+            positions[replication_id] = position
+            applied[replication_id] = set([
+                seq for seq in seqs.get(message_id, ()) if seq >= position])
+        return (last_seqs, positions, applied)
+
+    def identity(self):
+        """Return the persistent replication id of this instance"""
+        path = os.path.join(self.path, 'id')
+        if os.path.exists(path):
+            return uuid.UUID(hex=open(path).read().strip())
+
+        replication_id = uuid.uuid4()
+        open(path, 'w').write(replication_id.hex + '\n')
+        return replication_id
+
+    def close(self):
+        """Close the current segment"""
+        with self._lock:
+            self._segment.close()
+
+
+class Sequencer(object):
+    """Numbers published messages and detects duplicates of received ones
+
+    Each instance publishes its messages under an unique id with increasing
+    sequence numbers. Instances subscribed to multiple peers receive the same
+    message more than once, the (id, sequence number) pairs of the last
+    window messages of every publisher are kept to skip them.
+
+    Messages received through different peers may arrive out of order, the
+    sequence number of the last message on each of the last window paths of
+    every publisher is kept to skip older ones (see superseded).
+
+    Positions, the next sequence number expected from every publisher, are
+    used to detect lost messages. Received messages are applied concurrently,
+    so the sequence number up to which all messages of every publisher are
+    applied is tracked separately (see applied). With a journal the id,
+    sequence numbers and positions are restored from it after restarts:
+    positions are the ones all messages are applied up to, messages applied
+    after them count as received already.
+    """
+
+    def __init__(self, window=10000, journal=None):
+        self.window = window
+        self.journal = journal
+        self._seen = {}
+        # Publisher id -> ordered {path: sequence number of last message}
+        self._last = {}
+        # Publisher id -> [position, set of applied sequence numbers past it]
+        self._applied = {}
+
+        if journal:
+            self.id = journal.identity()
+            (seqs, positions, applied) = journal.recover()
+            self._seq = itertools.count(seqs.pop(self.id, 0) + 1)
+            self.positions = dict([(replication_id, seq + 1) for
+                                   replication_id, seq in seqs.items()])
+            self.positions.update(positions)
+            for replication_id, position in self.positions.items():
+                self._applied[replication_id] = [position, set()]
+                for seq in sorted(applied.get(replication_id, ())):
+                    self.seen(replication_id, seq)
+                    self.applied(replication_id, seq)
+        else:
+            self.id = uuid.uuid4()
+            self._seq = itertools.count(1)
+            self.positions = {}
+
+    def next_seq(self):
+        """Return sequence number for the next published message"""
+        return next(self._seq)
+
+    def seen(self, replication_id, seq):
+        """Check if a message was already received and remember it"""
+        if replication_id not in self._seen:
+            self._seen[replication_id] = (set(), collections.deque())
+        (seqs, order) = self._seen[replication_id]
+
+        if seq in seqs:
+            return True
+
+        seqs.add(seq)
+        order.append(seq)
+        if len(order) > self.window:
+            seqs.discard(order.popleft())
+        return False
+
+    def superseded(self, replication_id, seq, paths):
+        """Check if later messages of the publisher on every one of paths
+        were received already, otherwise remember this one as the last on
+        them
+
+        Applying such a message would undo the later ones. Messages on
+        several paths are applied if any of them is not superseded.
+        """
+        last = self._last.setdefault(replication_id,
+                                     collections.OrderedDict())
+        if paths and min([last.get(path, 0) for path in paths]) > seq:
+            return True
+
+        for path in paths:
+            if last.get(path, 0) < seq:
+                last.pop(path, None)
+                last[path] = seq
+        while len(last) > self.window:
+            last.popitem(False)
+        return False
+
+    def advance(self, replication_id, seq):
+        """Move publisher's position past a received message
+
+        Returns (first, last) sequence numbers of messages lost before this
+        one or None.
+        """
+        expected = self.positions.get(replication_id)
+        self.positions[replication_id] = max(expected, seq + 1)
+        if replication_id not in self._applied:
+            self._applied[replication_id] = [seq, set()]
+        if expected is not None and seq > expected:
+            return (expected, seq - 1)
+        return None
+
+    def applied(self, replication_id, first, last=None):
+        """Record received messages from first to last (only first if None)
+        as applied, or lost for good
+
+        Returns the publisher's new position if all messages before it are
+        applied now, None if it did not move.
+        """
+        if replication_id not in self._applied:
+            self._applied[replication_id] = [first, set()]
+        (position, seqs) = self._applied[replication_id]
+
+        seqs.update(xrange(max(first, position),
+                           (last is None and first or last) + 1))
+        if position not in seqs:
+            return None
+        while position in seqs:
+            seqs.remove(position)
+            position += 1
+        self._applied[replication_id][0] = position
+        return position
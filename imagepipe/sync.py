@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+"""Synchronize the image tree with another instance
+
+This compares the tree index (see index.TreeIndex) with the one of a running
+instance top-down, over its replay endpoint, and transfers only images from
+directories whose digests differ.
+
+    imagepipe-sync -c imagepipe.ini rebuild
+    imagepipe-sync -c imagepipe.ini verify tcp://10.0.0.2:8087
+    imagepipe-sync -c imagepipe.ini pull tcp://10.0.0.2:8087
+
+With images.roots it also moves images to the roots they are placed on, see
+image_io.Shards.rebalance:
+
+    imagepipe-sync -c imagepipe.ini rebalance
+"""
+
+import json
+import os
+import sys
+import time
+import uuid
+from optparse import OptionParser
+
+import zmq
+
+from imagepipe import config
+from imagepipe import image_io
+from imagepipe import index
+
+
+class Error(Exception):
+    """Base class for synchronization errors"""
+    pass
+
+
+class PeerError(Error):
+    """Indicates failed requests to the peer"""
+    pass
+
+
+class Peer(object):
+    """Client of the replay endpoint of another instance"""
+
+    def __init__(self, endpoint, timeout):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(endpoint)
+
+    def request(self, method, paths):
+        """Send a request and return parts of the reply"""
+        message_id = uuid.uuid4().bytes
+        self._socket.send_multipart([message_id, '', json.dumps(
+            {'method': method, 'paths': paths})])
+
+        while True:
+            if not self._socket.poll(self.timeout * 1000):
+                raise PeerError("No reply from %s" % (self.endpoint,))
+            reply = self._socket.recv_multipart()
+            if reply[0] == message_id:
+                break
+
+        if reply[2] != 'OK':
+            raise PeerError("Request failed, see log of %s" % (
+                self.endpoint,))
+        return reply[3:]
+
+    def tree(self, paths):
+        """Return dictionary of entries of directories"""
+        tree = json.loads(self.request('tree', paths)[0])
+        # Local paths are UTF-8 encoded
+        return dict([(path.encode('utf-8'),
+                      [[name.encode('utf-8'), digest, is_dir] for
+                       name, digest, is_dir in entries]) for
+                     path, entries in tree.items()])
+
+    def files(self, paths):
+        """Return list of (data, mode) of images, None for missing ones"""
+        parts = self.request('files', paths)
+        images = iter(parts[1:])
+        return [mode is not None and (next(images), mode) or None for
+                mode in json.loads(parts[0])]
+
+    def close(self):
+        """Close the connection"""
+        self._socket.close()
+        self._context.term()
+
+
+class Progress(object):
+    """Prints progress and throughput to stderr once a second"""
+
+    def __init__(self):
+        self.dirs = 0
+        self.files = 0
+        self.bytes = 0
+        self.deleted = 0
+        self._start = time.time()
+        self._printed = self._start
+
+    def report(self, force=False):
+        """Print progress unless printed less than a second ago"""
+        now = time.time()
+        if not force and now - self._printed < 1:
+            return
+        self._printed = now
+
+        elapsed = max(now - self._start, 0.001)
+        sys.stderr.write(
+            "%d dir(s) compared, %d file(s) transferred (%.1f MB, %.1f MB/s, "
+            "%.1f files/s), %d file(s) deleted\n" % (
+                self.dirs, self.files, self.bytes / 1048576.0,
+                self.bytes / 1048576.0 / elapsed, self.files / elapsed,
+                self.deleted))
+
+
+def _files(tree_index, path):
+    """Return paths of all files in the directory path of the index"""
+    files = []
+    for name, digest, is_dir in tree_index.entries(path):
+        if is_dir:
+            files.extend(_files(tree_index, os.path.join(path, name)))
+        else:
+            files.append(os.path.join(path, name))
+    return files
+
+
+def compare(tree_index, peer, progress, batch=100):
+    """Compare the index with the peer's one top-down
+
+    Yields ('+', path) for images missing or differing locally and
+    ('-', path) for images missing at the peer, directories with equal
+    digests are skipped.
+    """
+    queue = ['']
+    while queue:
+        paths = queue[:batch]
+        del queue[:batch]
+
+        remote = peer.tree(paths)
+        for path in paths:
+            local = dict([(entry[0], entry) for entry in
+                          tree_index.entries(path)])
+            for name, digest, is_dir in remote[path]:
+                child = os.path.join(path, name)
+                entry = local.pop(name, None)
+                if entry == [name, digest, is_dir]:
+                    continue
+                if entry and entry[2] and not is_dir:
+                    for extra in _files(tree_index, child):
+                        yield ('-', extra)
+                elif entry and not entry[2] and is_dir:
+                    yield ('-', child)
+                if is_dir:
+                    queue.append(child)
+                else:
+                    yield ('+', child)
+
+            for name, digest, is_dir in local.values():
+                if is_dir:
+                    for extra in _files(tree_index, os.path.join(path, name)):
+                        yield ('-', extra)
+                else:
+                    yield ('-', os.path.join(path, name))
+
+            progress.dirs += 1
+            progress.report()
+
+
+def _shards(settings):
+    """Return image_io.Shards of images.roots, None without them"""
+    if not settings['images']['roots']:
+        return None
+    return image_io.Shards([settings['images']['path']] +
+                           settings['images']['roots'])
+
+
+def _fetch(settings, tree_index, shards, peer, paths, progress):
+    """Store images from the peer locally"""
+    root = settings['images']['path']
+    for path, image in zip(paths, peer.files(paths)):
+        if not image:
+            # Removed in the meantime
+            continue
+        (data, mode) = image
+        image_io.store(data, os.path.join(root, path),
+                       umask=settings['images']['umask'], mode=mode,
+                       index=tree_index, shards=shards)
+        progress.files += 1
+        progress.bytes += len(data)
+        progress.report()
+
+
+def sync(settings, tree_index, peer, pull=False, delete=False, batch=100,
+         shards=None):
+    """Compare the image tree with the peer's one
+
+    Differences are printed to stdout. If pull is true missing and differing
+    images are transferred from the peer and, if delete is true, images
+    missing at the peer are deleted, placed by shards if given (see
+    _shards). Returns the number of differences.
+    """
+    root = settings['images']['path']
+    progress = Progress()
+    differences = 0
+    fetched = []
+
+    for action, path in compare(tree_index, peer, progress, batch):
+        differences += 1
+        print '%s %s' % (action, path)
+
+        if pull and action == '+':
+            fetched.append(path)
+            if len(fetched) >= batch:
+                _fetch(settings, tree_index, shards, peer, fetched,
+                       progress)
+                fetched = []
+        elif pull and delete:
+            image_io.delete(os.path.join(root, path), tree_index,
+                            shards=shards)
+            progress.deleted += 1
+
+    if fetched:
+        _fetch(settings, tree_index, shards, peer, fetched, progress)
+
+    progress.report(True)
+    return differences
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage='usage: %prog [options] rebuild | verify '
+                          'ENDPOINT | pull ENDPOINT | rebalance')
+    parser.add_option('-c', '--conf', dest='conf', default='imagepipe.ini',
+                      help='configuration file (default: %default)',
+                      metavar='PATH')
+    parser.add_option('-d', '--delete', dest='delete', action='store_true',
+                      default=False, help='delete images missing at the peer '
+                      'when pulling')
+    parser.add_option('-b', '--batch', dest='batch', type='int', default=100,
+                      help='directories or images per request (default: '
+                      '%default)', metavar='N')
+    parser.add_option('-t', '--timeout', dest='timeout', type='float',
+                      default=60, help='seconds to wait for replies '
+                      '(default: %default)', metavar='SECONDS')
+
+    (options, args) = parser.parse_args()
+
+    if (not args or args[0] not in ('rebuild', 'verify', 'pull',
+                                    'rebalance') or
+            len(args) != (args[0] in ('rebuild', 'rebalance') and 1 or 2)):
+        parser.print_help()
+        sys.exit(1)
+
+    settings = config.read(options.conf)
+    config.check(settings)
+    shards = _shards(settings)
+    if args[0] == 'rebalance':
+        if not shards:
+            sys.exit("There are no roots to rebalance, see images.roots")
+        start = time.time()
+        printed = [0]
+
+        def progress(checked, moved, removed):
+            now = time.time()
+            if now - printed[0] >= 1:
+                printed[0] = now
+                sys.stderr.write("%d file(s) checked, %d moved, %d removed "
+                                 "(%.1f files/s)\n" % (
+                                     checked, moved, removed,
+                                     checked / max(now - start, 0.001)))
+
+        try:
+            (moved, removed) = shards.rebalance(progress)
+        except image_io.LockedError as e:
+            sys.exit(str(e))
+        sys.stderr.write("%d file(s) moved, %d removed\n" % (moved, removed))
+        return
+
+    if not settings['images']['index']:
+        sys.exit("The index is not enabled, see images.index")
+
+    # Rebuilding reads the whole tree, so no service may store images
+    # meanwhile, pulling stores them like one
+    lock = None
+    if shards and args[0] != 'verify':
+        try:
+            lock = shards.lock(exclusive=args[0] == 'rebuild')
+        except image_io.LockedError as e:
+            sys.exit(str(e))
+
+    tree_index = index.TreeIndex(settings['images']['index'],
+                                 settings['images']['path'])
+    try:
+        if args[0] == 'rebuild':
+            start = time.time()
+            printed = [0]
+
+            def progress(count, force=False):
+                now = time.time()
+                if force or now - printed[0] >= 1:
+                    printed[0] = now
+                    sys.stderr.write("%d file(s) indexed (%.1f files/s)\n" % (
+                        count, count / max(now - start, 0.001)))
+
+            progress(tree_index.rebuild(progress), True)
+            return
+
+        peer = Peer(args[1], options.timeout)
+        try:
+            differences = sync(settings, tree_index, peer,
+                               args[0] == 'pull', options.delete,
+                               options.batch, shards)
+        except PeerError as e:
+            sys.exit(str(e))
+        finally:
+            peer.close()
+
+        if args[0] == 'verify' and differences:
+            sys.exit(2)
+    finally:
+        tree_index.close()
+        if lock is not None:
+            os.close(lock)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""Long-lived conversion workers
+
+Converting through a worker avoids forking the (large) service process for
+every convert call. Workers are small helper processes started with
+`python -m imagepipe.workers` which receive jobs over their stdin and send
+results back over their stdout, both pickled. Workers also run conversions of
+the Pillow engine, keeping their memory use apart from the service.
+"""
+
+import cPickle
+import os
+import Queue
+import resource
+import subprocess
+import sys
+import threading
+
+from twisted.python import log
+
+from imagepipe import image_io
+from imagepipe import pillow_io
+
+
+class Error(Exception):
+    """Base class for worker errors"""
+    pass
+
+
+class WorkerError(Error):
+    """Indicates a worker failure unrelated to the conversion itself"""
+    pass
+
+
+class Worker(object):
+    """Helper process executing conversions"""
+
+    def __init__(self):
+        # Make sure the worker imports the same imagepipe package
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            filter(None, [env.get('PYTHONPATH')]))
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'imagepipe.workers'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True,
+            env=env)
+        self.jobs = 0
+        self.rss = 0
+
+    def call(self, job):
+        """Send a job to the worker and return the reply"""
+        try:
+            cPickle.dump(job, self._process.stdin, cPickle.HIGHEST_PROTOCOL)
+            self._process.stdin.flush()
+            (status, result, self.rss) = cPickle.load(self._process.stdout)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            raise WorkerError("Worker %d exited unexpectedly" % (
+                self._process.pid,))
+        self.jobs += 1
+        return (status, result)
+
+    def stop(self):
+        """Stop the worker by closing its stdin"""
+        try:
+            self._process.stdin.close()
+            self._process.wait()
+        except (IOError, OSError):
+            pass
+
+
+class WorkerPool(object):
+    """A fixed number of pre-spawned workers
+
+    Workers are replaced after max_jobs jobs or if their maximum resident set
+    size, or the one of any convert they ran, exceeds max_rss megabytes.
+    """
+
+    def __init__(self, size, max_jobs=1000, max_rss=256):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self._idle = Queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        for i in xrange(size):
+            self._idle.put(Worker())
+
+    def _release(self, worker, failed=False):
+        """Return the worker to the pool, replacing it if needed"""
+        with self._lock:
+            if self._stopped:
+                worker.stop()
+                return
+
+            if (failed or worker.jobs >= self.max_jobs or
+                    worker.rss > self.max_rss * 1024):
+                log.msg("Recycling worker after %d job(s), %d kB rss" % (
+                    worker.jobs, worker.rss))
+                worker.stop()
+                worker = Worker()
+
+            self._idle.put(worker)
+
+    def _call(self, job):
+        """Execute a job in one of the workers
+
+        This blocks until a worker is available and raises the same errors as
+        a local call would.
+        """
+        worker = self._idle.get()
+        try:
+            (status, result) = worker.call(job)
+        except WorkerError:
+            self._release(worker, True)
+            raise
+        self._release(worker)
+
+        if status == 'imagemagick':
+            raise image_io.ImageMagickError(*result)
+        elif status == 'pillow':
+            raise pillow_io.PillowError(*result)
+        elif status == 'error':
+            raise WorkerError(result)
+
+    def convert(self, blob, magick, env):
+        """Execute convert in one of the workers"""
+        self._call(('convert', blob, magick, dict(env or {})))
+
+    def pillow(self, blob, variants):
+        """Execute a Pillow conversion in one of the workers"""
+        self._call(('pillow', blob, variants))
+
+    def shutdown(self):
+        """Stop all idle workers, busy ones are stopped once released"""
+        with self._lock:
+            self._stopped = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except Queue.Empty:
+                break
+
+
+def _rss():
+    """Return the maximum resident set size of this process or any of its
+    finished children, i.e. convert, in kilobytes"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def main():
+    """Worker loop, reads jobs until stdin is closed"""
+    stdin = sys.stdin
+    stdout = sys.stdout
+    # Anything printed by accident must not corrupt the replies
+    sys.stdout = sys.stderr
+
+    while True:
+        try:
+            job = cPickle.load(stdin)
+        except EOFError:
+            break
+
+        (method, args) = (job[0], job[1:])
+        try:
+            if method == 'convert':
+                reply = ('ok', image_io._imagemagick_convert(*args))
+            elif method == 'pillow':
+                reply = ('ok', pillow_io.convert(*args))
+            else:
+                reply = ('error', "Unknown job %s" % (method,))
+        except image_io.ImageMagickError as e:
+            reply = ('imagemagick', e.args)
+        except pillow_io.PillowError as e:
+            reply = ('pillow', e.args)
+        except Exception as e:
+            reply = ('error', "%s: %s" % (e.__class__.__name__, e))
+
+        cPickle.dump(reply + (_rss(),), stdout, cPickle.HIGHEST_PROTOCOL)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
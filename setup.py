@@ -11,7 +11,11 @@ setup(name='imagepipe',
       data_files=[
           ('twisted/plugins', ['twisted/plugins/imagepipe_plugin.py'])
       ],
-      install_requires=['configobj', 'pyzmq', 'Twisted', 'txzmq', 'Unidecode'])
+      install_requires=['configobj', 'pyzmq', 'Twisted', 'txzmq', 'Unidecode'],
+      extras_require={'pillow': ['Pillow']},
+      entry_points={
+          'console_scripts': ['imagepipe-sync = imagepipe.sync:main']
+      })
 
 # Refresh Twisted plugin cache
 from twisted.plugin import IPlugin, getPlugins
@@ -7,6 +7,7 @@ SOURCEDIR="`cd \`dirname $0\`/..; pwd`"  # Directory containing the twistd plugi
 TMPDIR="/tmp/imagepipe"  # Temporary directory; removed at the end of script!
 INSTANCES=1  # How many instances of the server should be spawned
 IO_THREADS=1  # How many io threads per instance
+ENGINE=convert  # Conversion engine, convert or pillow
 TIME=60  # Test duration, see `ab -t`
 CONCURRENCY=100  # Number of simulated clients, see `ab -c`
 IMAGE="$1"  # Test image
@@ -50,7 +51,8 @@ for i in `seq $INSTANCES`; do
         fi
     fi
 
-    write_config $config $port $publish_port $subscribe_port $rundir $IO_THREADS || \
+    write_config $config $port $publish_port $subscribe_port $rundir $IO_THREADS \
+        $ENGINE || \
         fail "unable to write ${config}"
 
     status "Starting twistd instance $i (127.0.0.1:${port})"
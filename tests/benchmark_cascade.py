@@ -0,0 +1,95 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Compare resizing every variant from the original with a cascade
+
+This calls image_io.store_multi directly (no service, no replication) with
+and without cascade, meant for multi-megapixel JPEG inputs, and reports how
+much the cascaded variants differ from the ones resized from the original
+(requires Pillow).
+"""
+
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import functions
+from imagepipe import image_io
+from imagepipe import pillow_io
+
+
+def run(cascade, blob, name, root, options):
+    """Return the average time of storing the variants under root"""
+    start = time.time()
+    for i in xrange(options.iterations):
+        image_io.store_multi(blob, functions.variants(root, name),
+                             convert=options.convert, engine=options.engine,
+                             cascade=cascade)
+    return (time.time() - start) / options.iterations
+
+
+def difference(path_a, path_b):
+    """Return sizes of two images and their PSNR in dB, None if the sizes
+    differ"""
+    image_a = pillow_io.Image.open(path_a).convert('RGBA')
+    image_b = pillow_io.Image.open(path_b).convert('RGBA')
+    if image_a.size != image_b.size:
+        return (image_a.size, image_b.size, None)
+
+    squares = 0
+    for a, b in zip(image_a.getdata(), image_b.getdata()):
+        squares += sum([(x - y) ** 2 for x, y in zip(a, b)])
+    mse = float(squares) / (image_a.size[0] * image_a.size[1] * 4)
+    if not mse:
+        return (image_a.size, image_b.size, float('inf'))
+    return (image_a.size, image_b.size, 10 * math.log10(255 ** 2 / mse))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] image')
+    functions.add_convert_option(parser)
+    parser.add_option('-e', '--engine', dest='engine', default='convert',
+                      help='convert or pillow (default: %default)',
+                      metavar='ENGINE')
+    parser.add_option('-n', '--iterations', dest='iterations', type='int',
+                      default=10, help='iterations (default: %default)',
+                      metavar='N')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or options.engine not in ('convert', 'pillow'):
+        parser.print_help()
+        sys.exit(1)
+
+    blob = open(args[0], 'rb').read()
+    name = os.path.basename(args[0])
+
+    direct_root = tempfile.mkdtemp(prefix='imagepipe-')
+    cascade_root = tempfile.mkdtemp(prefix='imagepipe-')
+    try:
+        direct = run(False, blob, name, direct_root, options)
+        print "from original: %.3fs per upload" % (direct,)
+        cascaded = run(True, blob, name, cascade_root, options)
+        print "cascade:       %.3fs per upload" % (cascaded,)
+        print "speedup:       %.2fx" % (direct / cascaded,)
+
+        if pillow_io.Image:
+            print
+            print "%-20s %-12s %-12s %s" % ('variant', 'original', 'cascade',
+                                            'PSNR')
+            for a, b in zip(functions.variants(direct_root, name),
+                            functions.variants(cascade_root, name)):
+                (size_a, size_b, psnr) = difference(a['path'], b['path'])
+                print "%-20s %-12s %-12s %s" % (
+                    os.path.basename(a['path']), '%dx%d' % size_a,
+                    '%dx%d' % size_b,
+                    psnr is None and 'size differs' or '%.1f dB' % (psnr,))
+    finally:
+        shutil.rmtree(direct_root)
+        shutil.rmtree(cascade_root)
@@ -0,0 +1,121 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Compare convert with and without the JPEG decode size hint
+
+For each input resolution a JPEG is generated (requires Pillow) and all
+variants are written by a single convert call as built by image_io, once as
+is and once without the -define jpeg:size hint. Reports the average latency
+and the peak memory (maximum resident set size) of convert.
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import functions
+from imagepipe import image_io
+from imagepipe import pillow_io
+
+
+VARIANTS = [
+    ('_large', [800, 800], 0, 0),
+    ('_medium', [400, 400], 0, 0),
+    ('_thumb', [100, 100], 0, 1),
+]
+
+
+def generate(width, height):
+    """Return a JPEG image of width x height with some detail"""
+    image = pillow_io.Image.new('RGB', (width / 16, height / 16))
+    image.putdata([(random.randint(0, 255), random.randint(0, 255),
+                    random.randint(0, 255)) for
+                   i in xrange(image.size[0] * image.size[1])])
+    image = image.resize((width, height), pillow_io.Image.BICUBIC)
+
+    output = tempfile.NamedTemporaryFile(suffix='.jpg')
+    try:
+        image.save(output, 'JPEG', quality=90)
+        output.seek(0)
+        return output.read()
+    finally:
+        output.close()
+
+
+def command(convert, root, hint):
+    """Return the convert command, without the decode hint unless hint"""
+    variants = [{'path': os.path.join(root, 'image%s.jpg' % (suffix,)),
+                 'dimension': dimension, 'composite': composite,
+                 'crop': crop} for
+                suffix, dimension, composite, crop in VARIANTS]
+    cmd = image_io._multi_magick(convert, '-', variants)
+    if not hint and '-define' in cmd:
+        i = cmd.index('-define')
+        del cmd[i:i + 2]
+    return cmd
+
+
+def run(cmd, blob):
+    """Return seconds and peak memory in MB of one convert call"""
+    start = time.time()
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    process.stdin.write(blob)
+    process.stdin.close()
+    (pid, status, usage) = os.wait4(process.pid, 0)
+    if status:
+        raise RuntimeError("%s failed with status %d" % (cmd[0], status))
+    # ru_maxrss is in kilobytes on Linux
+    return (time.time() - start, usage.ru_maxrss / 1024.0)
+
+
+def measure(cmd, blob, iterations):
+    """Return average seconds and maximum peak memory of iterations"""
+    results = [run(cmd, blob) for i in xrange(iterations)]
+    return (sum([seconds for seconds, memory in results]) / iterations,
+            max([memory for seconds, memory in results]))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] [WIDTHxHEIGHT ...]')
+    functions.add_convert_option(parser)
+    parser.add_option('-n', '--iterations', dest='iterations', type='int',
+                      default=5, help='iterations (default: %default)',
+                      metavar='N')
+
+    (options, args) = parser.parse_args()
+
+    try:
+        resolutions = [[int(value) for value in arg.split('x')] for
+                       arg in args or ['2000x1500', '4000x3000', '6000x4000',
+                                       '8000x6000']]
+    except ValueError:
+        parser.print_help()
+        sys.exit(1)
+    if not pillow_io.Image:
+        sys.exit("Pillow is required to generate the input images")
+
+    root = tempfile.mkdtemp(prefix='imagepipe-')
+    try:
+        print "%-12s %-10s %-10s %-10s %-10s %s" % (
+            'input', 'full', 'hint', 'full', 'hint', 'speedup')
+        for width, height in resolutions:
+            blob = generate(width, height)
+            (full, full_memory) = measure(command(options.convert, root,
+                                                  False),
+                                          blob, options.iterations)
+            (hint, hint_memory) = measure(command(options.convert, root,
+                                                  True),
+                                          blob, options.iterations)
+            print "%-12s %-10s %-10s %-10s %-10s %.2fx" % (
+                '%dx%d' % (width, height), '%.3fs' % (full,),
+                '%.3fs' % (hint,), '%.0f MB' % (full_memory,),
+                '%.0f MB' % (hint_memory,), full / hint)
+    finally:
+        shutil.rmtree(root)
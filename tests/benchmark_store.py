@@ -0,0 +1,68 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Compare storing variants one convert call at a time with a single call
+
+This calls image_io directly (no service, no replication) and stores the
+five-variant size dictionary used by most uploads with both methods.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import functions
+from imagepipe import image_io
+
+
+def per_variant(blob, root, name, convert):
+    """Store variants the way image_service did before store_multi"""
+    for variant in functions.variants(root, name):
+        image_io.store(blob, convert=convert, **variant)
+
+
+def single_decode(blob, root, name, convert):
+    """Store variants with a single convert call"""
+    image_io.store_multi(blob, functions.variants(root, name),
+                         convert=convert)
+
+
+def run(method, blob, name, convert, iterations):
+    """Return the average time of iterations method calls"""
+    root = tempfile.mkdtemp(prefix='imagepipe-')
+    try:
+        start = time.time()
+        for i in xrange(iterations):
+            method(blob, root, name, convert)
+        return (time.time() - start) / iterations
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] image')
+    functions.add_convert_option(parser)
+    parser.add_option('-n', '--iterations', dest='iterations', type='int',
+                      default=20, help='iterations (default: %default)',
+                      metavar='N')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    blob = open(args[0], 'rb').read()
+    name = os.path.basename(args[0])
+
+    loop = run(per_variant, blob, name, options.convert, options.iterations)
+    print "per variant:   %.3fs per upload" % (loop,)
+    single = run(single_decode, blob, name, options.convert,
+                 options.iterations)
+    print "single decode: %.3fs per upload" % (single,)
+    print "speedup:       %.2fx" % (loop / single,)
@@ -0,0 +1,435 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Benchmark a matrix of cluster configurations and report JSON
+
+For every combination of io_threads, payload size, number of variants and
+mode this starts the given number of instances, twistd subprocesses or
+ImageService instances within this process (--in-process), replicating in a
+ring (each one subscribes to its predecessor and forwards messages) or a
+fan-out (all subscribe to the first one). Concurrent clients store images on
+the first instance, then the time until all of them are present on the other
+instances is measured.
+
+Throughput, latency percentiles, peak RSS and replication convergence time
+of every case are printed as JSON (or written to --output), progress goes to
+stderr.
+
+By default convert is tests/fake_convert.py, writing the image unchanged
+after a fixed delay per image (--delay), and payloads are generated bytes of
+the given sizes, so results of CI runs are comparable between commits. Give
+image files as arguments and --convert /usr/bin/convert to benchmark
+ImageMagick.
+"""
+
+import base64
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+from optparse import OptionParser
+
+SOURCEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+sys.path.insert(0, SOURCEDIR)
+
+import functions
+
+CONFIG = """[network]
+interface = 127.0.0.1
+port = %(port)d
+[replication]
+publish = tcp://127.0.0.1:%(publish_port)d
+%(subscribe)s
+forward = %(forward)s
+[images]
+path = %(path)s
+io_threads = %(io_threads)d
+queue_depth = %(queue_depth)d
+[imagemagick]
+convert = %(convert)s
+[[env]]
+MAGICK_THREAD_LIMIT = 1
+FAKE_CONVERT_DELAY = %(delay)s
+"""
+
+MODES = ('resize', 'composite', 'crop')
+
+
+def _list(option, parse=int):
+    """Parse a comma separated option value"""
+    return [parse(value) for value in option.split(',') if value]
+
+
+def payloads(args, sizes):
+    """Return list of (name, image data) to store
+
+    Image files given as arguments are used as they are, otherwise payloads
+    of the given sizes in kilobytes are generated. Generated payloads start
+    with a marker so they are never taken for a known image format (see
+    image_io.probe).
+    """
+    if args:
+        return [(os.path.basename(path), open(path, 'rb').read()) for
+                path in args]
+
+    generator = random.Random(0)
+    return [('%dk' % (size,), 'IMAGEPIPE-BENCHMARK' + ''.join(
+        [chr(generator.randint(0, 255)) for i in xrange(size * 1024)])) for
+            size in sizes]
+
+
+def sizes(variants):
+    """Return a size dictionary of the given number of variants, halving the
+    dimensions of each one"""
+    return dict([(i and '_%d' % (i,) or '', [max(1600 >> i, 16)] * 2) for
+                 i in xrange(variants)])
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def configure(root, case, options):
+    """Write configuration of all instances, returns list of (configuration
+    path, images path, port)"""
+    instances = []
+    for i in xrange(1, options.instances + 1):
+        rundir = os.path.join(root, str(i))
+        os.makedirs(os.path.join(rundir, 'images'))
+
+        if i == 1 and options.topology == 'fanout':
+            peers = []
+        elif options.topology == 'fanout':
+            peers = [1]
+        else:
+            peers = [n for n in [i == 1 and options.instances or i - 1] if
+                     n != i]
+
+        config = os.path.join(rundir, 'imagepipe.ini')
+        open(config, 'w').write(CONFIG % {
+            'port': options.port + i,
+            'publish_port': options.port + 1000 + i,
+            'subscribe': peers and 'subscribe = %s' % (', '.join(
+                ['tcp://127.0.0.1:%d' % (options.port + 1000 + n,) for
+                 n in peers]),) or '',
+            'forward': options.topology == 'ring' and 'true' or 'false',
+            'path': os.path.join(rundir, 'images'),
+            'io_threads': case['io_threads'],
+            'queue_depth': options.concurrency * 2,
+            'convert': options.convert,
+            'delay': options.delay})
+        instances.append((config, os.path.join(rundir, 'images'),
+                          options.port + i))
+    return instances
+
+
+def _wait_listening(port, timeout):
+    """Wait until a server accepts connections on port"""
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("Instance on port %d did not start" % (port,))
+
+
+class SubprocessCluster(object):
+    """Instances running as twistd processes"""
+
+    def __init__(self, root, instances, options):
+        self.root = root
+        self.instances = instances
+        self.options = options
+        self.processes = []
+
+    def start(self):
+        """Start instances and wait until they listen"""
+        for config, path, port in self.instances:
+            self.processes.append(functions.start_twistd(
+                config, self.options.twistd))
+        for config, path, port in self.instances:
+            _wait_listening(port, self.options.timeout)
+        # zeromq subscriptions connect asynchronously
+        time.sleep(self.options.startup)
+
+    def rss(self):
+        """Return peak RSS of every instance in MB, None where unknown"""
+        result = []
+        for process in self.processes:
+            peak = None
+            try:
+                for line in open('/proc/%d/status' % (process.pid,)):
+                    if line.startswith('VmHWM:'):
+                        peak = int(line.split()[1]) / 1024.0
+            except IOError:
+                pass
+            result.append(peak)
+        return result
+
+    def stop(self):
+        """Stop all instances"""
+        functions.stop_twistd(self.processes)
+
+
+class InProcessCluster(object):
+    """ImageService instances running in the reactor of this process
+
+    The reactor runs in the main thread while the benchmark runs in another
+    one. All instances share the reactor and its thread pool, so this mainly
+    serves profiling; peak RSS is the one of this process.
+    """
+
+    def __init__(self, root, instances, options):
+        from imagepipe import image_service
+        self.services = [image_service.ImageService(config) for
+                         config, path, port in instances]
+        self.instances = instances
+        self.options = options
+
+    def start(self):
+        """Start instances"""
+        from twisted.internet import reactor, threads
+        for image_service in self.services:
+            threads.blockingCallFromThread(reactor,
+                                           image_service.startService)
+        time.sleep(self.options.startup)
+
+    def rss(self):
+        """Return peak RSS of this process in MB"""
+        return [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0]
+
+    def stop(self):
+        """Stop all instances"""
+        from twisted.internet import reactor, threads
+        for image_service in self.services:
+            threads.blockingCallFromThread(reactor, image_service.stopService)
+
+
+def load(port, blob, case, options):
+    """Store images with concurrent clients
+
+    Returns (names of stored images, sorted latencies, refused calls, failed
+    calls, seconds).
+    """
+    image = base64.encodestring(blob)
+    size = sizes(case['variants'])
+    composite = int(case['mode'] == 'composite')
+    crop = int(case['mode'] == 'crop')
+    requests = iter(xrange(options.requests))
+    lock = threading.Lock()
+    stored = []
+    latencies = []
+    errors = {'busy': 0, 'failed': 0}
+
+    def client():
+        proxy = xmlrpclib.ServerProxy('http://127.0.0.1:%d/' % (port,),
+                                      allow_none=1)
+        while True:
+            with lock:
+                i = next(requests, None)
+            if i is None:
+                return
+            name = 'bench/%d.jpg' % (i,)
+            start = time.time()
+            try:
+                proxy.store_image(image, name, None, size, composite, crop)
+            except xmlrpclib.Fault as e:
+                with lock:
+                    errors['[1003]' in e.faultString and 'busy' or
+                           'failed'] += 1
+                continue
+            except Exception:
+                with lock:
+                    errors['failed'] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+                stored.append(name)
+
+    start = time.time()
+    clients = [threading.Thread(target=client) for
+               i in xrange(options.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return (stored, sorted(latencies), errors['busy'], errors['failed'],
+            time.time() - start)
+
+
+def converge(instances, stored, variants, timeout):
+    """Return seconds until all variants of stored images are present on
+    all instances but the first one, None if they are not within timeout"""
+    start = time.time()
+    missing = [os.path.join(path, name[:-4] + suffix + '.jpg') for
+               config, path, port in instances[1:] for name in stored for
+               suffix in sizes(variants)]
+    while missing:
+        if time.time() - start > timeout:
+            return None
+        missing = [path for path in missing if not os.path.exists(path)]
+        time.sleep(0.01)
+    return time.time() - start
+
+
+def run_case(case, blob, options):
+    """Run one case of the matrix and return its results"""
+    root = tempfile.mkdtemp(prefix='imagepipe-')
+    try:
+        instances = configure(root, case, options)
+        cluster = (options.in_process and InProcessCluster or
+                   SubprocessCluster)(root, instances, options)
+        cluster.start()
+        try:
+            (stored, latencies, busy, failed, seconds) = load(
+                instances[0][2], blob, case, options)
+            convergence = None
+            if len(instances) > 1:
+                convergence = converge(instances, stored, case['variants'],
+                                       options.timeout)
+            rss = cluster.rss()
+        finally:
+            cluster.stop()
+    finally:
+        shutil.rmtree(root)
+
+    result = dict(case)
+    result.update({
+        'requests': options.requests,
+        'stored': len(stored),
+        'busy': busy,
+        'failed': failed,
+        'seconds': seconds,
+        'throughput': len(stored) / seconds,
+        'latency': {'mean': latencies and
+                    sum(latencies) / len(latencies) or None,
+                    'p50': percentile(latencies, 0.5),
+                    'p90': percentile(latencies, 0.9),
+                    'p99': percentile(latencies, 0.99),
+                    'max': latencies and latencies[-1] or None},
+        'rss_mb': rss,
+        'convergence': convergence})
+    return result
+
+
+def run(args, options):
+    """Run all cases, returns the report"""
+    report = {'instances': options.instances,
+              'topology': options.topology,
+              'in_process': options.in_process,
+              'convert': options.convert,
+              'delay': options.delay,
+              'concurrency': options.concurrency,
+              'cases': []}
+    for payload, blob in payloads(args, _list(options.payloads)):
+        for io_threads in _list(options.io_threads):
+            for variants in _list(options.variants):
+                for mode in _list(options.modes, str):
+                    case = {'payload': payload, 'bytes': len(blob),
+                            'io_threads': io_threads, 'variants': variants,
+                            'mode': mode}
+                    result = run_case(case, blob, options)
+                    report['cases'].append(result)
+                    # Not redirected to the log of in-process instances
+                    sys.__stderr__.write(
+                        "%(payload)s io_threads=%(io_threads)d "
+                        "variants=%(variants)d mode=%(mode)s: "
+                        "%(throughput).1f req/s\n" % result)
+    return report
+
+
+def main(args, options):
+    """Run the benchmark and write the report"""
+    report = run(args, options)
+    output = options.output and open(options.output, 'w') or sys.__stdout__
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] [image ...]')
+    parser.add_option('-n', '--instances', dest='instances', type='int',
+                      default=2, help='instances (default: %default)',
+                      metavar='N')
+    parser.add_option('-t', '--topology', dest='topology', default='ring',
+                      help='ring or fanout (default: %default)',
+                      metavar='TOPOLOGY')
+    parser.add_option('--io-threads', dest='io_threads', default='1,4',
+                      help='io_threads values (default: %default)',
+                      metavar='LIST')
+    parser.add_option('--payloads', dest='payloads', default='16,256',
+                      help='sizes of generated payloads in KB (default: '
+                      '%default)', metavar='LIST')
+    parser.add_option('--variants', dest='variants', default='1,5',
+                      help='numbers of sizes per image (default: %default)',
+                      metavar='LIST')
+    parser.add_option('--modes', dest='modes', default='resize,crop',
+                      help='resize, composite or crop (default: %default)',
+                      metavar='LIST')
+    parser.add_option('-r', '--requests', dest='requests', type='int',
+                      default=200, help='images per case (default: %default)',
+                      metavar='N')
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                      default=8, help='concurrent clients (default: %default)',
+                      metavar='N')
+    functions.add_convert_option(parser, os.path.join(SOURCEDIR, 'tests',
+                                                      'fake_convert.py'))
+    parser.add_option('--delay', dest='delay', type='float', default=0.005,
+                      help='seconds fake_convert.py takes per image (default: '
+                      '%default)', metavar='SECONDS')
+    parser.add_option('--in-process', dest='in_process', action='store_true',
+                      default=False, help='run instances in this process')
+    parser.add_option('--port', dest='port', type='int', default=2000,
+                      help='base port (default: %default)', metavar='PORT')
+    functions.add_cluster_options(parser, startup=1.0, timeout=60.0)
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='write the report to PATH instead of stdout',
+                      metavar='PATH')
+    parser.add_option('-l', '--log', dest='log', default=os.devnull,
+                      help='log of instances running in this process '
+                      '(default: %default)', metavar='PATH')
+
+    (options, args) = parser.parse_args()
+
+    if (options.topology not in ('ring', 'fanout') or
+            options.instances < 1 or
+            [mode for mode in _list(options.modes, str) if
+             mode not in MODES]):
+        parser.print_help()
+        sys.exit(1)
+
+    if not options.in_process:
+        main(args, options)
+        sys.exit(0)
+
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    # Output of the instances would mix with the report
+    log.startLogging(open(options.log, 'a'))
+    status = []
+
+    def benchmark():
+        try:
+            main(args, options)
+        except Exception:
+            log.err()
+            status.append(1)
+        reactor.callFromThread(reactor.stop)
+
+    reactor.callWhenRunning(threading.Thread(target=benchmark).start)
+    reactor.run()
+    sys.exit(status and 1 or 0)
@@ -0,0 +1,113 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Compare JSON and binary replication messages
+
+For store_image messages of every payload size and batches of deletes and
+moves of every batch size, reports bytes on the wire and the average time to
+encode and decode a message. Images of JSON messages are encoded in base64
+and decoded again as a subscriber does, binary ones carry them raw (see
+replication.encode).
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from imagepipe import replication
+
+
+def messages(payloads, batches):
+    """Return list of (name, JSON message, binary message) dictionaries"""
+    header = {'id': uuid.uuid4().hex, 'seq': 1, 'time': time.time()}
+    result = []
+    for size in payloads:
+        blob = os.urandom(size * 1024)
+        args = ['x/y/z/image.jpg', None, {'': [500, 500], '_s': [50, 50]},
+                None, None, 1]
+        result.append(('store_image %d KB' % (size,),
+                       dict(header, method='store_image',
+                            args=[blob] + args),
+                       dict(header, method='store_image',
+                            args=[replication.Blob(blob)] + args)))
+    for size in batches:
+        paths = ['x/y/z/image%06d.jpg' % (i,) for i in xrange(size)]
+        message = dict(header, method='delete_image', args=[paths])
+        result.append(('delete %d paths' % (size,), message, message))
+        message = dict(header, method='move_image',
+                       args=[paths, ['moved/' + path for path in paths]])
+        result.append(('move %d paths' % (size,), message, message))
+    return result
+
+
+def encode_json(message):
+    """Encode message as an instance with wire = json does"""
+    args = message['args']
+    if message['method'] == 'store_image':
+        args = [base64.encodestring(args[0])] + args[1:]
+    return [json.dumps(dict(message, args=args))]
+
+
+def decode_json(parts):
+    """Decode message as a subscriber does"""
+    message = replication.decode(parts)
+    if message['method'] == 'store_image':
+        base64.decodestring(message['args'][0])
+    return message
+
+
+def measure(f, argument, iterations):
+    """Return average seconds of f(argument)"""
+    start = time.time()
+    for i in xrange(iterations):
+        f(argument)
+    return (time.time() - start) / iterations
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--payloads', dest='payloads',
+                      default='10,100,1000,5000',
+                      help='image sizes in KB (default: %default)',
+                      metavar='LIST')
+    parser.add_option('--batches', dest='batches', default='10,1000',
+                      help='paths of deletes and moves (default: %default)',
+                      metavar='LIST')
+    parser.add_option('-n', '--iterations', dest='iterations', type='int',
+                      default=20, help='iterations (default: %default)',
+                      metavar='N')
+
+    (options, args) = parser.parse_args()
+
+    try:
+        payloads = [int(value) for value in options.payloads.split(',')]
+        batches = [int(value) for value in options.batches.split(',')]
+    except ValueError:
+        parser.print_help()
+        sys.exit(1)
+
+    print "%-20s %-11s %-11s %-7s %-9s %-9s %-9s %-9s" % (
+        'message', 'json', 'binary', 'ratio', 'json enc', 'bin enc',
+        'json dec', 'bin dec')
+    for name, json_message, binary_message in messages(payloads, batches):
+        json_parts = encode_json(json_message)
+        binary_parts = replication.encode(binary_message)
+        json_size = sum([len(part) for part in json_parts])
+        binary_size = sum([len(part) for part in binary_parts])
+        print "%-20s %-11d %-11d %-7s %-9s %-9s %-9s %-9s" % (
+            name, json_size, binary_size,
+            '%.2fx' % (float(json_size) / binary_size,),
+            '%.2fms' % (measure(encode_json, json_message,
+                                options.iterations) * 1000,),
+            '%.2fms' % (measure(replication.encode, binary_message,
+                                options.iterations) * 1000,),
+            '%.2fms' % (measure(decode_json, json_parts,
+                                options.iterations) * 1000,),
+            '%.2fms' % (measure(replication.decode, binary_parts,
+                                options.iterations) * 1000,))
@@ -0,0 +1,82 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Check that the convert and pillow engines produce images of equal
+dimensions
+
+Each of the given images is stored with every resize method in a number of
+sizes using both engines. Output dimensions are compared with Pillow.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PIL import Image
+
+import functions
+from imagepipe import image_io
+
+
+DIMENSIONS = [[50, 50], [100, 75], [75, 100], [400, 300], [5000, 5000]]
+
+METHODS = [('resize', 0, 0), ('composite', 1, 0), ('crop', 0, 1)]
+
+
+def store(blob, root, name, engine, convert):
+    """Store all methods and dimensions, returns {variant: (path, fmt)}"""
+    (base, ext) = os.path.splitext(name)
+    variants = []
+    for method, composite, crop in METHODS:
+        for dimension in DIMENSIONS:
+            fmt = composite and 'png' or None
+            path = os.path.join(root, engine, "%s_%s_%dx%d%s" % (
+                base, method, dimension[0], dimension[1],
+                fmt and '.' + fmt or ext))
+            variants.append({'path': path, 'fmt': fmt,
+                             'dimension': dimension, 'composite': composite,
+                             'crop': crop})
+    image_io.store_multi(blob, variants, convert=convert, engine=engine)
+    return [variant['path'] for variant in variants]
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] image [image...]')
+    functions.add_convert_option(parser)
+
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    failed = 0
+    root = tempfile.mkdtemp(prefix='imagepipe-')
+    try:
+        for image_path in args:
+            blob = open(image_path, 'rb').read()
+            name = os.path.basename(image_path)
+            expected = store(blob, root, name, 'convert', options.convert)
+            actual = store(blob, root, name, 'pillow', options.convert)
+
+            for convert_path, pillow_path in zip(expected, actual):
+                convert_size = Image.open(convert_path).size
+                pillow_size = Image.open(pillow_path).size
+                if convert_size != pillow_size:
+                    failed += 1
+                    status = 'FAIL'
+                else:
+                    status = 'OK'
+                print "%-4s %s: convert %dx%d, pillow %dx%d" % (
+                    status, os.path.basename(pillow_path), convert_size[0],
+                    convert_size[1], pillow_size[0], pillow_size[1])
+    finally:
+        shutil.rmtree(root)
+
+    if failed:
+        print "%d image(s) differ" % (failed,)
+        sys.exit(1)
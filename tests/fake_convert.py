@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Deterministic stand-in for convert
+
+This accepts the command lines assembled by image_io, reads the image from
+stdin and writes it unchanged to every output (the last argument and the ones
+of -write, without format prefixes). With FAKE_CONVERT_DELAY in the
+environment, e.g. set in the imagemagick.env section of the configuration, it
+sleeps that many seconds per written image to stand in for the conversion
+cost. Meant for benchmarks and tests without ImageMagick.
+"""
+
+import os
+import sys
+import time
+
+
+def outputs(args):
+    """Return paths of images written by a convert command line"""
+    paths = [args[i + 1] for i, arg in enumerate(args[:-1]) if
+             arg == '-write']
+    if args and args[-1] != 'null:':
+        paths.append(args[-1])
+    # Format prefixes, e.g. png:image.png
+    return [path.split(':', 1)[-1] for path in paths]
+
+
+if __name__ == '__main__':
+    paths = outputs(sys.argv[1:])
+    if not paths:
+        sys.exit("fake_convert: no output given")
+
+    blob = getattr(sys.stdin, 'buffer', sys.stdin).read()
+    delay = float(os.environ.get('FAKE_CONVERT_DELAY', 0))
+    for path in paths:
+        if delay:
+            time.sleep(delay)
+        image = open(path, 'wb')
+        try:
+            image.write(blob)
+        finally:
+            image.close()
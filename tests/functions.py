@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Common functions for test scripts"""
+
+import os
+import signal
+import subprocess
+
+SOURCEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Size dictionary used by most uploads, (suffix, dimension, format,
+# composite, crop)
+VARIANTS = [
+    ('', [1600, 1600], None, 0, 0),
+    ('_large', [800, 800], None, 0, 0),
+    ('_medium', [400, 400], None, 0, 0),
+    ('_small', [100, 100], 'png', 1, 0),
+    ('_thumb', [50, 50], None, 0, 1),
+]
+
+
+def add_convert_option(parser, default='/usr/bin/convert'):
+    """Add the --convert option to parser"""
+    parser.add_option('--convert', dest='convert', default=default,
+                      help='convert binary (default: %default)',
+                      metavar='PATH')
+
+
+def add_cluster_options(parser, startup=2.0, timeout=None):
+    """Add the options of scripts spawning instances to parser: --twistd,
+    --startup and, with a default timeout, --timeout"""
+    parser.add_option('--twistd', dest='twistd', default='twistd',
+                      help='twistd binary (default: %default)', metavar='PATH')
+    parser.add_option('--startup', dest='startup', type='float',
+                      default=startup, help='seconds to wait for instances '
+                      '(default: %default)', metavar='SECONDS')
+    if timeout is not None:
+        parser.add_option('--timeout', dest='timeout', type='float',
+                          default=timeout, help='seconds to wait for '
+                          'replication (default: %default)',
+                          metavar='SECONDS')
+
+
+def start_twistd(config, twistd='twistd'):
+    """Start an instance in the foreground logging next to its
+    configuration, returns the process"""
+    return subprocess.Popen(
+        [twistd, '-n', '--pidfile=', '-l',
+         os.path.join(os.path.dirname(config), 'twistd.log'), 'imagepipe',
+         '-c', config], cwd=SOURCEDIR)
+
+
+def stop_twistd(processes):
+    """Stop instances still running and wait for them"""
+    processes = [process for process in processes if process.poll() is None]
+    for process in processes:
+        os.kill(process.pid, signal.SIGTERM)
+    for process in processes:
+        process.wait()
+
+
+def variants(root, name):
+    """Build store_multi variants of VARIANTS for an image stored under
+    root"""
+    (base, ext) = os.path.splitext(name)
+    result = []
+    for suffix, dimension, fmt, composite, crop in VARIANTS:
+        path = os.path.join(root, base + suffix + (fmt and '.' + fmt or ext))
+        result.append({'path': path, 'fmt': fmt, 'dimension': dimension,
+                       'composite': composite, 'crop': crop})
+    return result
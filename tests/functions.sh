@@ -20,6 +20,7 @@ write_config() {
     # $4 = subscribe port
     # $5 = images path
     # $6 = io threads
+    # $7 = conversion engine (optional)
     cat << EOF >$1
 [network]
 interface = 127.0.0.1
@@ -31,8 +32,13 @@ subscribe = tcp://127.0.0.1:$4
 path = $5
 io_threads = $6
 [imagemagick]
+engine = ${7:-convert}
 [[env]]
 MAGICK_THREAD_LIMIT = 1
+[presets]
+[[integration]]
+_preset = 100x100
+_preset_crop = 100x100 crop
 EOF
     return $?
 }
@@ -107,6 +107,36 @@ for image in $IMAGES; do
             --size="_small_crop 100 100" --crop || \
                 fail "unable to store image; see $logfile for details"
 
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=$image_name_remote \
+            --preset=integration || \
+                fail "unable to store image; see $logfile for details"
+
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=$image_name_remote \
+            --preset=missing >/dev/null 2>&1 && \
+                fail "stored image with an unknown preset"
+
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=$image_name_remote --raw \
+            --size="_upload 100 100" \
+            --size="_upload_crop 100 100 png crop" || \
+                fail "unable to upload image; see $logfile for details"
+
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=../$image_name_remote --raw \
+            >/dev/null 2>&1 && \
+                fail "uploaded image outside of the images path"
+
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=${i}_batch_${image_name} --batch || \
+                fail "unable to store images; see $logfile for details"
+
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=../$image_name_remote --batch \
+            >/dev/null 2>&1 && \
+                fail "stored images outside of the images path"
+
         status "Waiting for convert to finish"
 
         while true; do
@@ -116,9 +146,63 @@ for image in $IMAGES; do
             fi
             sleep 1
         done
+
+        status "Moving images of instance ${i}"
+
+        # Moves sharing a path are done in order
+        $CLIENT --host=127.0.0.1 --port=$port --batch \
+            -m "${i}_batch_${image_name} ${i}_moving_${image_name}" \
+            -m "${i}_moving_${image_name} ${i}_moved_${image_name}" || \
+                fail "unable to move images; see $logfile for details"
+
+        $CLIENT --host=127.0.0.1 --port=$port --batch \
+            -m "${i}_batch_${image_name} ${i}_moved_${image_name}" \
+            >/dev/null 2>&1 && fail "moved a missing image"
+
+        for moved_path in ${i}_batch_${image_name} \
+                ${i}_moving_${image_name}; do
+            test -f ${rundir}/$moved_path && \
+                fail "image $moved_path was not moved"
+        done
     done
 done
 
+status "Reading metrics"
+
+for i in `seq $INSTANCES`; do
+    rundir=${TMPDIR}/${i}
+    logfile=${rundir}/twistd.log
+    metrics=${TMPDIR}/metrics
+    port=`expr 2000 + $i`
+
+    wget -qO $metrics http://127.0.0.1:${port}/metrics || \
+        fail "unable to read metrics; see $logfile for details"
+
+    patterns="
+        imagepipe_stage_seconds_count{operation=\"store_image_preset\",
+        imagepipe_stage_seconds_count{operation=\"upload\",
+        imagepipe_stage_seconds_count{operation=\"store_multi\",
+        imagepipe_stage_seconds_count{operation=\"store_images\",
+        imagepipe_queue_depth
+    "
+    if [ $INSTANCES -gt 1 ]; then
+        patterns="$patterns
+            imagepipe_stage_seconds_count{operation=\"replicated_store_image\",
+            imagepipe_replication_lag_seconds_count
+        "
+    fi
+    for pattern in $patterns; do
+        grep -F "$pattern" $metrics >/dev/null 2>&1 || \
+            fail "metric $pattern missing from /metrics of instance $i"
+    done
+
+    # Five store_image calls per image
+    stored=`awk '/^imagepipe_stage_seconds_count\{operation="store_image",.*stage="total"/ { n += $2 } END { print n }' $metrics`
+    test "$stored" = `expr 5 \* $#` || \
+        fail "$stored store_image calls recorded by instance $i"
+    rm -f $metrics
+done
+
 status "Verifying images"
 
 for image in $IMAGES; do
@@ -133,6 +217,11 @@ for image in $IMAGES; do
             ${i}_`echo ${image_name} | sed -r "s/\.(.+)?$/_small_composite.\1/g"`
             ${i}_`echo ${image_name} | sed -r "s/\.(.+)?$/_small_composite.png/g"`
             ${i}_`echo ${image_name} | sed -r "s/\.(.+)?$/_small_crop.\1/g"`
+            ${i}_`echo ${image_name} | sed -r "s/\.(.+)?$/_preset.\1/g"`
+            ${i}_`echo ${image_name} | sed -r "s/\.(.+)?$/_preset_crop.\1/g"`
+            ${i}_`echo ${image_name} | sed -r "s/\.(.+)?$/_upload.\1/g"`
+            ${i}_`echo ${image_name} | sed -r "s/\.(.+)?$/_upload_crop.png/g"`
+            ${i}_moved_${image_name}
         "
 
         for image_path in $image_paths; do
@@ -144,8 +233,106 @@ for image in $IMAGES; do
         port=`expr 2000 + $i`
 
         for image_path in $image_paths; do
-            $CLIENT --host=127.0.0.1 --port=$port -d $image_path || \
-                fail "unable to remove image; see $logfile for details"
+            $CLIENT --host=127.0.0.1 --port=$port -g $image_path \
+                -o ${TMPDIR}/served || \
+                    fail "unable to read image; see $logfile for details"
+            cmp -s ${TMPDIR}/served ${rundir}/$image_path || \
+                fail "image served differs from ${rundir}/$image_path"
+        done
+
+        cp ${rundir}/${i}_${image_name} ${rundir}/.hidden_${image_name}
+        cp ${rundir}/${i}_${image_name} ${TMPDIR}/outside_${image_name}
+        for image_path in .hidden_${image_name} ../outside_${image_name}; do
+            $CLIENT --host=127.0.0.1 --port=$port -g $image_path \
+                -o ${TMPDIR}/served >/dev/null 2>&1 && \
+                    fail "image $image_path served"
+        done
+        rm -f ${rundir}/.hidden_${image_name} ${TMPDIR}/outside_${image_name} \
+            ${TMPDIR}/served
+
+        delete_paths=""
+        for image_path in $image_paths; do
+            delete_paths="$delete_paths -d $image_path"
+        done
+        $CLIENT --host=127.0.0.1 --port=$port --batch $delete_paths || \
+            fail "unable to remove images; see $logfile for details"
+
+        $CLIENT --host=127.0.0.1 --port=$port --batch \
+            -d ../${i}_${image_name} >/dev/null 2>&1 && \
+                fail "removed an image outside of the images path"
+    done
+done
+
+status "Moving and deleting prefixes"
+
+for image in $IMAGES; do
+    image_name=`basename $image`
+    image_path=${TMPDIR}/${image_name}
+
+    for i in `seq $INSTANCES`; do
+        rundir=${TMPDIR}/${i}
+        logfile=${rundir}/twistd.log
+        port=`expr 2000 + $i`
+        prefix=prefix_${i}/a/${image_name}
+        base=`echo ${image_name} | sed -r "s/\.(.+)?$//g"`
+        ext=`echo ${image_name} | sed -r "s/^[^.]*\.//g"`
+
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=$prefix --preset=integration || \
+                fail "unable to store image; see $logfile for details"
+
+        $CLIENT --host=127.0.0.1 --port=$port \
+            -i $image_path --remote-path=$prefix \
+            --size="_other 100 100" || \
+                fail "unable to store image; see $logfile for details"
+
+        while true; do
+            pgrep -u `id -u` -l convert | grep " convert$" >/dev/null 2>&1
+            if [ $? -ne 0 ]; then
+               break
+            fi
+            sleep 1
+        done
+
+        # Only the sizes of the given suffixes are moved
+        $CLIENT --host=127.0.0.1 --port=$port --suffix=_preset \
+            --move-prefix="$prefix prefix_${i}/b/moved.${ext}" || \
+                fail "unable to move prefix; see $logfile for details"
+
+        for moved_path in b/moved_preset.${ext} a/${base}_preset_crop.${ext} \
+                a/${base}_other.${ext}; do
+            test -f ${rundir}/prefix_${i}/$moved_path || \
+                fail "image prefix_${i}/$moved_path does not exist"
+        done
+        test -f ${rundir}/prefix_${i}/a/${base}_preset.${ext} && \
+            fail "image prefix_${i}/a/${base}_preset.${ext} was not moved"
+
+        $CLIENT --host=127.0.0.1 --port=$port --preset=integration \
+            --delete-prefix=$prefix || \
+                fail "unable to delete prefix; see $logfile for details"
+
+        test -f ${rundir}/prefix_${i}/a/${base}_preset_crop.${ext} && \
+            fail "image prefix_${i}/a/${base}_preset_crop.${ext} not deleted"
+        test -f ${rundir}/prefix_${i}/a/${base}_other.${ext} || \
+            fail "image prefix_${i}/a/${base}_other.${ext} was deleted"
+
+        # Directories are moved and deleted with all of their contents
+        $CLIENT --host=127.0.0.1 --port=$port \
+            --move-prefix="prefix_${i}/a prefix_${i}/b/a" || \
+                fail "unable to move prefix; see $logfile for details"
+
+        test -f ${rundir}/prefix_${i}/b/a/${base}_other.${ext} || \
+            fail "directory prefix_${i}/a was not moved"
+
+        $CLIENT --host=127.0.0.1 --port=$port --delete-prefix=prefix_${i} || \
+            fail "unable to delete prefix; see $logfile for details"
+
+        test -d ${rundir}/prefix_${i} && \
+            fail "directory prefix_${i} was not deleted"
+
+        for invalid in . ..; do
+            $CLIENT --host=127.0.0.1 --port=$port --delete-prefix=$invalid \
+                >/dev/null 2>&1 && fail "deleted prefix $invalid"
         done
     done
 done
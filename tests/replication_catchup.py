@@ -0,0 +1,146 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Check that a subscriber catches up after being killed mid-stream
+
+This spawns two instances with journals, the second one subscribed to the
+first one and requesting lost messages from its replay endpoint. Images are
+stored on the first instance while the second one is killed (SIGKILL) and
+started again, afterwards every image must be present on both.
+"""
+
+import base64
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+from optparse import OptionParser
+
+import functions
+
+CONFIG = """[network]
+interface = 127.0.0.1
+port = %(port)d
+[replication]
+publish = tcp://127.0.0.1:%(publish_port)d
+journal = %(journal)s
+replay = tcp://127.0.0.1:%(replay_port)d
+%(peers)s[images]
+path = %(path)s
+io_threads = 1
+[imagemagick]
+convert = %(convert)s
+[[env]]
+MAGICK_THREAD_LIMIT = 1
+"""
+
+
+def configure(root, i, peer, options):
+    """Write configuration of an instance, returns its directory"""
+    rundir = os.path.join(root, str(i))
+    os.makedirs(os.path.join(rundir, 'images'))
+
+    peers = ''
+    if peer:
+        peers = ('subscribe = tcp://127.0.0.1:%d\n'
+                 'replay_peers = tcp://127.0.0.1:%d\n' % (3000 + peer,
+                                                          4000 + peer))
+
+    open(os.path.join(rundir, 'imagepipe.ini'), 'w').write(CONFIG % {
+        'port': 2000 + i, 'publish_port': 3000 + i, 'replay_port': 4000 + i,
+        'peers': peers,
+        'journal': os.path.join(rundir, 'journal'),
+        'path': os.path.join(rundir, 'images'),
+        'convert': options.convert})
+    return rundir
+
+
+def start(rundir, options):
+    """Start an instance"""
+    return functions.start_twistd(os.path.join(rundir, 'imagepipe.ini'),
+                                  options.twistd)
+
+
+def store(image, count, stored, options):
+    """Store count images on the first instance"""
+    xmlrpc = xmlrpclib.ServerProxy('http://127.0.0.1:2001/', allow_none=1)
+    for i in xrange(count):
+        xmlrpc.store_image(image, 'catchup_%d.jpg' % (i,), None,
+                           {'': [400, 400], '_small': [50, 50]})
+        stored.append(i)
+        time.sleep(options.interval)
+
+
+def missing(path, count):
+    """Return numbers of images not present in path"""
+    return [i for i in xrange(count) if not os.path.exists(
+        os.path.join(path, 'catchup_%d_small.jpg' % (i,)))]
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] image')
+    parser.add_option('-i', '--iterations', dest='iterations', type='int',
+                      default=200, help='images to store (default: %default)',
+                      metavar='N')
+    parser.add_option('--interval', dest='interval', type='float',
+                      default=0.01, help='seconds between stored images '
+                      '(default: %default)', metavar='SECONDS')
+    parser.add_option('--downtime', dest='downtime', type='float', default=2,
+                      help='seconds the subscriber is not running (default: '
+                      '%default)', metavar='SECONDS')
+    functions.add_convert_option(parser)
+    functions.add_cluster_options(parser, timeout=30.0)
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    image = base64.encodestring(open(args[0], 'rb').read())
+
+    root = tempfile.mkdtemp(prefix='imagepipe-')
+    publisher_dir = configure(root, 1, None, options)
+    subscriber_dir = configure(root, 2, 1, options)
+    publisher = start(publisher_dir, options)
+    subscriber = start(subscriber_dir, options)
+    try:
+        time.sleep(options.startup)
+
+        stored = []
+        thread = threading.Thread(target=store, args=(
+            image, options.iterations, stored, options))
+        thread.start()
+
+        while len(stored) < options.iterations / 4 and thread.is_alive():
+            time.sleep(0.01)
+        os.kill(subscriber.pid, signal.SIGKILL)
+        subscriber.wait()
+        print "Killed subscriber after %d image(s)" % (len(stored),)
+
+        time.sleep(options.downtime)
+        subscriber = start(subscriber_dir, options)
+        print "Started subscriber after %d image(s)" % (len(stored),)
+        thread.join()
+
+        path = os.path.join(subscriber_dir, 'images')
+        start_time = time.time()
+        lost = missing(path, options.iterations)
+        while lost and time.time() - start_time < options.timeout:
+            time.sleep(0.1)
+            lost = missing(path, options.iterations)
+        elapsed = time.time() - start_time
+    finally:
+        functions.stop_twistd([publisher, subscriber])
+        shutil.rmtree(root)
+
+    if lost:
+        print "FAILED, %d image(s) not replicated: %s" % (
+            len(lost), ', '.join([str(i) for i in lost]))
+        sys.exit(1)
+    print "OK, all %d image(s) replicated in %.3f s" % (
+        options.iterations, elapsed)
@@ -0,0 +1,136 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Check that superseded stores are not replicated
+
+This spawns an instance with a slow convert (see fake_convert.py) and stores
+three different images to one path at once: the first one is converted while
+the second one is queued and superseded by the third one. Only the first and
+the third image must be published, and the third one must be stored.
+"""
+
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+from optparse import OptionParser
+
+import zmq
+
+SOURCEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, SOURCEDIR)
+
+import functions
+from imagepipe import replication
+
+CONFIG = """[network]
+interface = 127.0.0.1
+port = %(port)d
+[replication]
+publish = tcp://127.0.0.1:%(publish_port)d
+[images]
+path = %(path)s
+io_threads = 4
+[imagemagick]
+convert = %(convert)s
+[[env]]
+FAKE_CONVERT_DELAY = %(delay)s
+"""
+
+
+def store(image, options):
+    """Store image at coalesce.jpg"""
+    xmlrpc = xmlrpclib.ServerProxy('http://127.0.0.1:%d/' % (options.port,),
+                                   allow_none=1)
+    xmlrpc.store_image(base64.encodestring(image), 'coalesce.jpg', None,
+                       [100, 100])
+
+
+def published(parts):
+    """Return the image of a store_image message, None for other ones"""
+    if not replication.is_binary(parts[0]):
+        parts = [parts[0].split('\0', 1)[-1]]
+    message = replication.decode(parts)
+    if message['method'] != 'store_image':
+        return None
+    image = message['args'][0]
+    if isinstance(image, replication.Blob):
+        return str(image)
+    return base64.decodestring(image)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] image')
+    functions.add_convert_option(parser, os.path.join(SOURCEDIR, 'tests',
+                                                      'fake_convert.py'))
+    parser.add_option('--delay', dest='delay', type='float', default=1.0,
+                      help='seconds a conversion takes (default: %default)',
+                      metavar='SECONDS')
+    parser.add_option('-p', '--port', dest='port', type='int', default=2001,
+                      help='port of the instance, it publishes on the next '
+                      'one (default: %default)', metavar='PORT')
+    functions.add_cluster_options(parser)
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    image = open(args[0], 'rb').read()
+    # Distinct images, trailing data is ignored by decoders
+    images = [image + chr(i) * 16 for i in xrange(3)]
+
+    root = tempfile.mkdtemp(prefix='imagepipe-')
+    path = os.path.join(root, 'images')
+    os.makedirs(path)
+    open(os.path.join(root, 'imagepipe.ini'), 'w').write(CONFIG % {
+        'port': options.port, 'publish_port': options.port + 1,
+        'path': path, 'convert': options.convert, 'delay': options.delay})
+
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, '')
+    socket.connect('tcp://127.0.0.1:%d' % (options.port + 1,))
+
+    process = functions.start_twistd(os.path.join(root, 'imagepipe.ini'),
+                                     options.twistd)
+    try:
+        time.sleep(options.startup)
+
+        threads = []
+        for blob in images:
+            thread = threading.Thread(target=store, args=(blob, options))
+            thread.start()
+            threads.append(thread)
+            # The first one runs, the second one is queued
+            time.sleep(options.delay / 4)
+        for thread in threads:
+            thread.join()
+
+        received = []
+        while socket.poll(options.delay * 1000):
+            received.append(published(socket.recv_multipart()))
+        received = [blob for blob in received if blob is not None]
+        stored = open(os.path.join(path, 'coalesce.jpg'), 'rb').read()
+    finally:
+        functions.stop_twistd([process])
+        socket.close()
+        context.term()
+        shutil.rmtree(root)
+
+    failed = False
+    if received != [images[0], images[2]]:
+        print "FAILED, published images %s instead of 0, 2" % (
+            ', '.join([str(images.index(blob)) for blob in received]),)
+        failed = True
+    if stored != images[2]:
+        print "FAILED, image %d stored instead of 2" % (images.index(stored),)
+        failed = True
+    if failed:
+        sys.exit(1)
+    print "OK, superseded image not published"
@@ -0,0 +1,125 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Measure replication lag against cluster size
+
+This spawns clusters of 2 up to the given number of instances connected in a
+ring (each one subscribes to its predecessor and forwards messages) or a mesh
+(each one subscribes to all other ones), stores an image on the first
+instance and measures the time until it is present on all of them.
+"""
+
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xmlrpclib
+from optparse import OptionParser
+
+import functions
+
+CONFIG = """[network]
+interface = 127.0.0.1
+port = %(port)d
+[replication]
+publish = tcp://127.0.0.1:%(publish_port)d
+subscribe = %(subscribe)s
+forward = %(forward)s
+[images]
+path = %(path)s
+io_threads = 1
+[imagemagick]
+convert = %(convert)s
+[[env]]
+MAGICK_THREAD_LIMIT = 1
+"""
+
+
+def start(root, instances, topology, options):
+    """Start instances, returns list of (process, images path, port)"""
+    nodes = []
+    for i in xrange(1, instances + 1):
+        rundir = os.path.join(root, str(i))
+        os.makedirs(os.path.join(rundir, 'images'))
+
+        if topology == 'ring':
+            peers = [instances if i == 1 else i - 1]
+        else:
+            peers = [n for n in xrange(1, instances + 1) if n != i]
+
+        config = os.path.join(rundir, 'imagepipe.ini')
+        open(config, 'w').write(CONFIG % {
+            'port': 2000 + i, 'publish_port': 3000 + i,
+            'subscribe': ', '.join(['tcp://127.0.0.1:%d' % (3000 + n,) for
+                                    n in peers]),
+            'forward': topology == 'ring' and 'true' or 'false',
+            'path': os.path.join(rundir, 'images'),
+            'convert': options.convert})
+
+        nodes.append((functions.start_twistd(config, options.twistd),
+                      os.path.join(rundir, 'images'), 2000 + i))
+
+    # Wait for listening sockets and zeromq subscriptions
+    time.sleep(options.startup)
+    return nodes
+
+
+def measure(nodes, image, options):
+    """Return replication lags, one per stored image"""
+    xmlrpc = xmlrpclib.ServerProxy('http://127.0.0.1:%d/' % (nodes[0][2],),
+                                   allow_none=1)
+    lags = []
+    for i in xrange(options.iterations):
+        name = 'lag_%d.jpg' % (i,)
+        start = time.time()
+        xmlrpc.store_image(image, name, None, {'': [400, 400],
+                                               '_small': [50, 50]})
+        missing = [os.path.join(path, 'lag_%d_small.jpg' % (i,)) for
+                   process, path, port in nodes[1:]]
+        while missing and time.time() - start < options.timeout:
+            missing = [path for path in missing if not os.path.exists(path)]
+            time.sleep(0.005)
+        if missing:
+            print "Image %s not replicated to %d instance(s)" % (
+                name, len(missing))
+        lags.append(time.time() - start)
+    return lags
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] image')
+    parser.add_option('-n', '--instances', dest='instances', type='int',
+                      default=8, help='largest cluster (default: %default)',
+                      metavar='N')
+    parser.add_option('-t', '--topology', dest='topology', default='mesh',
+                      help='ring or mesh (default: %default)',
+                      metavar='TOPOLOGY')
+    parser.add_option('-i', '--iterations', dest='iterations', type='int',
+                      default=10, metavar='N',
+                      help='images per cluster (default: %default)')
+    functions.add_convert_option(parser)
+    functions.add_cluster_options(parser, timeout=30.0)
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or options.topology not in ('ring', 'mesh'):
+        parser.print_help()
+        sys.exit(1)
+
+    image = base64.encodestring(open(args[0], 'rb').read())
+
+    print "%-10s %-10s %-10s %-10s" % ('instances', 'median', 'max',
+                                       'topology')
+    for instances in xrange(2, options.instances + 1):
+        root = tempfile.mkdtemp(prefix='imagepipe-')
+        nodes = start(root, instances, options.topology, options)
+        try:
+            lags = sorted(measure(nodes, image, options))
+        finally:
+            functions.stop_twistd([process for process, path, port in
+                                   nodes])
+            shutil.rmtree(root)
+        print "%-10d %-10.3f %-10.3f %-10s" % (
+            instances, lags[len(lags) / 2], lags[-1], options.topology)
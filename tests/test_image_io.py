@@ -0,0 +1,569 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Checks of image_io not needing ImageMagick
+
+Run as a script or with any unittest runner.
+"""
+
+import cStringIO
+import os
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import unittest
+
+from twisted.internet import defer
+from twisted.trial import unittest as trial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from imagepipe import image_io
+
+
+def run_magick(cmd):
+    """Follow the image list operations of a convert command line, returns
+    {output path: images written}
+
+    Images are strings, the decoded input (paths starting with /in) is
+    'input', resize geometries are appended to it (e.g. 'input100x100>'),
+    xc:none canvases are 'canvas WxH'. Composited layers are joined with '+'.
+    """
+    stack = [[]]
+    written = {}
+    size = None
+    args = iter(cmd[1:-1])
+    for arg in args:
+        images = stack[-1]
+        if arg in ('-respect-parentheses', '+repage'):
+            continue
+        elif arg in ('-define', '-gravity', '-crop'):
+            next(args)
+        elif arg == '(':
+            stack.append([])
+        elif arg == ')':
+            stack.pop()
+            stack[-1].extend(images)
+        elif arg == '-clone':
+            (first, last) = (next(args).split('--') + [None])[:2]
+            parent = stack[-2]
+            if last is None:
+                images.append(parent[int(first)])
+            else:
+                images.extend(parent[int(first):len(parent) + int(last) + 1])
+        elif arg == '-insert':
+            images.insert(int(next(args)), images.pop())
+        elif arg == '-delete':
+            assert next(args) == '0--1'
+            del images[:]
+        elif arg == '-size':
+            size = next(args)
+        elif arg == 'xc:none':
+            images.append('canvas ' + size)
+        elif arg == 'null:':
+            images.append('null')
+        elif arg == '-resize':
+            images[-1] += next(args)
+        elif arg == '-layers':
+            assert next(args) == 'composite'
+            null = images.index('null')
+            images[:] = ['+'.join(images[:null] + images[null + 1:])]
+        elif arg == '-write':
+            written[next(args)] = list(images)
+        else:
+            images.append(arg.startswith('/in') and 'input' or arg)
+    if cmd[-1] != 'null:':
+        written[cmd[-1]] = stack[0]
+    return written
+
+
+class MultiMagickTest(unittest.TestCase):
+    """Single convert calls writing several variants, see _multi_magick"""
+
+    def variants(self):
+        return [{'path': '/out/a.jpg', 'dimension': [400, 300]},
+                {'path': '/out/b.png', 'fmt': 'png', 'dimension': [100, 100],
+                 'composite': 1},
+                {'path': '/out/c.jpg', 'dimension': [50, 80], 'crop': 1}]
+
+    def test_single_decode(self):
+        cmd = image_io._multi_magick('convert', '/in.jpg', self.variants())
+        self.assertEqual(cmd[:5], ['convert', '-respect-parentheses',
+                                   '-define', 'jpeg:size=800x600',
+                                   '/in.jpg[0]'])
+        self.assertEqual(len([arg for arg in cmd if
+                              arg.startswith('/in')]), 1)
+        self.assertEqual(cmd[-1], 'null:')
+
+    def test_variants(self):
+        written = run_magick(image_io._multi_magick(
+            'convert', '/in.jpg', self.variants()))
+        self.assertEqual(written, {
+            '/out/a.jpg': ['input400x300>'],
+            'png:/out/b.png': ['canvas 100x100+input100x100>'],
+            '/out/c.jpg': ['input50x80^']})
+
+    def test_composite(self):
+        """The clone is composited over a canvas as in _composite_magick"""
+        variant = {'path': '/out/b.png', 'dimension': [100, 100],
+                   'composite': 1}
+        single = run_magick(image_io._composite_magick(
+            'convert', '/in.png', variant['path'], variant['dimension']))
+        multi = run_magick(image_io._multi_magick(
+            'convert', '/in.png', [variant]))
+        self.assertEqual(multi, single)
+
+    def test_animated(self):
+        cmd = image_io._multi_magick(
+            'convert', '/in.gif', [{'path': '/out/a.gif',
+                                    'dimension': [100, 100]},
+                                   {'path': '/out/a.jpg',
+                                    'dimension': [100, 100]}])
+        self.assertIn('/in.gif', cmd)
+        self.assertEqual(cmd[cmd.index('-clone') + 1], '0--1')
+
+    def test_source(self):
+        """Variants with source are cloned from the kept source image"""
+        written = run_magick(image_io._multi_magick(
+            'convert', '/in.jpg', [{'path': '/out/a.jpg',
+                                    'dimension': [400, 400]},
+                                   {'path': '/out/b.jpg',
+                                    'dimension': [100, 100], 'source': 0}]))
+        self.assertEqual(written['/out/b.jpg'],
+                         ['input400x400>100x100>'])
+
+
+class CascadeTest(unittest.TestCase):
+    """Sizes resized from larger ones, see _cascade"""
+
+    def test_sources(self):
+        variants = [{'path': '/out/a_50.jpg', 'dimension': [50, 50]},
+                    {'path': '/out/a.jpg', 'dimension': [500, 500]},
+                    {'path': '/out/a_100.jpg', 'dimension': [100, 100]},
+                    {'path': '/out/a_crop.jpg', 'dimension': [240, 240],
+                     'crop': 1},
+                    {'path': '/out/a_60.png', 'dimension': [60, 60],
+                     'composite': 1}]
+        planned = image_io._cascade(variants)
+        self.assertEqual([(variant['path'], variant.get('source')) for
+                          variant in planned],
+                         [('/out/a.jpg', None), ('/out/a_crop.jpg', None),
+                          ('/out/a_100.jpg', 0), ('/out/a_60.png', 0),
+                          ('/out/a_50.jpg', 2)])
+        # Copies are planned
+        self.assertFalse([variant for variant in variants if
+                          'source' in variant])
+
+    def test_resolution(self):
+        """Sources keep twice the width and height of the result"""
+        planned = image_io._cascade([
+            {'path': '/out/a.jpg', 'dimension': [500, 200]},
+            {'path': '/out/b.jpg', 'dimension': [200, 150]},
+            {'path': '/out/c.jpg', 'dimension': [100, 100]}])
+        self.assertEqual([variant.get('source') for variant in planned],
+                         [None, None, 0])
+
+    def test_animated(self):
+        variants = [{'path': '/out/a.gif', 'dimension': [500, 500]},
+                    {'path': '/out/b.jpg', 'dimension': [50, 50]}]
+        self.assertEqual(image_io._cascade(variants), variants)
+
+    def test_cache_key(self):
+        """Cascaded results are cached apart from direct ones"""
+        path = tempfile.mkdtemp(prefix='imagepipe-')
+        try:
+            cache = image_io.ResultCache(path, 1024)
+            variant = {'path': '/out/a.jpg', 'dimension': [50, 50]}
+            self.assertNotEqual(cache.key('digest', variant),
+                                cache.key('digest', variant, cascade=True))
+            self.assertEqual(cache.key('digest', variant),
+                             cache.key('digest', dict(variant,
+                                                      path='/out/b.jpg')))
+        finally:
+            shutil.rmtree(path)
+
+
+class SplitTest(unittest.TestCase):
+    """Sizes converted by parallel calls, see _split"""
+
+    def planned(self):
+        return image_io._cascade([
+            {'path': '/out/a.jpg', 'dimension': [500, 500]},
+            {'path': '/out/a_200.jpg', 'dimension': [200, 200]},
+            {'path': '/out/a_100.jpg', 'dimension': [100, 100]},
+            {'path': '/out/a_crop.jpg', 'dimension': [300, 300],
+             'crop': 1}])
+
+    def paths(self, groups):
+        return [[(variant['path'], variant.get('source')) for
+                 variant in group] for group in groups]
+
+    def test_cascades(self):
+        """Cascades stay in one group with sources numbered within it"""
+        self.assertEqual(self.paths(image_io._split(self.planned(), 2)), [
+            [('/out/a.jpg', None), ('/out/a_200.jpg', 0),
+             ('/out/a_100.jpg', 1)],
+            [('/out/a_crop.jpg', None)]])
+        self.assertEqual(len(image_io._split(self.planned(), 8)), 2)
+
+    def test_single(self):
+        planned = self.planned()
+        self.assertEqual(image_io._split(planned, 1), [planned])
+
+    def test_balanced(self):
+        planned = image_io._cascade([
+            {'path': '/out/%d.jpg' % (i,), 'dimension': [100, 100],
+             'crop': 1} for i in xrange(6)] + [
+            {'path': '/out/large.jpg', 'dimension': [300, 100], 'crop': 1}])
+        groups = image_io._split(planned, 3)
+        self.assertEqual(sorted([sum([variant['dimension'][0] for
+                                      variant in group]) for
+                                 group in groups]), [300, 300, 300])
+
+
+def png(width, height):
+    """Return the header of a PNG image"""
+    return ('\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + 'IHDR' +
+            struct.pack('>II', width, height) + '\x08\x06\0\0\0')
+
+
+def jpeg(width, height, junk=''):
+    """Return the header of a JPEG image, junk is put in front of the frame
+    header"""
+    return ('\xff\xd8\xff\xe0' + struct.pack('>H', 16) + 'JFIF\0' +
+            '\0' * 9 + junk + '\xff\xff\xc0' +
+            struct.pack('>HBHHB', 11, 8, height, width, 1) + '\x01\x11\0')
+
+
+class ProbeTest(unittest.TestCase):
+    """Image headers, see probe and _unchanged"""
+
+    def test_formats(self):
+        self.assertEqual(image_io.probe(png(640, 480)), ('png', 640, 480))
+        self.assertEqual(image_io.probe('GIF89a' + struct.pack(
+            '<HH', 32, 16) + '\0' * 20), ('gif', 32, 16))
+        self.assertEqual(image_io.probe(jpeg(1024, 768)),
+                         ('jpeg', 1024, 768))
+        self.assertEqual(image_io.probe(
+            'RIFF\0\0\0\0WEBPVP8 \0\0\0\0\0\0\0\x9d\x01\x2a' +
+            struct.pack('<HH', 300, 200)), ('webp', 300, 200))
+        self.assertEqual(image_io.probe(
+            'RIFF\0\0\0\0WEBPVP8L\0\0\0\0\x2f' +
+            struct.pack('<I', 299 | 199 << 14) + '\0' * 5),
+            ('webp', 300, 200))
+        self.assertEqual(image_io.probe('BM' + '\0' * 30), None)
+
+    def test_file(self):
+        image = cStringIO.StringIO(png(10, 20))
+        image.read()
+        self.assertEqual(image_io.probe(image), ('png', 10, 20))
+
+    def test_junk(self):
+        """Bytes between JPEG segments are skipped"""
+        self.assertEqual(image_io.probe(jpeg(1024, 768, 'junk\xff\0')),
+                         ('jpeg', 1024, 768))
+
+    def test_broken(self):
+        """Broken headers are rejected and counted as probed"""
+        before = dict(image_io.probe_stats)
+        for blob in ('', png(10, 10).replace('IHDR', 'IDAT'),
+                     jpeg(10, 10)[:26], '\xff\xd8\xff\xda\0\x02',
+                     'RIFF\0\0\0\0WEBPVP8 ' + '\0' * 14):
+            self.assertRaises(image_io.InvalidImageError, image_io.probe,
+                              blob)
+        for key in ('probed', 'rejected'):
+            self.assertEqual(image_io.probe_stats[key] - before.get(key, 0),
+                             5)
+
+    def test_unchanged(self):
+        header = ('jpeg', 400, 300)
+        self.assertTrue(image_io._unchanged(header, {'path': 'a.jpg'}))
+        self.assertTrue(image_io._unchanged(header, {
+            'path': 'a.JPEG', 'dimension': [400, 400]}))
+        self.assertFalse(image_io._unchanged(header, {
+            'path': 'a.jpg', 'dimension': [200, 400]}))
+        self.assertFalse(image_io._unchanged(header, {
+            'path': 'a.jpg', 'fmt': 'png', 'dimension': [400, 400]}))
+        for option in ('composite', 'crop'):
+            self.assertFalse(image_io._unchanged(header, {
+                'path': 'a.jpg', 'dimension': [400, 400], option: 1}))
+        self.assertFalse(image_io._unchanged(None, {'path': 'a.jpg'}))
+
+    def test_probed(self):
+        """Headers probed before are not probed again"""
+        root = tempfile.mkdtemp()
+        try:
+            blob = png(100, 100)
+            before = dict(image_io.probe_stats)
+            image_io.store(blob, os.path.join(root, 'a.png'),
+                           dimension=[400, 400], header=('png', 100, 100))
+            image_io.store_multi(blob, [{
+                'path': os.path.join(root, 'b.png'),
+                'dimension': [400, 400]}], header=('png', 100, 100))
+            self.assertEqual(image_io.probe_stats['probed'],
+                             before.get('probed', 0))
+            self.assertEqual(image_io.probe_stats['skipped'] -
+                             before.get('skipped', 0), 2)
+            self.assertEqual(open(os.path.join(root, 'b.png')).read(), blob)
+        finally:
+            shutil.rmtree(root)
+
+
+class ResultCacheTest(unittest.TestCase):
+    """Converted images kept on disk, see ResultCache"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+        self.cache = image_io.ResultCache(os.path.join(self.path, 'cache'),
+                                          10)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def image(self, name, data):
+        """Write an image converted to data, returns its path"""
+        path = os.path.join(self.path, name)
+        open(path, 'wb').write(data)
+        return path
+
+    def key(self, name):
+        return self.cache.key(name, {'dimension': [100, 100]})
+
+    def test_hit(self):
+        key = self.key('a')
+        self.assertFalse(self.cache.fetch(key, os.path.join(self.path, 'b')))
+        self.cache.add(key, self.image('a', 'image'))
+        self.assertTrue(self.cache.fetch(key, os.path.join(self.path, 'b')))
+        self.assertEqual(open(os.path.join(self.path, 'b')).read(), 'image')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertNotEqual(key, self.cache.key('a', {'dimension': [100, 100],
+                                                      'crop': 1}))
+
+    def test_eviction(self):
+        """The least recently used entries are removed"""
+        for name in ('a', 'b'):
+            self.cache.add(self.key(name), self.image(name, name * 4))
+        self.assertTrue(self.cache.fetch(self.key('a'),
+                                         os.path.join(self.path, 'x')))
+        self.cache.add(self.key('c'), self.image('c', 'cccc'))
+        self.assertEqual(self.cache.size, 8)
+        self.assertFalse(self.cache.fetch(self.key('b'),
+                                          os.path.join(self.path, 'x')))
+        self.assertTrue(self.cache.fetch(self.key('a'),
+                                         os.path.join(self.path, 'x')))
+
+        restored = image_io.ResultCache(self.cache.path, 10)
+        self.assertEqual(restored.size, 8)
+        self.assertTrue(restored.fetch(self.key('c'),
+                                       os.path.join(self.path, 'x')))
+
+    def test_mode(self):
+        """Hits with other permission bits leave the entry alone"""
+        key = self.key('a')
+        path = self.image('a', 'image')
+        os.chmod(path, 0644)
+        self.cache.add(key, path)
+        for mode in (0600, 0644):
+            copy = os.path.join(self.path, 'b%o' % (mode,))
+            self.assertTrue(self.cache.fetch(key, copy, mode))
+            self.assertEqual(stat.S_IMODE(os.stat(copy).st_mode), mode)
+            self.assertEqual(open(copy).read(), 'image')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0644)
+
+
+class SpawnTest(trial.TestCase):
+    """Conversions in processes spawned from the reactor, see
+    _imagemagick_spawn"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @defer.inlineCallbacks
+    def test_stdin(self):
+        """Blobs, strings or files, are sent to the standard input"""
+        output = os.path.join(self.path, 'out')
+        for blob in ('image' * 100000, cStringIO.StringIO('image')):
+            yield image_io._imagemagick_spawn(
+                blob, ['/bin/sh', '-c', 'cat > ' + output], None)
+            self.assertEqual(open(output).read(), image_io.read(blob))
+
+    @defer.inlineCallbacks
+    def test_error(self):
+        """Failures are reported with the error output"""
+        try:
+            yield image_io._imagemagick_spawn(
+                'image', ['/bin/sh', '-c', 'echo broken >&2; exit 1'], None)
+        except image_io.ImageMagickError as e:
+            self.assertEqual(str(e), 'broken')
+        else:
+            self.fail("ImageMagickError not raised")
+
+
+class WriteTest(unittest.TestCase):
+    """Images are written to temporary files renamed once complete"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+        self.image = os.path.join(self.path, 'image.jpg')
+        open(self.image, 'wb').write('previous')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write(self):
+        """Other links of a replaced image keep its contents"""
+        os.link(self.image, os.path.join(self.path, 'link'))
+        image_io.store('image', self.image, mode=0600)
+        self.assertEqual(open(self.image).read(), 'image')
+        self.assertEqual(stat.S_IMODE(os.stat(self.image).st_mode), 0600)
+        self.assertEqual(open(os.path.join(self.path, 'link')).read(),
+                         'previous')
+        self.assertEqual(sorted(os.listdir(self.path)), ['image.jpg', 'link'])
+
+    def test_failed(self):
+        """Failed conversions leave the previous image and no other files"""
+        convert = os.path.join(self.path, 'convert')
+        open(convert, 'wb').write('#!/bin/sh\n'
+                                  'for last; do :; done\n'
+                                  'echo partial > "$last"\n'
+                                  'echo failed >&2; exit 1\n')
+        os.chmod(convert, 0755)
+        self.assertRaises(image_io.ImageMagickError, image_io.store,
+                          png(400, 400), self.image, dimension=[100, 100],
+                          convert=convert)
+        self.assertEqual(open(self.image).read(), 'previous')
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['convert', 'image.jpg'])
+
+
+class ShardsTest(unittest.TestCase):
+    """Images spread over several roots, see Shards"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+        self.roots = [os.path.join(self.path, name) for name in ('0', '1')]
+        self.shards = image_io.Shards(self.roots)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def image(self, root, prefix='image'):
+        """Return a path in the tree stored on the root of the given index"""
+        for i in xrange(1000):
+            path = os.path.join(self.roots[0], 'a', '%s_%d.jpg' % (prefix, i))
+            if self.shards.shard(path) == root:
+                return path
+
+    def store(self, path, data):
+        location = self.shards.locate(path)
+        image_io.create_dirs(os.path.dirname(location))
+        open(location, 'wb').write(data)
+        self.shards.link(path)
+
+    def files(self, root):
+        return sorted([os.path.join(dirpath, filename) for
+                       dirpath, dirnames, filenames in os.walk(root) for
+                       filename in filenames])
+
+    def test_roots(self):
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        try:
+            shards = image_io.Shards(['0', '1'])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(shards.roots, self.roots)
+        self.assertEqual(shards.root, self.roots[0])
+
+    def test_shard(self):
+        """Placement depends on the relative path and positions of roots"""
+        moved = image_io.Shards(['/mnt/images', '/mnt/other'])
+        for i in xrange(20):
+            name = 'a/image_%d.jpg' % (i,)
+            self.assertEqual(
+                self.shards.shard(os.path.join(self.roots[0], name)),
+                moved.shard(os.path.join('/mnt/images', name)))
+        self.assertEqual(len(set([self.image(root) for root in (0, 1)])), 2)
+
+    def test_unicode(self):
+        """Non-ASCII paths are placed by their UTF-8 encoding"""
+        for i in xrange(20):
+            path = os.path.join(self.roots[0], u'\u017e\xe1k_%d.jpg' % (i,))
+            self.assertEqual(self.shards.shard(path),
+                             self.shards.shard(path.encode('utf-8')))
+
+    def test_link(self):
+        (path, linked) = (self.image(0), self.image(1))
+        self.store(path, 'image')
+        self.store(linked, 'linked')
+        self.assertFalse(os.path.islink(path))
+        self.assertEqual(self.shards.resolve(linked),
+                         os.path.join(self.roots[1], 'a',
+                                      os.path.basename(linked)))
+        self.assertEqual(open(linked, 'rb').read(), 'linked')
+
+    def test_move(self):
+        (src_path, dst_path) = (self.image(1), self.image(0, 'moved'))
+        self.store(src_path, 'image')
+        self.shards.move(src_path, dst_path)
+        self.assertFalse(os.path.lexists(src_path))
+        self.assertEqual(open(dst_path, 'rb').read(), 'image')
+        self.assertEqual(self.files(self.roots[1]), [])
+
+    def test_move_replaced(self):
+        """The file a replaced link pointed to is removed"""
+        (src_path, dst_path) = (self.image(1), self.image(0, 'moved'))
+        self.store(src_path, 'image')
+        # Linked to another root, e.g. before a root was added
+        previous = os.path.join(self.roots[1], 'a', 'previous.jpg')
+        open(previous, 'wb').write('previous')
+        os.symlink(previous, dst_path)
+
+        self.shards.move(src_path, dst_path)
+        self.assertFalse(os.path.islink(dst_path))
+        self.assertEqual(open(dst_path, 'rb').read(), 'image')
+        self.assertEqual(self.files(self.roots[1]), [])
+
+    def test_rebalance(self):
+        paths = [self.image(i % 2, 'image%d' % (i,)) for i in xrange(6)]
+        single = image_io.Shards(self.roots[:1])
+        for path in paths:
+            image_io.create_dirs(os.path.dirname(path))
+            open(path, 'wb').write(path)
+        orphan = os.path.join(self.roots[1], 'a', 'orphan.jpg')
+        image_io.create_dirs(os.path.dirname(orphan))
+        open(orphan, 'wb').write('orphan')
+        self.assertEqual(single.rebalance(), (0, 0))
+
+        self.assertEqual(self.shards.rebalance(), (3, 1))
+        for path in paths:
+            self.assertEqual(self.shards.resolve(path),
+                             self.shards.locate(path))
+            self.assertEqual(open(path, 'rb').read(), path)
+        self.assertEqual(len(self.files(self.roots[1])), 3)
+        self.assertEqual(self.shards.rebalance(), (0, 0))
+
+    def test_lock(self):
+        """Services and rebalancing exclude each other"""
+        fd = self.shards.lock()
+        try:
+            os.close(self.shards.lock())
+            self.assertRaises(image_io.LockedError, self.shards.rebalance)
+        finally:
+            os.close(fd)
+
+        fd = self.shards.lock(exclusive=True)
+        try:
+            self.assertRaises(image_io.LockedError, self.shards.lock)
+        finally:
+            os.close(fd)
+        self.assertEqual(self.shards.rebalance(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,432 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Checks of image_service helpers not needing a running service
+
+Run as a script or with any unittest runner.
+"""
+
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import uuid
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest as trial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from imagepipe import config
+from imagepipe import image_service
+from imagepipe import replication
+
+
+def settings(path, wire='binary'):
+    """Return the settings of a service storing images under path"""
+    return {'images': {'path': path, 'umask': None, 'io_threads': 2,
+                       'lazy': False},
+            'imagemagick': {'async': False, 'convert': 'convert',
+                            'env': None, 'engine': 'convert'},
+            'replication': {'mode': 'command', 'wire': wire,
+                            'forward': False}}
+
+
+class PubConnection(object):
+    """Records messages published like txzmq.ZmqPubConnection"""
+
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, message, tag=''):
+        self.sent.append([tag + '\0' + message])
+
+    def send(self, parts):
+        self.sent.append(list(parts))
+
+
+class UploadArgumentsTest(unittest.TestCase):
+    """Query string arguments of uploads, see UploadResource"""
+
+    def parse(self, values, parse=str):
+        return image_service.UploadResource._parse_argument(values, parse)
+
+    def size(self, values):
+        return self.parse(values, image_service.UploadResource._parse_size)
+
+    def test_single(self):
+        """A single argument without a suffix affects all images"""
+        self.assertEqual(self.parse(['png']), 'png')
+        self.assertEqual(self.parse(None), None)
+        self.assertEqual(self.parse([]), None)
+
+    def test_suffixed(self):
+        self.assertEqual(self.parse(['_small:png', '_thumb:gif']),
+                         {'_small': 'png', '_thumb': 'gif'})
+        self.assertEqual(self.parse(['_small:1'], int), {'_small': 1})
+
+    def test_unsuffixed(self):
+        """Repeated arguments without a suffix are the unsuffixed image"""
+        self.assertEqual(self.size(['500x500', '_small:50X50']),
+                         {'': [500, 500], '_small': [50, 50]})
+        self.assertEqual(self.parse([':png', '_small:gif']),
+                         {'': 'png', '_small': 'gif'})
+
+    def test_invalid(self):
+        self.assertRaises(image_service.ClientError, self.parse,
+                          ['_small:png', '_small:gif'])
+        self.assertRaises(image_service.ClientError, self.size, ['500xwide'])
+        self.assertRaises(image_service.ClientError, self.parse,
+                          ['_small:yes'], int)
+
+
+class SchedulerTest(trial.TestCase):
+    """Admission and order of conversions, see Scheduler"""
+
+    def setUp(self):
+        self.scheduler = image_service.Scheduler(0, 2, 100)
+        self.ran = []
+
+    def submit(self, name, size=10, priority=image_service.Scheduler.LOCAL):
+        return self.scheduler.run(size, priority, self.ran.append, name)
+
+    def test_depth(self):
+        """Local conversions are refused once max_depth ones wait"""
+        self.submit('a')
+        self.submit('b')
+        self.failureResultOf(self.submit('c'), image_service.BusyError)
+        self.assertEqual(self.scheduler.depth, 2)
+        self.assertEqual(self.scheduler.rejected, 1)
+
+    def test_bytes(self):
+        """Local conversions are refused once images take max_bytes"""
+        self.submit('a', 60)
+        self.failureResultOf(self.submit('b', 60), image_service.BusyError)
+        self.assertEqual(self.scheduler.bytes, 60)
+        self.assertEqual(self.scheduler.rejected, 1)
+
+    def test_replication(self):
+        """Replicated conversions are always admitted"""
+        results = [self.submit(name, 60, image_service.Scheduler.REPLICATION)
+                   for name in 'abc']
+        self.assertEqual(self.scheduler.depth, 3)
+        self.assertEqual(self.scheduler.rejected, 0)
+        self.scheduler.configure(1, 2, 100)
+        for result in results:
+            self.successResultOf(result)
+
+    def test_priority(self):
+        """Local conversions run first, each priority in arrival order"""
+        self.scheduler.configure(0, 10, 100)
+        self.submit('r1', priority=image_service.Scheduler.REPLICATION)
+        self.submit('l1')
+        self.submit('r2', priority=image_service.Scheduler.REPLICATION)
+        self.submit('l2')
+        self.scheduler.configure(1, 10, 100)
+        self.assertEqual(self.ran, ['l1', 'l2', 'r1', 'r2'])
+        self.assertEqual((self.scheduler.running, self.scheduler.bytes),
+                         (0, 0))
+
+
+class CoalesceTest(trial.TestCase):
+    """Stores of one path run in sequence, see XMLRPCServer._coalesce"""
+
+    def setUp(self):
+        self.server = image_service.XMLRPCServer(
+            {}, None, None, replication.Sequencer(),
+            image_service.Scheduler(1, 10, 1 << 20))
+        # Digests are computed right away so requests queue in order
+        self.patch(image_service.threads, 'deferToThread',
+                   lambda f, *args: defer.succeed(f(*args)))
+        self.started = []
+        self.stores = {}
+
+    def store(self, blob, size=100, name=None):
+        """Request a store of blob, returns the Deferred of the request
+
+        The store call is recorded in started by name (blob by default)
+        and fires once finish is called with its name.
+        """
+        name = name or blob
+        self.stores[name] = defer.Deferred()
+
+        def store():
+            self.started.append(name)
+            return self.stores[name]
+        return self.server._coalesce('a.jpg', blob,
+                                     [{'dimension': [size, size]}], store)
+
+    def finish(self, name, result=None):
+        self.stores[name].callback(result or [name])
+
+    def test_sequence(self):
+        """Stores of other variants run one after another"""
+        first = self.store('first')
+        second = self.store('second', 50)
+        self.assertEqual(self.started, ['first'])
+        self.finish('first')
+        self.assertEqual(self.successResultOf(first), ['first'])
+        self.assertEqual(self.started, ['first', 'second'])
+        self.finish('second')
+        self.assertEqual(self.successResultOf(second), ['second'])
+        self.assertEqual(self.server._storing, {})
+
+    def test_join(self):
+        """Requests of the image being stored join it"""
+        first = self.store('image')
+        second = self.store('image', name='again')
+        third = self.store('image', name='queued')
+        self.finish('image')
+        self.assertEqual(self.started, ['image'])
+        self.assertEqual(self.successResultOf(first), ['image'])
+        self.assertEqual(self.successResultOf(second), ['image'])
+        self.assertEqual(self.successResultOf(third), ['image'])
+
+    def test_supersede(self):
+        """Waiting requests are replaced by later ones of another image"""
+        running = self.store('running')
+        replaced = self.store('replaced')
+        last = self.store('last')
+        self.finish('running')
+        self.assertEqual(self.successResultOf(running), ['running'])
+        self.assertEqual(self.started, ['running', 'last'])
+        self.finish('last')
+        self.assertEqual(self.successResultOf(replaced), None)
+        self.assertEqual(self.successResultOf(last), ['last'])
+
+    def test_failure(self):
+        """Joined requests fail with the store"""
+        first = self.store('image')
+        second = self.store('image', name='again')
+        self.stores['image'].errback(image_service.ServerError('failed'))
+        self.failureResultOf(first, image_service.ServerError)
+        self.failureResultOf(second, image_service.ServerError)
+        self.assertEqual(self.server._storing, {})
+
+
+class SerializeTest(trial.TestCase):
+    """Operations on a path wait for the stores before, see
+    XMLRPCServer._serialize"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+        # Conversions wait until a slot is added
+        self.scheduler = image_service.Scheduler(0, 10, 1 << 20)
+        self.server = image_service.XMLRPCServer(
+            settings(self.path), None, None, replication.Sequencer(),
+            self.scheduler)
+        self.publisher = uuid.uuid4()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def apply(self, method, *args, **kwargs):
+        """Apply a replication message, with the sequence number seq if
+        given"""
+        message = {'method': method, 'args': list(args)}
+        if 'seq' in kwargs:
+            message['seq'] = kwargs['seq']
+        return self.server._replication_apply(message, self.publisher, [''])
+
+    @defer.inlineCallbacks
+    def stored(self, *applied):
+        """Let the held store run after the applied messages had a chance
+        to, returns the Deferred of them all"""
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.scheduler.configure(1, 10, 1 << 20)
+        yield defer.gatherResults(list(applied))
+
+    @defer.inlineCallbacks
+    def test_store_delete(self):
+        """A replicated delete is not undone by the store before"""
+        yield self.stored(
+            self.apply('store_image', replication.Blob('image'), 'a.jpg'),
+            self.apply('delete_image', 'a.jpg'))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'a.jpg')))
+
+    @defer.inlineCallbacks
+    def test_store_move(self):
+        yield self.stored(
+            self.apply('store_image', replication.Blob('image'), 'a.jpg'),
+            self.apply('move_image', 'a.jpg', 'b.jpg'))
+        self.assertEqual(os.listdir(self.path), ['b.jpg'])
+
+    @defer.inlineCallbacks
+    def test_store_delete_prefix(self):
+        """Prefix operations wait for the stores under the prefix"""
+        yield self.stored(
+            self.apply('store_image', replication.Blob('image'), 'x/a.jpg'),
+            self.apply('delete_prefix', 'x'))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'x')))
+
+    @defer.inlineCallbacks
+    def test_delete_prefix_store(self):
+        """Stores under the prefix wait for prefix operations before"""
+        os.mkdir(os.path.join(self.path, 'x'))
+        self.scheduler.configure(1, 10, 1 << 20)
+        yield defer.gatherResults([
+            self.apply('delete_prefix', 'x'),
+            self.apply('store_image', replication.Blob('image'), 'x/a.jpg')])
+        self.assertEqual(os.listdir(os.path.join(self.path, 'x')), ['a.jpg'])
+
+    @defer.inlineCallbacks
+    def test_superseded(self):
+        """Messages received after later ones on their paths are skipped"""
+        self.scheduler.configure(1, 10, 1 << 20)
+        yield self.apply('delete_image', ['a.jpg', 'b.jpg'], seq=3)
+        yield self.apply('store_image', replication.Blob('image'), '/a.jpg',
+                         seq=2)
+        yield self.apply('store_image', replication.Blob('image'), 'c.jpg',
+                         seq=1)
+        self.assertEqual(os.listdir(self.path), ['c.jpg'])
+
+    def test_message_paths(self):
+        self.assertEqual(image_service._message_paths(
+            {'method': 'move_image', 'args': [['a.jpg', u'x//b.jpg'],
+                                              ['c.jpg', 'd.jpg']]}),
+            ['/a.jpg', '/x/b.jpg', '/c.jpg', '/d.jpg'])
+        self.assertEqual(image_service._message_paths(
+            {'method': 'store_image_preset',
+             'args': ['image', 'a.jpg', 'product']}), ['/a.jpg'])
+        self.assertEqual(image_service._message_paths(
+            {'method': 'store_image', 'args': []}), [])
+
+
+class WireTest(trial.TestCase):
+    """Replication messages reach subscribers in both encodings"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def server(self, name, wire='binary', pub_connection=None):
+        """Return a server storing images in the directory name"""
+        return image_service.XMLRPCServer(
+            settings(os.path.join(self.path, name), wire), pub_connection,
+            None, replication.Sequencer(),
+            image_service.Scheduler(1, 10, 1 << 20))
+
+    def test_default(self):
+        """Messages are JSON unless all subscribers are known to be new"""
+        conf_path = os.path.join(self.path, 'imagepipe.ini')
+        open(conf_path, 'w').write('[images]\npath = %s\n' % (self.path,))
+        conf = config.read(conf_path)
+        config.check(conf)
+        self.assertEqual(conf['replication']['wire'], 'json')
+
+    @defer.inlineCallbacks
+    def test_subscriber(self):
+        """Subscribers accept messages of JSON and binary publishers"""
+        subscriber = self.server('subscriber')
+        for wire in ('json', 'binary'):
+            connection = PubConnection()
+            publisher = self.server(wire, wire, connection)
+            if wire == 'json':
+                image = base64.encodestring(wire)
+            else:
+                image = replication.Blob(wire)
+            publisher._replication_publish(publisher._replication_id,
+                                           'store_image', image,
+                                           wire + '.jpg')
+            self.assertEqual(len(connection.sent), 1)
+            self.assertEqual(
+                replication.is_binary(connection.sent[0][0]),
+                wire == 'binary')
+            yield subscriber._replication_received(connection.sent[0])
+            self.assertEqual(open(os.path.join(
+                self.path, 'subscriber', wire + '.jpg')).read(), wire)
+
+
+class SubConnection(object):
+    """Records pausing like image_service._SubConnection"""
+
+    paused = False
+
+    def subscribe(self, tag):
+        pass
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class SubscriptionTest(trial.TestCase):
+    """Received messages are bounded by the limits of the queue"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @defer.inlineCallbacks
+    def test_pause(self):
+        """Reading pauses while max_depth messages are being handled"""
+        connection = PubConnection()
+        publisher = image_service.XMLRPCServer(
+            settings(os.path.join(self.path, 'publisher')), connection,
+            None, replication.Sequencer(),
+            image_service.Scheduler(1, 10, 1 << 20))
+        for name in ('a.jpg', 'b.jpg'):
+            publisher._replication_publish(publisher._replication_id,
+                                           'store_image',
+                                           replication.Blob('image'), name)
+        sub_connection = SubConnection()
+        scheduler = image_service.Scheduler(0, 2, 1 << 20)
+        subscriber = image_service.XMLRPCServer(
+            settings(os.path.join(self.path, 'subscriber')), None,
+            sub_connection, replication.Sequencer(), scheduler)
+        first = sub_connection.messageReceived(connection.sent[0])
+        self.assertFalse(sub_connection.paused)
+        second = sub_connection.messageReceived(connection.sent[1])
+        self.assertTrue(sub_connection.paused)
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        scheduler.configure(1, 2, 1 << 20)
+        yield defer.gatherResults([first, second])
+        self.assertFalse(sub_connection.paused)
+        self.assertEqual(subscriber._replication_pending, 0)
+        self.assertEqual(subscriber._replication_bytes, 0)
+
+
+class PartitionTest(unittest.TestCase):
+    """Batches split into jobs, see _partition"""
+
+    def test_balanced(self):
+        chunks = image_service._partition(
+            ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg'], 2,
+            lambda path: [path])
+        self.assertEqual(sorted([len(chunk) for chunk in chunks]), [2, 3])
+        self.assertEqual(sorted(sum(chunks, [])), range(5))
+
+    def test_shared(self):
+        """Moves sharing a path end up in one chunk, in the given order"""
+        moves = [('a.jpg', 'b.jpg'), ('x.jpg', 'y.jpg'), ('b.jpg', 'c.jpg'),
+                 ('c.jpg', 'z.jpg')]
+        chunks = image_service._partition(moves, 4, list)
+        self.assertEqual(sorted(chunks), [[0, 2, 3], [1]])
+
+    def test_normalized(self):
+        """All spellings of one path are equal"""
+        chunks = image_service._partition(
+            ['a/b.jpg', '/a//b.jpg', 'a/./c/../b.jpg', u'a/b.jpg'], 4,
+            lambda path: [path])
+        self.assertEqual(chunks, [[0, 1, 2, 3]])
+
+    def test_invalid(self):
+        """Keys which are not strings are ignored"""
+        chunks = image_service._partition(
+            [None, 'a.jpg', 1, 'a.jpg'], 4, lambda path: [path])
+        self.assertEqual(sorted(chunks), [[0], [1, 3], [2]])
+
+    def test_empty(self):
+        self.assertEqual(image_service._partition([], 4, list), [[]])
+
+
+if __name__ == '__main__':
+    unittest.main()
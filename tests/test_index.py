@@ -0,0 +1,114 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Checks of the digest index of the image tree
+
+Run as a script or with any unittest runner.
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from imagepipe import index
+
+
+class TreeIndexTest(unittest.TestCase):
+    """Digests of files and directories, see index.TreeIndex"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+        self.root = os.path.join(self.path, 'images')
+        os.makedirs(self.root)
+        self.index = self.tree_index('index.db')
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.path)
+
+    def tree_index(self, name):
+        return index.TreeIndex(os.path.join(self.path, name), self.root)
+
+    def write(self, path, data):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'wb').write(data)
+        self.index.update(path)
+
+    def test_empty(self):
+        self.assertEqual(self.index.digest(), None)
+        self.assertEqual(self.index.entries(), [])
+
+    def test_update(self):
+        self.write('a/b/image.jpg', 'image')
+        root = self.index.digest()
+        self.assertEqual(self.index.entries(), [
+            ['a', self.index.digest('a'), True]])
+        self.assertEqual(self.index.entries('a/b'), [
+            ['image.jpg', index.TreeIndex.file_digest(
+                os.path.join(self.root, 'a/b/image.jpg')), False]])
+
+        # Only parents of a changed file change
+        self.write('c/image.jpg', 'image')
+        digest = self.index.digest('a')
+        self.write('a/b/image.jpg', 'changed')
+        self.assertNotEqual(self.index.digest('a'), digest)
+        self.assertNotEqual(self.index.digest(), root)
+        self.write('a/b/image.jpg', 'image')
+        self.assertEqual(self.index.digest('a'), digest)
+
+    def test_remove(self):
+        self.write('a/image.jpg', 'image')
+        root = self.index.digest()
+        self.write('a/b/other.jpg', 'other')
+        self.index.remove(os.path.join(self.root, 'a/b/other.jpg'))
+        self.assertEqual(self.index.digest(), root)
+
+        self.write('c/d/image.jpg', 'image')
+        self.index.remove_tree(os.path.join(self.root, 'c'))
+        self.assertEqual(self.index.digest(), root)
+        self.assertEqual(self.index.entries('c'), [])
+
+    def test_move_tree(self):
+        """Moved trees equal trees written there"""
+        self.write('a/b/image.jpg', 'image')
+        self.write('a/image.jpg', 'other')
+        self.index.move_tree(os.path.join(self.root, 'a'),
+                             os.path.join(self.root, 'z'))
+        self.assertEqual(self.index.entries('a'), [])
+
+        expected = self.tree_index('expected.db')
+        try:
+            for path, data in (('z/b/image.jpg', 'image'),
+                               ('z/image.jpg', 'other')):
+                expected.update(os.path.join(self.root, path),
+                                hashlib.md5(data).hexdigest())
+            self.assertEqual(self.index.digest(), expected.digest())
+        finally:
+            expected.close()
+
+    def test_rebuild(self):
+        """Rebuilt indices equal updated ones"""
+        self.write('a/b/image.jpg', 'image')
+        self.write('a/image.jpg', 'other')
+        self.write('c/image.jpg', 'image')
+        # Left by a store in progress
+        open(os.path.join(self.root, 'c/.tmp.1.2.image.jpg'), 'wb').write(
+            'partial')
+
+        rebuilt = self.tree_index('rebuilt.db')
+        try:
+            self.assertEqual(rebuilt.rebuild(), 3)
+            self.assertEqual(rebuilt.digest(), self.index.digest())
+        finally:
+            rebuilt.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Checks of the Pillow conversion engine
+
+Run as a script or with any unittest runner.
+"""
+
+import cStringIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from imagepipe import pillow_io
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def encode(image, fmt, **options):
+    """Return image encoded in fmt"""
+    output = cStringIO.StringIO()
+    image.save(output, fmt, **options)
+    return output.getvalue()
+
+
+@unittest.skipIf(Image is None, "Pillow is not installed")
+class ConvertTest(unittest.TestCase):
+    """Variants written by pillow_io.convert"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.blob = encode(Image.new('RGB', (300, 200), (255, 0, 0)), 'PNG')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def convert(self, blob, **variant):
+        """Convert blob to a single variant, returns the image written"""
+        variant['path'] = os.path.join(self.root, variant.get('path', 'out'))
+        pillow_io.convert(blob, [variant])
+        return Image.open(variant['path'])
+
+    def test_resize(self):
+        """Images are fit into the dimension rounding like convert"""
+        image = self.convert(self.blob, path='out.png', dimension=[100, 100])
+        self.assertEqual(image.size, (100, 67))
+
+    def test_never_enlarge(self):
+        """Images smaller than the dimension keep their size"""
+        image = self.convert(self.blob, path='out.png', dimension=[800, 800])
+        self.assertEqual(image.size, (300, 200))
+
+    def test_composite(self):
+        """Composited images are centered on a transparent canvas"""
+        image = self.convert(self.blob, path='out.png', dimension=[100, 100],
+                             composite=1)
+        self.assertEqual(image.size, (100, 100))
+        self.assertEqual(image.mode, 'RGBA')
+        self.assertEqual(image.getpixel((50, 5))[3], 0)
+        self.assertEqual(image.getpixel((50, 50)), (255, 0, 0, 255))
+
+    def test_crop(self):
+        """Cropped images fill the dimension"""
+        image = self.convert(self.blob, path='out.png', dimension=[50, 50],
+                             crop=1)
+        self.assertEqual(image.size, (50, 50))
+
+    def test_format(self):
+        """The format is taken from fmt, or the extension if not given"""
+        image = self.convert(self.blob, path='out', fmt='jpg',
+                             dimension=[100, 100])
+        self.assertEqual(image.format, 'JPEG')
+        image = self.convert(self.blob, path='out.gif', dimension=[100, 100])
+        self.assertEqual(image.format, 'GIF')
+
+    def test_animated(self):
+        """Only gif outputs keep all of the frames"""
+        frames = [Image.new('P', (40, 40), i) for i in range(3)]
+        blob = encode(frames[0], 'GIF', save_all=True,
+                      append_images=frames[1:], duration=100)
+        image = self.convert(blob, path='out.gif', dimension=[20, 20])
+        self.assertEqual(image.n_frames, 3)
+        self.assertEqual(image.size, (20, 20))
+        image = self.convert(blob, path='out.png', dimension=[20, 20])
+        self.assertEqual(getattr(image, 'n_frames', 1), 1)
+
+    def test_invalid(self):
+        """Undecodable input raises PillowError"""
+        self.assertRaises(pillow_io.PillowError, self.convert, 'not an image',
+                          path='out.png', dimension=[100, 100])
+
+
+if __name__ == '__main__':
+    unittest.main()
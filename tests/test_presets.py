@@ -0,0 +1,64 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Checks of named transformation presets
+
+Run as a script or with any unittest runner.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from imagepipe import config
+from imagepipe import image_io
+from imagepipe import presets
+
+
+class ParseTest(unittest.TestCase):
+    """Size specifications, see presets.parse"""
+
+    def test_size(self):
+        self.assertEqual(presets.parse('500x400'), {
+            'fmt': None, 'dimension': [500, 400], 'composite': 0, 'crop': 0})
+
+    def test_options(self):
+        self.assertEqual(presets.parse('50x50 crop png'), {
+            'fmt': 'png', 'dimension': [50, 50], 'composite': 0, 'crop': 1})
+        self.assertEqual(presets.parse('GIF Composite 100x75'), {
+            'fmt': 'gif', 'dimension': [100, 75], 'composite': 1, 'crop': 0})
+
+    def test_invalid(self):
+        for value in ('', 'png', '50x', '50x50 60x60', '50x50 crop composite',
+                      '50x50 png gif'):
+            self.assertRaises(ValueError, presets.parse, value)
+
+
+class CompileTest(unittest.TestCase):
+    """Presets compiled from settings, see presets.compile"""
+
+    def test_variants(self):
+        preset = presets.compile({'presets': {'product': {
+            '': '500x500', '_small': '50x50 crop',
+            '_thumb': '100x100 composite png'}}})['product']
+        self.assertEqual(preset.suffixes(), ['', '_small', '_thumb'])
+
+        variants = preset.variants('/images/a/b.jpg')
+        self.assertEqual([variant['path'] for variant in variants],
+                         ['/images/a/b.jpg', '/images/a/b_small.jpg',
+                          '/images/a/b_thumb.png'])
+        for variant in variants:
+            self.assertEqual(variant['magick'],
+                             image_io.transform_magick(variant))
+
+    def test_invalid(self):
+        self.assertRaises(config.ValidationError, presets.compile,
+                          {'presets': {'product': {'': '500'}}})
+        self.assertRaises(config.ValidationError, presets.compile,
+                          {'presets': {'product': {}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+"""Checks of the replication journal and sequencing
+
+Run as a script or with any unittest runner.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from imagepipe import replication
+
+
+class WireTest(unittest.TestCase):
+    """Binary and JSON messages, see replication.encode and decode"""
+
+    def message(self):
+        return {'id': uuid.uuid4().hex, 'seq': 1, 'method': 'store_images',
+                'args': [[{'image': replication.Blob('\xff\xd8image'),
+                           'path': 'a.jpg'},
+                          {'image': replication.Blob(''), 'path': 'b.jpg',
+                           'size': [50, 50]}]],
+                'kwargs': {'cascade': 0}}
+
+    def test_frames(self):
+        """Images are carried raw in frames of their own"""
+        message = self.message()
+        parts = replication.encode(message)
+        self.assertEqual(parts[1:], ['\xff\xd8image', ''])
+        self.assertTrue(replication.is_binary(parts[0]))
+
+        decoded = replication.decode(parts)
+        self.assertEqual(decoded, message)
+        self.assertTrue(isinstance(decoded['args'][0][0]['image'],
+                                   replication.Blob))
+
+    def test_joined(self):
+        message = self.message()
+        self.assertEqual(replication.decode(
+            [''.join(replication.encode(message))]), message)
+
+    def test_compressed(self):
+        message = {'method': 'delete_images', 'args': [
+            ['image_%d.jpg' % (i,) for i in xrange(1000)]]}
+        parts = replication.encode(message)
+        self.assertTrue(len(parts[0]) < len(json.dumps(message)) / 2)
+        self.assertEqual(replication.decode(parts), message)
+
+    def test_json(self):
+        message = {'method': 'delete_image', 'args': ['a.jpg']}
+        self.assertEqual(replication.decode([json.dumps(message)]), message)
+
+    def test_invalid(self):
+        parts = replication.encode(self.message())
+        header = parts[0]
+        for invalid in (['{'], [header[:8]],
+                        [header[:4] + '\x02' + header[5:]] + parts[1:],
+                        [header] + parts[1:2],
+                        [header, 'x', ''],
+                        [''.join(parts) + 'x']):
+            self.assertRaises(replication.MessageError, replication.decode,
+                              invalid)
+
+
+class JournalTest(unittest.TestCase):
+    """Appending, replaying and recovering, see replication.Journal"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='imagepipe-')
+        self.publisher = uuid.uuid4()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def journal(self, max_size=1024 * 1024):
+        return replication.Journal(self.path, max_size, 3600)
+
+    def test_replay(self):
+        journal = self.journal()
+        for seq in xrange(1, 11):
+            journal.append(self.publisher, seq, ['{"seq": %d}' % (seq,)])
+        journal.append(uuid.uuid4(), 5, ['{"other": 1}'])
+
+        self.assertEqual(journal.replay(self.publisher, 8),
+                         ['{"seq": 8}', '{"seq": 9}', '{"seq": 10}'])
+        self.assertEqual(journal.replay(self.publisher, 4, 5),
+                         ['{"seq": 4}', '{"seq": 5}'])
+        self.assertEqual(journal.replay(self.publisher, 2, limit=2),
+                         ['{"seq": 2}', '{"seq": 3}'])
+        self.assertEqual(journal.replay(self.publisher, 11), [])
+        journal.close()
+
+    def test_binary(self):
+        """Binary messages are replayed joined, newlines included"""
+        journal = self.journal()
+        parts = replication.encode({'method': 'store_image', 'args': [
+            replication.Blob('\n\x00image\n'), 'a.jpg']})
+        journal.append(self.publisher, 1, parts)
+        (message,) = journal.replay(self.publisher, 1)
+        self.assertEqual(message, ''.join(parts))
+        self.assertEqual(replication.decode([message])['args'],
+                         ['\n\x00image\n', 'a.jpg'])
+        journal.close()
+
+    def test_rotation(self):
+        """Old segments are removed, positions are kept"""
+        journal = self.journal(max_size=4096)
+        journal.append(self.publisher, 1, None, position=2)
+        for seq in xrange(1, 201):
+            journal.append(self.publisher, seq, ['x' * 100])
+        self.assertTrue(len(journal._segments()) > 1)
+        self.assertTrue(sum([os.path.getsize(path) for number, path in
+                             journal._segments()[:-1]]) <= 4096)
+
+        replayed = journal.replay(self.publisher, 1)
+        self.assertTrue(0 < len(replayed) < 200)
+        journal.close()
+
+        journal = self.journal()
+        (last_seqs, positions, applied) = journal.recover()
+        self.assertEqual(last_seqs, {self.publisher: 200})
+        self.assertEqual(positions, {self.publisher: 2})
+        journal.close()
+
+    def test_recover(self):
+        """Messages applied past the position count as received"""
+        journal = self.journal()
+        for seq in (1, 2, 4, 5):
+            journal.append(self.publisher, seq, ['{}'],
+                           position=seq < 3 and seq + 1 or None)
+        journal.close()
+
+        sequencer = replication.Sequencer(journal=self.journal())
+        self.assertEqual(sequencer.positions, {self.publisher: 3})
+        self.assertTrue(sequencer.seen(self.publisher, 4))
+        self.assertTrue(sequencer.seen(self.publisher, 5))
+        self.assertFalse(sequencer.seen(self.publisher, 3))
+        self.assertEqual(sequencer.applied(self.publisher, 3), 6)
+        sequencer.journal.close()
+
+    def test_identity(self):
+        journal = self.journal()
+        identity = journal.identity()
+        journal.close()
+        journal = self.journal()
+        self.assertEqual(journal.identity(), identity)
+        journal.close()
+
+
+class SequencerTest(unittest.TestCase):
+    """Duplicates, lost messages and positions, see replication.Sequencer"""
+
+    def setUp(self):
+        self.sequencer = replication.Sequencer(window=3)
+        self.publisher = uuid.uuid4()
+
+    def test_seen(self):
+        for seq in (1, 2, 3):
+            self.assertFalse(self.sequencer.seen(self.publisher, seq))
+        self.assertTrue(self.sequencer.seen(self.publisher, 2))
+        self.assertFalse(self.sequencer.seen(self.publisher, 4))
+        # Out of the window
+        self.assertFalse(self.sequencer.seen(self.publisher, 1))
+
+    def test_advance(self):
+        self.assertEqual(self.sequencer.advance(self.publisher, 1), None)
+        self.assertEqual(self.sequencer.advance(self.publisher, 2), None)
+        self.assertEqual(self.sequencer.advance(self.publisher, 6), (3, 5))
+        self.assertEqual(self.sequencer.advance(self.publisher, 4), None)
+        self.assertEqual(self.sequencer.positions[self.publisher], 7)
+
+    def test_applied(self):
+        """The position moves once all messages before it are applied"""
+        self.sequencer.advance(self.publisher, 1)
+        self.assertEqual(self.sequencer.applied(self.publisher, 2), None)
+        self.assertEqual(self.sequencer.applied(self.publisher, 4, 5), None)
+        self.assertEqual(self.sequencer.applied(self.publisher, 1), 3)
+        self.assertEqual(self.sequencer.applied(self.publisher, 3), 6)
+
+    def test_superseded(self):
+        """Messages older than the last one on their paths are skipped"""
+        superseded = self.sequencer.superseded
+        self.assertFalse(superseded(self.publisher, 2, ['/a.jpg']))
+        self.assertTrue(superseded(self.publisher, 1, ['/a.jpg']))
+        self.assertFalse(superseded(self.publisher, 1, ['/a.jpg', '/b.jpg']))
+        self.assertFalse(superseded(uuid.uuid4(), 1, ['/a.jpg']))
+        self.assertFalse(superseded(self.publisher, 3, ['/a.jpg']))
+        # Out of the window
+        self.assertFalse(superseded(self.publisher, 4, ['/c.jpg', '/d.jpg',
+                                                        '/e.jpg']))
+        self.assertFalse(superseded(self.publisher, 2, ['/a.jpg']))
+
+
+if __name__ == '__main__':
+    unittest.main()